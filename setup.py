@@ -41,12 +41,16 @@ else:
         # it might use the regiter rbx...
         extra_compile_args += ['-g']
         extra_compile_args += ['-O2']
-        extra_source_files += ['src/vmprof_unix.c', 'src/vmprof_mt.c']
+        extra_source_files += ['src/vmprof_unix.c', 'src/vmprof_mt.c',
+                               'src/vmprof_aggregate.c', 'src/vmprof_prefix.c',
+                               'src/vmprof_seen.c']
     elif _supported_unix():
         libraries = ['dl','unwind']
         extra_compile_args = ['-Wno-unused']
         if _supported_unix() == 'linux':
             extra_compile_args += ['-DVMPROF_LINUX=1']
+            # timer_create() for glibc < 2.17
+            libraries.append('rt')
         if _supported_unix() == 'bsd':
             libraries = ['unwind']
             extra_compile_args += ['-DVMPROF_BSD=1']
@@ -64,6 +68,10 @@ else:
         extra_source_files += [
            'src/vmprof_mt.c',
            'src/vmprof_unix.c',
+           'src/vmprof_aggregate.c',
+           'src/vmprof_prefix.c',
+           'src/vmprof_seen.c',
+           'src/vmprof_thread_timers.c',
            'src/libbacktrace/backtrace.c',
            'src/libbacktrace/state.c',
            'src/libbacktrace/elf.c',
@@ -99,6 +107,10 @@ else:
                            depends=[
                                'src/vmprof_unix.h',
                                'src/vmprof_mt.h',
+                               'src/vmprof_aggregate.h',
+                               'src/vmprof_prefix.h',
+                               'src/vmprof_seen.h',
+                               'src/vmprof_thread_timers.h',
                                'src/vmprof_common.h',
                                'src/vmp_stack.h',
                                'src/symboltable.h',
@@ -19,6 +19,9 @@ static PyObject* (*_default_eval_loop)(PyFrameObject *, int) = 0;
 #include "machine.h"
 #include "symboltable.h"
 #include "vmprof_unix.h"
+#include "vmprof_aggregate.h"
+#include "vmprof_prefix.h"
+#include "vmprof_seen.h"
 #else
 #include "vmprof_win.h"
 #endif
@@ -161,23 +164,61 @@ void emit_all_code_objects(PyObject * seen_code_ids)
 static void cpyprof_code_dealloc(PyObject *co)
 {
     if (vmprof_is_enabled()) {
+#ifdef VMPROF_UNIX
+        /* only a code object of the samples is written, and removed from
+           the set so that write_seen_code_objects() does not find it.
+           If the set overflowed, all of them are written. */
+        if (vmp_seen_remove(SEEN_CODE(CODE_ADDR_TO_UID(co))) ||
+                vmp_seen_words() == NULL)
+#endif
         emit_code_object((PyCodeObject *)co);
         /* xxx error return values are ignored */
     }
     Original_code_dealloc(co);
 }
 
-static PyObject *enable_vmprof(PyObject* self, PyObject *args)
+#ifdef VMP_WALK_CACHE
+static destructor Original_frame_dealloc = 0;
+
+static void cpyprof_frame_dealloc(PyObject *f)
+{
+    /* the walk cache must not mistake a new frame at this address for it */
+    vmp_walk_cache_forget((PyFrameObject *)f);
+    Original_frame_dealloc(f);
+}
+#endif
+
+static PyObject *enable_vmprof(PyObject* self, PyObject *args, PyObject *kwargs)
 {
+    static char *kwlist[] = {"fileno", "period", "memory", "lines", "native",
+                             "real_time", "aggregate", "compact_stacks",
+                             "writer_thread", "writer_latency", "num_buffers",
+                             "max_overhead", "per_thread", "perf_events",
+                             "cache_stacks", NULL};
     int fd;
     int memory = 0;
     int lines = 0;
     int native = 0;
     int real_time = 0;
+    int aggregate = 0;
+    int compact_stacks = 0;
+    int writer_thread = 0;
+    double writer_latency = 0.01;
+    int num_buffers = DEFAULT_NUM_BUFFERS;
+    double max_overhead = 0.0;
+    int per_thread = 0;
+    int perf_events = 0;
+    int cache_stacks = 0;
     double interval;
     char *p_error;
 
-    if (!PyArg_ParseTuple(args, "id|iiii", &fd, &interval, &memory, &lines, &native, &real_time)) {
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "id|iiiiiiididiii", kwlist,
+                                     &fd, &interval, &memory, &lines, &native,
+                                     &real_time, &aggregate, &compact_stacks,
+                                     &writer_thread, &writer_latency,
+                                     &num_buffers, &max_overhead,
+                                     &per_thread, &perf_events,
+                                     &cache_stacks)) {
         return NULL;
     }
 
@@ -201,8 +242,64 @@ static PyObject *enable_vmprof(PyObject* self, PyObject *args)
         PyErr_SetString(PyExc_ValueError, "real time profiling is only supported on Linux and MacOS");
         return NULL;
     }
+    if (aggregate) {
+        PyErr_SetString(PyExc_ValueError, "aggregation is only supported on Linux and MacOS");
+        return NULL;
+    }
+    if (compact_stacks) {
+        PyErr_SetString(PyExc_ValueError, "compact stacks are only supported on Linux and MacOS");
+        return NULL;
+    }
+    if (writer_thread) {
+        PyErr_SetString(PyExc_ValueError, "the writer thread is only supported on Linux and MacOS");
+        return NULL;
+    }
+    if (num_buffers != DEFAULT_NUM_BUFFERS) {
+        PyErr_SetString(PyExc_ValueError, "num_buffers is only supported on Linux and MacOS");
+        return NULL;
+    }
+    if (max_overhead != 0.0) {
+        PyErr_SetString(PyExc_ValueError, "max_overhead is only supported on Linux and MacOS");
+        return NULL;
+    }
+    if (per_thread || perf_events) {
+        PyErr_SetString(PyExc_ValueError, "per thread timers are only supported on Linux");
+        return NULL;
+    }
+    if (cache_stacks) {
+        PyErr_SetString(PyExc_ValueError, "cached stack walks are only supported on Linux and MacOS");
+        return NULL;
+    }
+#else
+    if (vmprof_set_per_thread(per_thread, perf_events) < 0) {
+        PyErr_SetString(PyExc_ValueError, "per thread timers are only supported on Linux");
+        return NULL;
+    }
+    if (perf_events && real_time) {
+        PyErr_SetString(PyExc_ValueError, "perf events only sample the CPU time, not the real time");
+        return NULL;
+    }
+    if (set_concurrent_bufs_count(num_buffers) < 0) {
+        PyErr_Format(PyExc_ValueError, "num_buffers must be between 1 and %d", MAX_NUM_BUFFERS);
+        return NULL;
+    }
 #endif
 
+    if (!(max_overhead >= 0.0 && max_overhead < 1.0)) {   /* also if it is NaN */
+        PyErr_SetString(PyExc_ValueError, "max_overhead must be >= 0 and < 1");
+        return NULL;
+    }
+
+    if (writer_thread && (writer_latency <= 0.0 || writer_latency > 10.0)) {
+        PyErr_SetString(PyExc_ValueError, "writer_latency must be > 0 and at most 10 seconds");
+        return NULL;
+    }
+
+    if (aggregate && memory) {
+        PyErr_SetString(PyExc_ValueError, "memory profiling cannot be combined with aggregation");
+        return NULL;
+    }
+
     vmp_profile_lines(lines);
 
     if (!Original_code_dealloc) {
@@ -210,14 +307,52 @@ static PyObject *enable_vmprof(PyObject* self, PyObject *args)
         PyCode_Type.tp_dealloc = &cpyprof_code_dealloc;
     }
 
-    p_error = vmprof_init(fd, interval, memory, lines, "cpython", native, real_time);
+    vmprof_set_aggregate(aggregate);
+    /* native is 2 (VMP_NATIVE_FRAME_POINTERS) for native='fp' */
+    p_error = vmprof_init(fd, interval, memory, lines, "cpython", native != 0, real_time);
     if (p_error) {
         PyErr_SetString(PyExc_ValueError, p_error);
         return NULL;
     }
 
+#ifdef VMPROF_UNIX
+    if (aggregate && vmp_aggregate_prepare(vmprof_get_prepare_interval_usec()) < 0) {
+        vmprof_set_aggregate(0);
+        PyErr_SetString(PyExc_ValueError, "out of memory");
+        return NULL;
+    }
+    vmp_prefix_release();
+    if (compact_stacks && vmp_prefix_prepare() < 0) {
+        PyErr_SetString(PyExc_ValueError, "out of memory");
+        return NULL;
+    }
+    /* without it disable() reads the profile to find the seen addresses */
+    (void)vmp_seen_prepare(lines);
+    vmp_walk_cache_release();
+    if (cache_stacks) {
+        if (!Original_frame_dealloc) {
+            Original_frame_dealloc = PyFrame_Type.tp_dealloc;
+            PyFrame_Type.tp_dealloc = &cpyprof_frame_dealloc;
+        }
+        if (vmp_walk_cache_prepare() < 0) {
+            PyErr_SetString(PyExc_ValueError, "out of memory");
+            return NULL;
+        }
+    }
+    if (writer_thread && start_writer_thread(fd, (long)(writer_latency * 1000000)) < 0) {
+        PyErr_SetFromErrno(PyExc_OSError);
+        return NULL;
+    }
+    vmprof_set_max_overhead(max_overhead);
+#endif
+
     if (vmprof_enable(memory, native, real_time) < 0) {
         PyErr_SetFromErrno(PyExc_OSError);
+#ifdef VMPROF_UNIX
+        if (writer_thread) {
+            (void)shutdown_concurrent_bufs(fd);
+        }
+#endif
         return NULL;
     }
 
@@ -236,6 +371,9 @@ static PyObject * vmp_is_enabled(PyObject *module, PyObject *noargs) {
 static PyObject *
 disable_vmprof(PyObject *module, PyObject *noargs)
 {
+#ifdef VMP_WALK_CACHE
+    vmp_walk_cache_stop();
+#endif
     if (vmprof_disable() < 0) {
         PyErr_SetFromErrno(PyExc_OSError);
         return NULL;
@@ -349,10 +487,88 @@ error:
 }
 #endif
 
+#ifdef VMPROF_UNIX
+static PyObject *
+seen_addresses(PyObject *module, PyObject *noargs)
+{
+    // assumptions: signals must be disabled (see stop_sampling)
+    const uintptr_t *words = vmp_seen_words();
+    PyObject *seen, *addr;
+    size_t i;
+
+    if (words == NULL) {
+        Py_RETURN_NONE;
+    }
+    seen = PySet_New(NULL);
+    if (seen == NULL) {
+        return NULL;
+    }
+    for (i = 0; i < SEEN_SIZE; i++) {
+        uintptr_t word = words[i];
+        if (word == 0 || word == SEEN_REMOVED) {
+            continue;
+        }
+        if (SEEN_IS_CODE(word)) {
+            word = SEEN_CODE_ID(word);
+        }
+        addr = PyLong_FromVoidPtr((void *)word);
+        if (addr == NULL || PySet_Add(seen, addr) < 0) {
+            Py_XDECREF(addr);
+            Py_DECREF(seen);
+            return NULL;
+        }
+        Py_DECREF(addr);
+    }
+    return seen;
+}
+#endif
+
+#ifdef VMPROF_UNIX
+static PyObject *
+write_seen_code_objects(PyObject *module, PyObject *noargs)
+{
+    // assumptions: signals must be disabled (see stop_sampling)
+    const uintptr_t *words = vmp_seen_words();
+    size_t i;
+
+    if (words == NULL) {
+        PyErr_SetString(PyExc_ValueError, "the seen addresses are unknown");
+        return NULL;
+    }
+    for (i = 0; i < SEEN_SIZE; i++) {
+        uintptr_t word = words[i];
+        // only the words the stack walker added as code ids are code
+        // objects, the ones that died since they were seen are emitted
+        // and removed by cpyprof_code_dealloc, see vmprof_seen.h
+        if (word == SEEN_REMOVED || !SEEN_IS_CODE(word)) {
+            continue;
+        }
+        if (emit_code_object((PyCodeObject *)SEEN_CODE_ID(word)) < 0) {
+            break;
+        }
+    }
+
+    if (PyErr_Occurred())
+        return NULL;
+    Py_RETURN_NONE;
+}
+#endif
+
 static PyObject *
 stop_sampling(PyObject *module, PyObject *noargs)
 {
     vmprof_ignore_signals(1);
+#ifdef VMPROF_UNIX
+    // the aggregated samples must be in the profile before disable()
+    // looks for the code objects and native symbols of the samples
+    if (vmprof_get_aggregate() && vmp_profile_fileno() >= 0) {
+        (void)vmp_aggregate_flush(vmp_profile_fileno());
+    }
+    // and so must the samples still waiting for the writer thread
+    if (vmp_profile_fileno() >= 0) {
+        (void)flush_concurrent_bufs(vmp_profile_fileno());
+    }
+#endif
     return PyLong_NEW(vmp_profile_fileno());
 }
 
@@ -425,8 +641,47 @@ remove_real_time_thread(PyObject *module, PyObject * noargs) {
 }
 #endif
 
+#ifdef VMPROF_UNIX
+static PyObject *
+get_sampler_stats(PyObject *module, PyObject * noargs) {
+    struct vmprof_sampler_stats_s stats;
+    vmprof_get_sampler_stats(&stats);
+    return Py_BuildValue("{sl,sl,sl,sl,sl,sl,sl,sl,sl,sl,sl,sl,sl,sl,sl,sl,sl,ss}",
+                         "samples", stats.samples,
+                         "dropped_samples", stats.dropped,
+                         "cancelled_samples", stats.cancelled,
+                         "handler_ns", stats.handler_ns,
+                         "handler_max_ns", stats.handler_max_ns,
+                         "pystate_ns", stats.pystate_ns,
+                         "pystate_lockfree", stats.pystate_lockfree,
+                         "walk_ns", stats.walk_ns,
+                         "commit_ns", stats.commit_ns,
+                         "elapsed_ns", stats.elapsed_ns,
+                         "bytes_written", stats.bytes_written,
+                         "unwind_hits", stats.unwind_hits,
+                         "unwind_misses", stats.unwind_misses,
+                         "fp_walks", stats.fp_walks,
+                         "fp_fallbacks", stats.fp_fallbacks,
+                         "walked_frames", stats.walked_frames,
+                         "cached_frames", stats.cached_frames,
+                         "backend", vmprof_get_sampling_backend());
+}
+#endif
+
+#ifdef VMPROF_UNIX
+static PyObject *
+register_thread(PyObject *module, PyObject * noargs) {
+    if (vmprof_register_thread() < 0) {
+        PyErr_SetFromErrno(PyExc_OSError);
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+#endif
+
 static PyMethodDef VMProfMethods[] = {
-    {"enable",  enable_vmprof, METH_VARARGS, "Enable profiling."},
+    {"enable",  (PyCFunction)enable_vmprof, METH_VARARGS | METH_KEYWORDS,
+        "Enable profiling."},
     {"disable", disable_vmprof, METH_NOARGS, "Disable profiling."},
     {"write_all_code_objects", write_all_code_objects, METH_O,
         "Write eagerly all the IDs of code objects"},
@@ -449,6 +704,14 @@ static PyMethodDef VMProfMethods[] = {
         "Insert a thread into the real time profiling list."},
     {"remove_real_time_thread", remove_real_time_thread, METH_NOARGS,
         "Remove a thread from the real time profiling list."},
+    {"register_thread", register_thread, METH_NOARGS,
+        "Creates the timer of the calling thread if there is one per thread."},
+    {"get_stats", get_sampler_stats, METH_NOARGS,
+        "Counters of the sampler itself, of the current or last profile."},
+    {"seen_addresses", seen_addresses, METH_NOARGS,
+        "The code ids and native addresses of the samples, None if unknown."},
+    {"write_seen_code_objects", write_seen_code_objects, METH_NOARGS,
+        "Write the code objects of the samples that are still alive."},
 #endif
     {NULL, NULL, 0, NULL}        /* Sentinel */
 };
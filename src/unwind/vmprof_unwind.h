@@ -43,6 +43,8 @@ typedef struct unw_proc_info
     void *unwind_info;         /* unwind-info (arch-specific) */
   } unw_proc_info_t;
 
+typedef struct unw_addr_space *unw_addr_space_t;
+
 // end of copy
 
 #endif
@@ -13,6 +13,9 @@
 
 #include "vmprof.h"
 #include "compat.h"
+#ifdef VMPROF_UNIX
+#include "vmprof_seen.h"
+#endif
 
 #ifdef VMP_SUPPORTS_NATIVE_PROFILING
 
@@ -28,6 +31,10 @@ static int (*unw_get_proc_info)(unw_cursor_t *, unw_proc_info_t *) = NULL;
 static int (*unw_get_proc_name)(unw_cursor_t *, char *, size_t, unw_word_t*) = NULL;
 static int (*unw_is_signal_frame)(unw_cursor_t *) = NULL;
 static int (*unw_getcontext)(unw_context_t *) = NULL;
+// optional, only the frame pointer walker needs them
+static int (*unw_get_proc_info_by_ip)(unw_addr_space_t, unw_word_t,
+                                      unw_proc_info_t *, void *) = NULL;
+static unw_addr_space_t *unw_local_addr_space = NULL;
 #else
 #define UNW_LOCAL_ONLY
 #include <libunwind.h>
@@ -122,6 +129,10 @@ static PY_STACK_FRAME_T * _write_python_stack_entry(PY_STACK_FRAME_T * frame, vo
         }
     }
     result[*depth] = (void*)CODE_ADDR_TO_UID(FRAME_CODE(frame));
+#ifdef VMPROF_UNIX
+    /* known to be a code id here, see vmprof_seen.h */
+    vmp_seen_add_code((uintptr_t)result[*depth]);
+#endif
     *depth = *depth + 1;
 #else
 
@@ -144,9 +155,290 @@ static PY_STACK_FRAME_T * _write_python_stack_entry(PY_STACK_FRAME_T * frame, vo
     return FRAME_STEP(frame);
 }
 
+#ifdef VMP_WALK_CACHE
+/* The frames of a thread closest to the root usually stay the same from
+   one sample to the next.  The walk cache keeps the chain of frames of
+   the last stack trace of a thread (in a slot chosen by the thread) with
+   the words written for each of them.  The walker stops at the first
+   frame that is in the chain and copies the words of its callers from
+   the chain instead of walking them.
+
+   That is exact because a frame (unless it belongs to a generator or a
+   coroutine) runs only once: if it is still on the stack, it did not
+   return since the last sample, so none of its callers returned or moved
+   to another line either.  The frames of generators and coroutines can
+   be resumed by another caller, they are never looked up.  A frame that
+   is deallocated is removed by vmp_walk_cache_forget() (called by the
+   tp_dealloc of frames), so a new frame at the same address is never
+   mistaken for it.
+
+   A table shared by all slots maps a frame to its slot and its height
+   (the distance to the root of the chain).  Entries are claimed with a
+   compare and swap and published after the slot and the height, a frame
+   that finds no free entry is just not cached. */
+#include <pthread.h>
+#include <sys/mman.h>
+
+#ifndef MAP_ANONYMOUS
+#define MAP_ANONYMOUS MAP_ANON
+#endif
+
+#define WALK_CACHE_SLOTS    64
+#define WALK_CACHE_WORDS    1024    /* more than the words of a stack trace */
+#define WALK_CACHE_SIZE     16384   /* entries of the table, a power of two */
+#define WALK_CACHE_PROBES   8
+#define WALK_CACHE_CLAIMED  ((PY_STACK_FRAME_T *)1)
+
+#ifndef CO_COROUTINE
+#define CO_COROUTINE 0
+#endif
+#ifndef CO_ASYNC_GENERATOR
+#define CO_ASYNC_GENERATOR 0
+#endif
+#define RESUMABLE_FLAGS  (CO_GENERATOR | CO_COROUTINE | CO_ASYNC_GENERATOR)
+
+struct walk_cache_entry_s {
+    PY_STACK_FRAME_T * volatile frame;  /* NULL if the entry is free */
+    int slot;
+    int height;
+};
+
+struct walk_cache_slot_s {
+    int volatile lock;
+    int per_loop;               /* words per frame of the chain */
+    long height;                /* frames in the chain */
+    uintptr_t thread;
+    PY_STACK_FRAME_T *frames[WALK_CACHE_WORDS];  /* root first */
+    void *words[WALK_CACHE_WORDS];  /* leaf first, at the end */
+    PY_STACK_FRAME_T *fresh[WALK_CACHE_WORDS];   /* of the current walk */
+};
+
+static struct walk_cache_slot_s *walk_slots = NULL;
+static struct walk_cache_entry_s *walk_table = NULL;
+static int volatile walk_cache_on = 0;
+static long volatile walk_cache_walked = 0;
+static long volatile walk_cache_cached = 0;
+
+static size_t _walk_cache_index(PY_STACK_FRAME_T *frame)
+{
+    return (size_t)((((uintptr_t)frame >> 4) * 2654435761u) >> 8);
+}
+
+static long _walk_cache_height(int slot, PY_STACK_FRAME_T *frame)
+{
+    /* Returns the height of frame in the chain of slot, -1 if it is not
+       in it. */
+    size_t index = _walk_cache_index(frame);
+    struct walk_cache_slot_s *s = &walk_slots[slot];
+    int i;
+    for (i = 0; i < WALK_CACHE_PROBES; i++) {
+        struct walk_cache_entry_s *e = &walk_table[(index + i) & (WALK_CACHE_SIZE - 1)];
+        if (e->frame == frame && e->slot == slot && e->height < s->height &&
+                s->frames[e->height] == frame) {
+            return e->height;
+        }
+    }
+    return -1;
+}
+
+static void _walk_cache_add(int slot, long height, PY_STACK_FRAME_T *frame)
+{
+    size_t index = _walk_cache_index(frame);
+    int i;
+    for (i = 0; i < WALK_CACHE_PROBES; i++) {
+        struct walk_cache_entry_s *e = &walk_table[(index + i) & (WALK_CACHE_SIZE - 1)];
+        if (e->frame == frame && e->slot == slot) {
+            e->height = (int)height;
+            return;
+        }
+    }
+    for (i = 0; i < WALK_CACHE_PROBES; i++) {
+        struct walk_cache_entry_s *e = &walk_table[(index + i) & (WALK_CACHE_SIZE - 1)];
+        if (e->frame == NULL &&
+                __sync_bool_compare_and_swap(&e->frame, NULL, WALK_CACHE_CLAIMED)) {
+            e->slot = slot;
+            e->height = (int)height;
+            __sync_synchronize();
+            e->frame = frame;
+            return;
+        }
+    }
+}
+
+static void _walk_cache_remove(PY_STACK_FRAME_T *frame)
+{
+    size_t index = _walk_cache_index(frame);
+    int i;
+    for (i = 0; i < WALK_CACHE_PROBES; i++) {
+        struct walk_cache_entry_s *e = &walk_table[(index + i) & (WALK_CACHE_SIZE - 1)];
+        if (e->frame == frame) {
+            (void)__sync_bool_compare_and_swap(&e->frame, frame, NULL);
+        }
+    }
+}
+
+static void _walk_cache_clear(struct walk_cache_slot_s *s)
+{
+    long i;
+    for (i = 0; i < s->height; i++) {
+        _walk_cache_remove(s->frames[i]);
+    }
+    s->height = 0;
+}
+
+static int _walk_cached(PY_STACK_FRAME_T *frame, void **result,
+                        int max_depth, int depth)
+{
+    /* vmp_walk_and_record_python_stack_only() with the walk cache.
+       Returns -1 if the slot of the thread is in use. */
+    struct walk_cache_slot_s *s;
+    uintptr_t thread = (uintptr_t)pthread_self();
+    int slot = (int)((((thread >> 12) * 2654435761u) >> 8) % WALK_CACHE_SLOTS);
+    int per_loop = _per_loop();
+    int start = depth;
+    long walked = 0, found = -1, first, height, i;
+    PY_STACK_FRAME_T *f;
+
+    s = &walk_slots[slot];
+    if (!__sync_bool_compare_and_swap(&s->lock, 0, 1)) {
+        return -1;
+    }
+    if (s->thread != thread || s->per_loop != per_loop) {
+        _walk_cache_clear(s);
+        s->thread = thread;
+        s->per_loop = per_loop;
+    }
+
+    for (f = frame; f != NULL; f = FRAME_STEP(f)) {
+        if (walked == WALK_CACHE_WORDS || depth + per_loop > max_depth) {
+            /* too deep for the cache, or the stack trace is full */
+            _walk_cache_clear(s);
+            __sync_lock_release(&s->lock);
+            while ((depth + per_loop) <= max_depth && f) {
+                f = _write_python_stack_entry(f, result, &depth, max_depth);
+            }
+            return depth;
+        }
+        s->fresh[walked++] = f;
+        (void)_write_python_stack_entry(f, result, &depth, max_depth);
+        if (!(FRAME_CODE(f)->co_flags & RESUMABLE_FLAGS)) {
+            found = _walk_cache_height(slot, f);
+            if (found >= 0) {
+                break;
+            }
+        }
+    }
+    __sync_fetch_and_add(&walk_cache_walked, walked);
+
+    /* the callers of the frame found are the frames below it */
+    if (found > 0) {
+        long words = found * per_loop;
+        if (words > max_depth - depth) {
+            words = (max_depth - depth) / per_loop * per_loop;
+        }
+        memcpy(result + depth, &s->words[WALK_CACHE_WORDS - found * per_loop],
+               words * sizeof(void *));
+        depth += (int)words;
+        __sync_fetch_and_add(&walk_cache_cached, words / per_loop);
+    }
+
+    /* the frames walked replace the ones above the frame found */
+    first = found >= 0 ? found : 0;
+    height = first + walked;
+    if (height * per_loop > WALK_CACHE_WORDS) {
+        _walk_cache_clear(s);
+    } else {
+        for (i = first; i < s->height; i++) {
+            if (i >= height || s->frames[i] != s->fresh[height - 1 - i]) {
+                _walk_cache_remove(s->frames[i]);
+            }
+        }
+        s->height = first;
+        for (i = 0; i < walked; i++) {
+            f = s->fresh[i];
+            s->frames[height - 1 - i] = f;
+            if (!(FRAME_CODE(f)->co_flags & RESUMABLE_FLAGS)) {
+                _walk_cache_add(slot, height - 1 - i, f);
+            }
+        }
+        memcpy(&s->words[WALK_CACHE_WORDS - height * per_loop], result + start,
+               walked * per_loop * sizeof(void *));
+        s->height = height;
+    }
+    __sync_lock_release(&s->lock);
+    return depth;
+}
+
+int vmp_walk_cache_prepare(void)
+{
+    vmp_walk_cache_release();
+    walk_slots = mmap(NULL, sizeof(struct walk_cache_slot_s) * WALK_CACHE_SLOTS,
+                      PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS,
+                      -1, 0);
+    if (walk_slots == MAP_FAILED) {
+        walk_slots = NULL;
+        return -1;
+    }
+    walk_table = mmap(NULL, sizeof(struct walk_cache_entry_s) * WALK_CACHE_SIZE,
+                      PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS,
+                      -1, 0);
+    if (walk_table == MAP_FAILED) {
+        walk_table = NULL;
+        vmp_walk_cache_release();
+        return -1;
+    }
+    walk_cache_walked = walk_cache_cached = 0;
+    walk_cache_on = 1;
+    return 0;
+}
+
+void vmp_walk_cache_stop(void)
+{
+    walk_cache_on = 0;
+}
+
+void vmp_walk_cache_release(void)
+{
+    walk_cache_on = 0;
+    if (walk_slots != NULL) {
+        munmap(walk_slots, sizeof(struct walk_cache_slot_s) * WALK_CACHE_SLOTS);
+        walk_slots = NULL;
+    }
+    if (walk_table != NULL) {
+        munmap(walk_table, sizeof(struct walk_cache_entry_s) * WALK_CACHE_SIZE);
+        walk_table = NULL;
+    }
+}
+
+void vmp_walk_cache_forget(PY_STACK_FRAME_T *frame)
+{
+    if (walk_cache_on) {
+        _walk_cache_remove(frame);
+    }
+}
+#endif
+
+void vmp_walk_cache_stats(long * walked, long * cached)
+{
+#ifdef VMP_WALK_CACHE
+    *walked = walk_cache_walked;
+    *cached = walk_cache_cached;
+#else
+    *walked = *cached = 0;
+#endif
+}
+
 int vmp_walk_and_record_python_stack_only(PY_STACK_FRAME_T *frame, void ** result,
                                           int max_depth, int depth, intptr_t pc)
 {
+#ifdef VMP_WALK_CACHE
+    if (walk_cache_on) {
+        int cached_depth = _walk_cached(frame, result, max_depth, depth);
+        if (cached_depth >= 0) {
+            return cached_depth;
+        }
+    }
+#endif
     while ((depth + _per_loop()) <= max_depth && frame) {
         frame = _write_python_stack_entry(frame, result, &depth, max_depth);
     }
@@ -154,6 +446,91 @@ int vmp_walk_and_record_python_stack_only(PY_STACK_FRAME_T *frame, void ** resul
 }
 
 #ifdef VMP_SUPPORTS_NATIVE_PROFILING
+/* A cache of the start address of the procedure each instruction pointer
+   belongs to, unw_get_proc_info() is the most expensive part of walking
+   the native stack.  It is an open addressing table allocated up front,
+   entries are only added (the key is claimed with a compare and swap and
+   published after the value), so the signal handlers of several threads
+   can use it at the same time.  When the probes of an ip find no free
+   entry it is simply not cached.  It is emptied by vmp_native_enable(). */
+#define UNWIND_CACHE_SIZE    8192   /* a power of two */
+#define UNWIND_CACHE_PROBES  8
+#define UNWIND_CACHE_CLAIMED ((unw_word_t)1)
+
+struct unwind_cache_entry_s {
+    unw_word_t volatile ip;     /* 0 if the entry is free */
+    unw_word_t start_ip;
+};
+
+static struct unwind_cache_entry_s unwind_cache[UNWIND_CACHE_SIZE];
+static long volatile unwind_cache_hits = 0;
+static long volatile unwind_cache_misses = 0;
+
+static void _reset_unwind_cache(void)
+{
+    memset((void *)unwind_cache, 0, sizeof(unwind_cache));
+    unwind_cache_hits = unwind_cache_misses = 0;
+}
+
+static unw_word_t _proc_start_ip(unw_cursor_t * cursor, unw_word_t ip,
+                                 long * hits, long * misses)
+{
+    /* Returns the start address of the procedure of the cursor's frame,
+       or of the one that contains ip if cursor is NULL.  Returns 0 if it
+       is unknown. */
+    unw_proc_info_t pip;
+    struct unwind_cache_entry_s * entry = NULL;
+    unsigned long i, index;
+    int ret;
+
+    if (cursor != NULL && unw_get_reg(cursor, UNW_REG_IP, &ip) < 0) {
+        ip = 0;
+    }
+    if (ip > UNWIND_CACHE_CLAIMED) {
+        index = (unsigned long)(ip * 0x9E3779B97F4A7C15ULL >> 32);
+        for (i = 0; i < UNWIND_CACHE_PROBES; i++) {
+            struct unwind_cache_entry_s * e = &unwind_cache[(index + i) & (UNWIND_CACHE_SIZE - 1)];
+            unw_word_t key = e->ip;
+            if (key == ip) {
+                __sync_synchronize();
+                (*hits)++;
+                return e->start_ip;
+            }
+            if (key == 0) {
+                if (__sync_bool_compare_and_swap(&e->ip, 0, UNWIND_CACHE_CLAIMED)) {
+                    entry = e;
+                }
+                break;
+            }
+        }
+    }
+    (*misses)++;
+    if (cursor != NULL) {
+        ret = unw_get_proc_info(cursor, &pip);
+    } else {
+        ret = unw_get_proc_info_by_ip(*unw_local_addr_space, ip, &pip, NULL);
+    }
+    if (ret < 0) {
+        pip.start_ip = 0;
+    }
+    if (entry != NULL) {
+        entry->start_ip = pip.start_ip;
+        __sync_synchronize();
+        entry->ip = ip;
+    }
+    return pip.start_ip;
+}
+
+static void _count_unwind_cache(long hits, long misses)
+{
+    if (hits) {
+        __sync_fetch_and_add(&unwind_cache_hits, hits);
+    }
+    if (misses) {
+        __sync_fetch_and_add(&unwind_cache_misses, misses);
+    }
+}
+
 int _write_native_stack(void* addr, void ** result, int depth, int max_depth) {
 #ifdef RPYTHON_VMPROF
     if (depth + 2 >= max_depth) {
@@ -204,7 +581,7 @@ int vmp_walk_and_record_stack(PY_STACK_FRAME_T *frame, void ** result,
     void * func_addr;
     unw_cursor_t cursor;
     unw_context_t uc;
-    unw_proc_info_t pip;
+    long hits = 0, misses = 0;
     int ret;
 
     if (vmp_native_enabled() == 0) {
@@ -264,9 +641,7 @@ int vmp_walk_and_record_stack(PY_STACK_FRAME_T *frame, void ** result,
     int depth = 0;
     //PY_STACK_FRAME_T * top_most_frame = frame;
     while ((depth + _per_loop()) <= max_depth) {
-        unw_get_proc_info(&cursor, &pip);
-
-        func_addr = (void*)pip.start_ip;
+        func_addr = (void*)_proc_start_ip(&cursor, 0, &hits, &misses);
 
         //{
         //    char name[64];
@@ -292,11 +667,13 @@ int vmp_walk_and_record_stack(PY_STACK_FRAME_T *frame, void ** result,
         }
 #endif
 
-        if (IS_VMPROF_EVAL((void*)pip.start_ip)) {
+        if (IS_VMPROF_EVAL(func_addr)) {
             // yes we found one stack entry of the python frames!
+            _count_unwind_cache(hits, misses);
             return vmp_walk_and_record_python_stack_only(frame, result, max_depth, depth, pc);
 #ifdef PYPY_JIT_CODEMAP
         } else if (pypy_find_codemap_at_addr(rip, &start_addr) != NULL) {
+            _count_unwind_cache(hits, misses);
             depth = vmprof_write_header_for_jit_addr(result, depth, pc, max_depth);
             return vmp_walk_and_record_python_stack_only(frame, result, max_depth, depth, pc);
 #endif
@@ -314,15 +691,183 @@ int vmp_walk_and_record_stack(PY_STACK_FRAME_T *frame, void ** result,
             break;
         } else if (err < 0) {
             // this sample is broken, cannot walk native level... record python level (at least)
+            _count_unwind_cache(hits, misses);
             return vmp_walk_and_record_python_stack_only(frame, result, max_depth, 0, pc);
         }
     }
+    _count_unwind_cache(hits, misses);
 
     // if we come here, the found stack trace is removed and only python stacks are recorded
 #endif
     return vmp_walk_and_record_python_stack_only(frame, result, max_depth, 0, pc);
 }
 
+#if defined(VMP_SUPPORTS_NATIVE_PROFILING) && defined(VMPROF_LINUX) && defined(X86_64)
+#define VMP_FRAME_POINTERS
+#include <pthread.h>
+#include <sys/resource.h>
+
+/* The frame pointer walker follows the chain of saved rbp registers of
+   code compiled with -fno-omit-frame-pointer: [rbp] is the rbp of the
+   caller, [rbp + 8] the return address into it.  A frame must lie
+   between the stack pointer of the interrupted code and the top of the
+   thread's stack and above the previous one, otherwise the chain is
+   broken (code without frame pointers uses rbp for anything) and the
+   sample is walked with libunwind instead.  The top of a thread's stack
+   is where glibc puts its struct pthread, pthread_self(); the main
+   thread's stack is read from /proc/self/maps when the walker is
+   selected. */
+#define MAX_THREAD_STACK_SIZE  (1024UL * 1024 * 1024)
+
+static int vmp_frame_pointers = 0;
+static uintptr_t main_stack_top = 0, main_stack_size = 0;
+static long volatile fp_walks = 0;
+static long volatile fp_fallbacks = 0;
+
+static int _read_main_stack(void)
+{
+    FILE * maps;
+    char line[512];
+    unsigned long start, end;
+    struct rlimit limit;
+
+    maps = fopen("/proc/self/maps", "r");
+    if (maps == NULL) {
+        return -1;
+    }
+    main_stack_top = 0;
+    while (fgets(line, sizeof(line), maps) != NULL) {
+        if (strstr(line, "[stack]") != NULL &&
+                sscanf(line, "%lx-%lx", &start, &end) == 2) {
+            main_stack_top = end;
+            break;
+        }
+    }
+    fclose(maps);
+    main_stack_size = MAX_THREAD_STACK_SIZE;
+    if (getrlimit(RLIMIT_STACK, &limit) == 0 && limit.rlim_cur != RLIM_INFINITY &&
+            limit.rlim_cur < main_stack_size) {
+        main_stack_size = limit.rlim_cur;
+    }
+    return main_stack_top == 0 ? -1 : 0;
+}
+
+static uintptr_t _stack_top(uintptr_t sp)
+{
+    /* Returns the top of the stack sp points into, or 0 */
+    uintptr_t top;
+    if (sp < main_stack_top && main_stack_top - sp <= main_stack_size) {
+        return main_stack_top;
+    }
+    top = (uintptr_t)pthread_self();
+    if (sp < top && top - sp <= MAX_THREAD_STACK_SIZE) {
+        return top;
+    }
+    return 0;
+}
+
+static int _walk_frame_pointers(PY_STACK_FRAME_T * frame, void ** result,
+                                int max_depth, ucontext_t * uc)
+{
+    /* Returns the depth of the stack trace, or -1 if the frame pointer
+       chain is broken */
+    uintptr_t ip = (uintptr_t)uc->uc_mcontext.gregs[REG_RIP];
+    uintptr_t fp = (uintptr_t)uc->uc_mcontext.gregs[REG_RBP];
+    uintptr_t sp = (uintptr_t)uc->uc_mcontext.gregs[REG_RSP];
+    uintptr_t top = _stack_top(sp);
+    unw_word_t start_ip;
+    long hits = 0, misses = 0;
+    int depth = 0;
+    int leaf = 1;
+
+    if (top == 0) {
+        return -1;
+    }
+    while ((depth + _per_loop()) <= max_depth) {
+        // a return address belongs to the call instruction before it
+        start_ip = _proc_start_ip(NULL, leaf ? ip : ip - 1, &hits, &misses);
+        if (IS_VMPROF_EVAL((void*)start_ip)) {
+            _count_unwind_cache(hits, misses);
+            return vmp_walk_and_record_python_stack_only(frame, result, max_depth, depth, 0);
+        }
+        if (start_ip != 0) {
+            depth = _write_native_stack((void*)(start_ip | 0x1), result, depth, max_depth);
+        }
+        if (fp == 0) {
+            break;  // the outermost frame
+        }
+        if (fp < sp || fp > top - 2 * sizeof(uintptr_t) || (fp & (sizeof(uintptr_t) - 1))) {
+            _count_unwind_cache(hits, misses);
+            return -1;
+        }
+        // the caller's frame pointer is only checked when it is followed,
+        // code without frame pointers (e.g. the eval loop) can be the
+        // caller as long as it is the last frame needed
+        ip = ((uintptr_t *)fp)[1];
+        sp = fp + 2 * sizeof(uintptr_t);
+        fp = ((uintptr_t *)fp)[0];
+        leaf = 0;
+    }
+    // like the libunwind walker, only the python frames are recorded
+    _count_unwind_cache(hits, misses);
+    return vmp_walk_and_record_python_stack_only(frame, result, max_depth, 0, 0);
+}
+#endif
+
+int vmp_native_use_frame_pointers(int use) {
+#ifdef VMP_FRAME_POINTERS
+    if (!use) {
+        vmp_frame_pointers = 0;
+        return 0;
+    }
+    if (unw_get_proc_info_by_ip == NULL || unw_local_addr_space == NULL ||
+            _read_main_stack() < 0) {
+        vmp_frame_pointers = 0;
+        return -1;
+    }
+    fp_walks = fp_fallbacks = 0;
+    vmp_frame_pointers = 1;
+    return 0;
+#else
+    return use ? -1 : 0;
+#endif
+}
+
+int vmp_walk_and_record_stack_uc(PY_STACK_FRAME_T *frame, void ** result,
+                                 int max_depth, void * ucontext) {
+    // called in signal handler, with the context of the interrupted code
+#ifdef VMP_FRAME_POINTERS
+    int depth;
+    if (vmp_frame_pointers && vmp_native_enabled()) {
+        __sync_fetch_and_add(&fp_walks, 1L);
+        depth = _walk_frame_pointers(frame, result, max_depth, (ucontext_t *)ucontext);
+        if (depth >= 0) {
+            return depth;
+        }
+        __sync_fetch_and_add(&fp_fallbacks, 1L);
+    }
+#endif
+    return vmp_walk_and_record_stack(frame, result, max_depth, 1, 0);
+}
+
+void vmp_frame_pointer_stats(long * walks, long * fallbacks) {
+#ifdef VMP_FRAME_POINTERS
+    *walks = fp_walks;
+    *fallbacks = fp_fallbacks;
+#else
+    *walks = *fallbacks = 0;
+#endif
+}
+
+void vmp_unwind_cache_stats(long * hits, long * misses) {
+#ifdef VMP_SUPPORTS_NATIVE_PROFILING
+    *hits = unwind_cache_hits;
+    *misses = unwind_cache_misses;
+#else
+    *hits = *misses = 0;
+#endif
+}
+
 int vmp_native_enabled(void) {
 #ifdef VMP_SUPPORTS_NATIVE_PROFILING
     return vmp_native_traces_enabled;
@@ -582,9 +1127,12 @@ loaded_libunwind:
         if ((unw_getcontext = dlsym(libhandle, U_PREFIX PREFIX "_getcontext")) == NULL) {
             goto bail_out;
         }
+        unw_get_proc_info_by_ip = dlsym(libhandle, UL_PREFIX PREFIX "_get_proc_info_by_ip");
+        unw_local_addr_space = dlsym(libhandle, UL_PREFIX PREFIX "_local_addr_space");
     }
 #endif
 
+    _reset_unwind_cache();
     vmp_native_traces_enabled = 1;
     return 1;
 
@@ -4,8 +4,34 @@
 
 int vmp_walk_and_record_stack(PY_STACK_FRAME_T * frame, void **data,
                               int max_depth, int signal, intptr_t pc);
+/* walks from the interrupted context of a signal handler, with the frame
+   pointer walker if it is used, see vmp_native_use_frame_pointers() */
+int vmp_walk_and_record_stack_uc(PY_STACK_FRAME_T * frame, void **data,
+                                 int max_depth, void * ucontext);
 
 int vmp_native_enabled(void);
+/* the hits and misses of the cache of unw_get_proc_info() results */
+void vmp_unwind_cache_stats(long * hits, long * misses);
+/* Walks the native stack by following the frame pointers instead of with
+   libunwind (after vmp_native_enable(), only on Linux x86_64, returns -1
+   elsewhere).  Samples whose frame pointer chain is broken are walked with
+   libunwind, vmp_frame_pointer_stats() counts them. */
+#define VMP_NATIVE_FRAME_POINTERS  2   /* the value of native that selects it */
+int vmp_native_use_frame_pointers(int use);
+void vmp_frame_pointer_stats(long * walks, long * fallbacks);
+/* Caches the Python frames of the last stack trace of every thread, the
+   next walk stops at the first frame that is still on the stack (CPython
+   on Unix only).  vmp_walk_cache_forget() must be called when a frame is
+   deallocated.  vmp_walk_cache_stats() counts the frames walked and the
+   ones copied from the cache. */
+#if !defined(RPYTHON_VMPROF) && defined(VMPROF_UNIX)
+#define VMP_WALK_CACHE
+int vmp_walk_cache_prepare(void);
+void vmp_walk_cache_stop(void);
+void vmp_walk_cache_release(void);
+void vmp_walk_cache_forget(PY_STACK_FRAME_T * frame);
+#endif
+void vmp_walk_cache_stats(long * walked, long * cached);
 int vmp_native_enable(void);
 int vmp_ignore_ip(intptr_t ip);
 int vmp_binary_search_ranges(intptr_t ip, intptr_t * l, int count);
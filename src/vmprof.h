@@ -19,6 +19,8 @@
 #define MARKER_TIME_N_ZONE '\x06'
 #define MARKER_META '\x07'
 #define MARKER_NATIVE_SYMBOLS '\x08'
+#define MARKER_STACKTRACE_PREFIX '\x09'
+#define MARKER_PERIOD '\x0a'
 
 #define VERSION_BASE '\x00'
 #define VERSION_THREAD_ID '\x01'
@@ -33,6 +35,7 @@
 #define PROFILE_NATIVE '\x04'
 #define PROFILE_RPYTHON '\x08'
 #define PROFILE_REAL_TIME '\x10'
+#define PROFILE_AGGREGATE '\x20'
 
 #define DYN_JIT_FLAG 0xbeefbeef
 
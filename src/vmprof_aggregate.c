@@ -0,0 +1,203 @@
+#include "vmprof_aggregate.h"
+/* Aggregation of stack traces in the sampler (implementation) */
+
+#include <assert.h>
+#include <string.h>
+#include <sys/mman.h>
+
+#include "vmprof_mt.h"
+
+#ifndef MAP_ANONYMOUS
+#define MAP_ANONYMOUS MAP_ANON
+#endif
+
+/* twice the number of entries, the hash table is at most half full */
+#define AGGREGATE_SLOTS  (2 * AGGREGATE_MAX_ENTRIES)
+
+struct aggregate_entry_s {
+    unsigned long hash;
+    long count;         /* samples since the entry was last written */
+    long depth;
+    long offset;        /* of the stack trace in aggregate_s.words */
+    void *thread;
+};
+
+struct aggregate_s {
+    long entry_count;
+    long word_count;
+    long samples;       /* since the last flush */
+    long flush_every;
+    /* index of the entry + 1, 0 marks a free slot */
+    unsigned int slots[AGGREGATE_SLOTS];
+    struct aggregate_entry_s entries[AGGREGATE_MAX_ENTRIES];
+    void *words[AGGREGATE_MAX_WORDS];
+};
+
+static struct aggregate_s *aggregate = NULL;
+static int volatile aggregate_lock = 0;
+
+int vmp_aggregate_prepare(long interval_usec)
+{
+    vmp_aggregate_release();
+    aggregate = mmap(NULL, sizeof(struct aggregate_s),
+                     PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS,
+                     -1, 0);
+    if (aggregate == MAP_FAILED) {
+        aggregate = NULL;
+        return -1;
+    }
+    /* the table is written about once per second of samples */
+    aggregate->flush_every = 1;
+    if (interval_usec > 0 && interval_usec < 1000000) {
+        aggregate->flush_every = 1000000 / interval_usec;
+    }
+    aggregate_lock = 0;
+    return 0;
+}
+
+void vmp_aggregate_release(void)
+{
+    if (aggregate != NULL) {
+        munmap(aggregate, sizeof(struct aggregate_s));
+        aggregate = NULL;
+    }
+}
+
+static unsigned long hash_stack(void **stack, long depth, void *thread)
+{
+    unsigned long hash = (unsigned long)thread;
+    long i;
+    for (i = 0; i < depth; i++) {
+        hash = (hash ^ (unsigned long)stack[i]) * 16777619UL;
+    }
+    return hash ^ (hash >> 15) ^ (unsigned long)depth;
+}
+
+static unsigned long find_slot(struct aggregate_s *a, unsigned long hash,
+                               void **stack, long depth, void *thread)
+{
+    /* returns the slot of the entry for the stack trace, or the free slot
+       to insert it into */
+    unsigned long slot = hash & (AGGREGATE_SLOTS - 1);
+    while (a->slots[slot] != 0) {
+        struct aggregate_entry_s *e = &a->entries[a->slots[slot] - 1];
+        if (e->hash == hash && e->depth == depth && e->thread == thread &&
+            memcmp(&a->words[e->offset], stack, depth * sizeof(void *)) == 0) {
+            break;
+        }
+        slot = (slot + 1) & (AGGREGATE_SLOTS - 1);
+    }
+    return slot;
+}
+
+static int _flush(int fd)
+{
+    /* Writes the entries that got samples since the last flush as stack
+       trace records.  Must be called with the lock held.  Returns -1 if
+       no buffer was available, the entries not written yet keep their
+       counts then. */
+    struct aggregate_s *a = aggregate;
+    struct profbuf_s *p = NULL;
+    long i;
+    char *t;
+
+    a->samples = 0;
+    for (i = 0; i < a->entry_count; i++) {
+        struct aggregate_entry_s *e = &a->entries[i];
+        size_t size;
+        if (e->count == 0) {
+            continue;
+        }
+        size = 1 + 2 * sizeof(long) + (e->depth + 1) * sizeof(void *);
+        if (p != NULL && p->data_size + size > SINGLE_BUF_SIZE) {
+            commit_buffer(fd, p);
+            p = NULL;
+        }
+        if (p == NULL) {
+            p = reserve_buffer(fd);
+            if (p == NULL) {
+                return -1;
+            }
+        }
+        t = p->data + p->data_size;
+        *t++ = MARKER_STACKTRACE;
+        memcpy(t, &e->count, sizeof(long)); t += sizeof(long);
+        memcpy(t, &e->depth, sizeof(long)); t += sizeof(long);
+        memcpy(t, &a->words[e->offset], e->depth * sizeof(void *));
+        t += e->depth * sizeof(void *);
+        memcpy(t, &e->thread, sizeof(void *));
+        p->data_size += size;
+        e->count = 0;
+    }
+    if (p != NULL) {
+        commit_buffer(fd, p);
+    }
+    return 0;
+}
+
+int vmp_aggregate_sample(int fd, void **stack, long depth, void *thread)
+{
+    /* Adds a sample to the table.  Returns 0 if it was not added, the
+       caller must write the sample itself then. */
+    struct aggregate_s *a = aggregate;
+    struct aggregate_entry_s *e;
+    unsigned long hash, slot;
+    int added = 0;
+
+    if (a == NULL || depth > AGGREGATE_MAX_WORDS) {
+        return 0;
+    }
+    if (!__sync_bool_compare_and_swap(&aggregate_lock, 0, 1)) {
+        /* another thread is using the table, never wait for it */
+        return 0;
+    }
+    hash = hash_stack(stack, depth, thread);
+    slot = find_slot(a, hash, stack, depth, thread);
+    if (a->slots[slot] == 0 && (a->entry_count == AGGREGATE_MAX_ENTRIES ||
+                                a->word_count + depth > AGGREGATE_MAX_WORDS)) {
+        /* the table is full, start over once all entries are written */
+        if (_flush(fd) < 0) {
+            goto done;
+        }
+        memset(a->slots, 0, sizeof(a->slots));
+        a->entry_count = 0;
+        a->word_count = 0;
+        slot = find_slot(a, hash, stack, depth, thread);
+    }
+    if (a->slots[slot] == 0) {
+        e = &a->entries[a->entry_count];
+        e->hash = hash;
+        e->count = 0;
+        e->depth = depth;
+        e->offset = a->word_count;
+        e->thread = thread;
+        memcpy(&a->words[a->word_count], stack, depth * sizeof(void *));
+        a->word_count += depth;
+        a->slots[slot] = (unsigned int)++a->entry_count;
+    }
+    a->entries[a->slots[slot] - 1].count++;
+    added = 1;
+    if (++a->samples >= a->flush_every) {
+        (void)_flush(fd);
+    }
+
+ done:
+    __sync_lock_release(&aggregate_lock);
+    return added;
+}
+
+int vmp_aggregate_flush(int fd)
+{
+    /* no signal handler can be running concurrently here, because we
+       already did vmprof_ignore_signals(1) */
+    int result;
+    if (aggregate == NULL) {
+        return 0;
+    }
+    if (!__sync_bool_compare_and_swap(&aggregate_lock, 0, 1)) {
+        return -1;
+    }
+    result = _flush(fd);
+    __sync_lock_release(&aggregate_lock);
+    return result;
+}
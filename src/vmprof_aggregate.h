@@ -0,0 +1,24 @@
+#pragma once
+/* Aggregation of stack traces in the sampler */
+
+#include "vmprof.h"
+
+/* When aggregation is enabled, the signal handler does not write every
+   sample to the profile. It adds the captured stack trace to a table
+   that maps (stack trace, thread) to the number of samples, and the
+   entries of the table are written as regular stack trace records with
+   their count from time to time and when profiling is disabled.
+
+   The table lives in preallocated memory and is protected by a lock
+   that is only ever tried, never waited for: a signal handler that does
+   not get the lock, or that finds the table full, writes its sample
+   as usual.  Thus the profile is always complete, samples are only
+   written with a delay.
+*/
+#define AGGREGATE_MAX_ENTRIES  4096
+#define AGGREGATE_MAX_WORDS    (64 * 1024)
+
+int vmp_aggregate_prepare(long interval_usec);
+void vmp_aggregate_release(void);
+int vmp_aggregate_sample(int fd, void **stack, long depth, void *thread);
+int vmp_aggregate_flush(int fd);
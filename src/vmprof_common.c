@@ -27,6 +27,7 @@ int get_stack_trace(PY_THREAD_STATE_T * current, void** result, int max_depth, i
 static volatile int is_enabled = 0;
 static long prepare_interval_usec = 0;
 static long profile_interval_usec = 0;
+static int aggregate = 0;
 
 #ifdef VMPROF_UNIX
 static int signal_type = SIGPROF;
@@ -74,6 +75,14 @@ void vmprof_set_profile_interval_usec(long value) {
     profile_interval_usec = value;
 }
 
+int vmprof_get_aggregate(void) {
+    return aggregate;
+}
+
+void vmprof_set_aggregate(int value) {
+    aggregate = value;
+}
+
 char *vmprof_init(int fd, double interval, int memory,
                   int proflines, const char *interp_name, int native, int real_time)
 {
@@ -137,7 +146,8 @@ int opened_profile(const char *interp_name, int memory, int proflines, int nativ
     header.interp_name[1] = '\x00';
     header.interp_name[2] = VERSION_TIMESTAMP;
     header.interp_name[3] = memory*PROFILE_MEMORY + proflines*PROFILE_LINES + \
-                            native*PROFILE_NATIVE + real_time*PROFILE_REAL_TIME;
+                            native*PROFILE_NATIVE + real_time*PROFILE_REAL_TIME + \
+                            aggregate*PROFILE_AGGREGATE;
 #ifdef RPYTHON_VMPROF
     header.interp_name[3] += PROFILE_RPYTHON;
 #endif
@@ -108,6 +108,8 @@ long vmprof_get_prepare_interval_usec(void);
 long vmprof_get_profile_interval_usec(void);
 void vmprof_set_prepare_interval_usec(long value);
 void vmprof_set_profile_interval_usec(long value);
+int vmprof_get_aggregate(void);
+void vmprof_set_aggregate(int value);
 int vmprof_is_enabled(void);
 void vmprof_set_enabled(int value);
 int vmprof_get_itimer_type(void);
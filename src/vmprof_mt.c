@@ -2,6 +2,12 @@
 /* Support for multithreaded write() operations (implementation) */
 
 #include <assert.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <pthread.h>
+#include <signal.h>
+#include <sys/select.h>
+#include <sys/uio.h>
 
 #if defined(__i386__) || defined(__amd64__)
   static inline void write_fence(void) { asm("" : : : "memory"); }
@@ -9,26 +15,75 @@
   static inline void write_fence(void) { __sync_synchronize(); }
 #endif
 
-static char volatile profbuf_state[MAX_NUM_BUFFERS];
+/* the buffers and the arrays below are allocated together */
+static long profbuf_count = DEFAULT_NUM_BUFFERS;
+static size_t profbuf_mapped_size;
 static struct profbuf_s *profbuf_all_buffers = NULL;
+static char volatile *profbuf_state;
+/* incremented every time the content of a buffer is completely written */
+static unsigned long volatile *profbuf_generation;
 static int volatile profbuf_write_lock = 2;
 static long profbuf_pending_write;
+/* only changed by the holder of the write lock */
+static long volatile profbuf_bytes_written;
+
+/* In the writer thread mode commit_buffer() only publishes the buffer
+   in a ring, in the order of the commits, and the writer thread writes
+   them.  A position of the ring holds the index of a buffer + 1, or 0
+   while nothing is published there.  Only the holder of the write lock
+   takes buffers out of the ring, it keeps the ones that are not
+   written completely in profbuf_queue. */
+static long volatile *profbuf_ring;
+static unsigned long profbuf_ring_size;   /* a power of two > profbuf_count */
+static unsigned long volatile profbuf_ring_head;
+static unsigned long volatile profbuf_ring_tail;
+static long *profbuf_queue;
+static long profbuf_queue_length;
+static int profbuf_writer_running = 0;
+static int volatile profbuf_writer_stop;
+static pthread_t profbuf_writer;
+static int profbuf_writer_fd;
+static long profbuf_writer_latency_usec;
+/* a byte written to the pipe wakes the writer thread up early */
+static int profbuf_wakeup[2] = {-1, -1};
+
+
+/* the writev() calls of the writer thread write at most this many
+   buffers at once */
+#define IOV_BATCH  64
 
 
 static void unprepare_concurrent_bufs(void)
 {
     if (profbuf_all_buffers != NULL) {
-        munmap(profbuf_all_buffers, sizeof(struct profbuf_s) * MAX_NUM_BUFFERS);
+        munmap(profbuf_all_buffers, profbuf_mapped_size);
         profbuf_all_buffers = NULL;
     }
 }
 
+int set_concurrent_bufs_count(long count)
+{
+    /* The number of buffers prepare_concurrent_bufs() allocates. */
+    if (count < 1 || count > MAX_NUM_BUFFERS)
+        return -1;
+    profbuf_count = count;
+    return 0;
+}
+
 int prepare_concurrent_bufs(void)
 {
+    char *extra;
     assert(sizeof(struct profbuf_s) == 8192);
 
     unprepare_concurrent_bufs();
-    profbuf_all_buffers = mmap(NULL, sizeof(struct profbuf_s) * MAX_NUM_BUFFERS,
+    profbuf_ring_size = 2;
+    while (profbuf_ring_size <= (unsigned long)profbuf_count)
+        profbuf_ring_size *= 2;
+    profbuf_mapped_size = sizeof(struct profbuf_s) * profbuf_count +
+                          sizeof(unsigned long) * profbuf_count +
+                          sizeof(long) * (profbuf_ring_size + profbuf_count) +
+                          profbuf_count;
+    profbuf_all_buffers = mmap(NULL, profbuf_mapped_size,
                                PROT_READ | PROT_WRITE,
                                MAP_PRIVATE | MAP_ANONYMOUS,
                                -1, 0);
@@ -36,12 +91,30 @@ int prepare_concurrent_bufs(void)
         profbuf_all_buffers = NULL;
         return -1;
     }
-    memset((char *)profbuf_state, PROFBUF_UNUSED, sizeof(profbuf_state));
+    /* fresh anonymous memory is zeroed, i.e. all buffers are unused */
+    extra = (char *)(profbuf_all_buffers + profbuf_count);
+    profbuf_generation = (unsigned long volatile *)extra;
+    extra += sizeof(unsigned long) * profbuf_count;
+    profbuf_ring = (long volatile *)extra;
+    extra += sizeof(long) * profbuf_ring_size;
+    profbuf_queue = (long *)extra;
+    extra += sizeof(long) * profbuf_count;
+    profbuf_state = extra;
+    assert(PROFBUF_UNUSED == 0);
     profbuf_write_lock = 0;
     profbuf_pending_write = -1;
+    profbuf_writer_running = 0;
+    profbuf_bytes_written = 0;
     return 0;
 }
 
+static void _buffer_written(long i)
+{
+    profbuf_generation[i]++;
+    write_fence();
+    profbuf_state[i] = PROFBUF_UNUSED;
+}
+
 static int _write_single_ready_buffer(int fd, long i)
 {
     /* Try to write to disk the buffer number 'i'.  This function must
@@ -64,8 +137,10 @@ static int _write_single_ready_buffer(int fd, long i)
     int err;
     struct profbuf_s *p = &profbuf_all_buffers[i];
     ssize_t count = write(fd, p->data + p->data_offset, p->data_size);
+    if (count > 0)
+        profbuf_bytes_written += count;
     if (count == p->data_size) {
-        profbuf_state[i] = PROFBUF_UNUSED;
+        _buffer_written(i);
         profbuf_pending_write = -1;
     }
     else {
@@ -80,12 +155,60 @@ static int _write_single_ready_buffer(int fd, long i)
     return 0;
 }
 
+static int _write_queued_buffers(int fd)
+{
+    /* Writes the buffers published in the ring in order, with as few
+       writev() calls as possible.  This function must only be called
+       while we hold the write lock. */
+    struct iovec iov[IOV_BATCH];
+    long i, batch, value;
+    ssize_t count;
+
+    assert(profbuf_write_lock != 0);
+    while ((value = profbuf_ring[profbuf_ring_tail & (profbuf_ring_size - 1)]) != 0) {
+        profbuf_ring[profbuf_ring_tail & (profbuf_ring_size - 1)] = 0;
+        profbuf_ring_tail++;
+        profbuf_queue[profbuf_queue_length++] = value - 1;
+    }
+    while (profbuf_queue_length > 0) {
+        batch = profbuf_queue_length < IOV_BATCH ? profbuf_queue_length
+                                                 : IOV_BATCH;
+        for (i = 0; i < batch; i++) {
+            struct profbuf_s *p = &profbuf_all_buffers[profbuf_queue[i]];
+            iov[i].iov_base = p->data + p->data_offset;
+            iov[i].iov_len = p->data_size;
+        }
+        count = writev(fd, iov, (int)batch);
+        if (count < 0) {
+            if (errno == EINTR)
+                continue;
+            return -1;
+        }
+        profbuf_bytes_written += count;
+        for (i = 0; i < batch; i++) {
+            struct profbuf_s *p = &profbuf_all_buffers[profbuf_queue[i]];
+            if ((size_t)count < p->data_size) {
+                /* partially written, the rest is written first next time */
+                p->data_offset += count;
+                p->data_size -= count;
+                break;
+            }
+            count -= p->data_size;
+            _buffer_written(profbuf_queue[i]);
+        }
+        profbuf_queue_length -= i;
+        memmove(profbuf_queue, profbuf_queue + i,
+                profbuf_queue_length * sizeof(long));
+    }
+    return 0;
+}
+
 static void _write_ready_buffers(int fd)
 {
     long i;
     int has_write_lock = 0;
 
-    for (i = 0; i < MAX_NUM_BUFFERS; i++) {
+    for (i = 0; i < profbuf_count; i++) {
         if (profbuf_state[i] == PROFBUF_READY) {
             if (!has_write_lock) {
                 if (!__sync_bool_compare_and_swap(&profbuf_write_lock, 0, 1))
@@ -112,9 +235,10 @@ struct profbuf_s *reserve_buffer(int fd)
     */
     long i;
 
-    _write_ready_buffers(fd);
+    if (!profbuf_writer_running)
+        _write_ready_buffers(fd);
 
-    for (i = 0; i < MAX_NUM_BUFFERS; i++) {
+    for (i = 0; i < profbuf_count; i++) {
         if (profbuf_state[i] == PROFBUF_UNUSED &&
             __sync_bool_compare_and_swap(&profbuf_state[i], PROFBUF_UNUSED,
                                          PROFBUF_FILLING)) {
@@ -145,6 +269,18 @@ void commit_buffer(int fd, struct profbuf_s *buf)
     assert(profbuf_state[i] == PROFBUF_FILLING);
     profbuf_state[i] = PROFBUF_READY;
 
+    if (profbuf_writer_running) {
+        /* publish it for the writer thread, never call write() here */
+        unsigned long pos = __sync_fetch_and_add(&profbuf_ring_head, 1);
+        profbuf_ring[pos & (profbuf_ring_size - 1)] = i + 1;
+        if ((long)(pos - profbuf_ring_tail) >= profbuf_count / 2) {
+            /* half of the buffers are waiting, don't wait for the timeout */
+            char wakeup = 0;
+            (void)write(profbuf_wakeup[1], &wakeup, 1);
+        }
+        return;
+    }
+
     if (!__sync_bool_compare_and_swap(&profbuf_write_lock, 0, 1)) {
         /* can't acquire the write lock, ignore */
     }
@@ -154,6 +290,18 @@ void commit_buffer(int fd, struct profbuf_s *buf)
     }
 }
 
+unsigned long buffer_generation(struct profbuf_s *buf)
+{
+    /* The number of times 'buf' was written.  Once this changes, the
+       content 'buf' had is in the profile file. */
+    return profbuf_generation[buf - profbuf_all_buffers];
+}
+
+long buffer_bytes_written(void)
+{
+    return profbuf_bytes_written;
+}
+
 void cancel_buffer(struct profbuf_s *buf)
 {
     long i = buf - profbuf_all_buffers;
@@ -161,16 +309,131 @@ void cancel_buffer(struct profbuf_s *buf)
     profbuf_state[i] = PROFBUF_UNUSED;
 }
 
+int flush_concurrent_bufs(int fd)
+{
+    /* Writes the buffers committed so far.  Must not be called from a
+       signal handler, it waits for the write lock. */
+    int result = 0;
+    long i;
+
+    while (!__sync_bool_compare_and_swap(&profbuf_write_lock, 0, 1)) {
+        if (profbuf_write_lock == 2)
+            return 0;   /* shut down */
+        usleep(1);
+    }
+    if (profbuf_writer_running) {
+        result = _write_queued_buffers(fd);
+    }
+    else {
+        for (i = 0; i < profbuf_count && result == 0; i++) {
+            while (profbuf_state[i] == PROFBUF_READY && result == 0)
+                result = _write_single_ready_buffer(fd, i);
+        }
+    }
+    profbuf_write_lock = 0;
+    return result;
+}
+
+static void *_writer_thread_main(void *arg)
+{
+    char wakeup[64];
+    struct timeval timeout;
+    fd_set fds;
+    int stop;
+
+    do {
+        stop = profbuf_writer_stop;
+        if (!stop) {
+            FD_ZERO(&fds);
+            FD_SET(profbuf_wakeup[0], &fds);
+            timeout.tv_sec = profbuf_writer_latency_usec / 1000000;
+            timeout.tv_usec = profbuf_writer_latency_usec % 1000000;
+            if (select(profbuf_wakeup[0] + 1, &fds, NULL, NULL, &timeout) > 0) {
+                while (read(profbuf_wakeup[0], wakeup, sizeof(wakeup)) > 0) {
+                }
+            }
+            stop = profbuf_writer_stop;
+        }
+        (void)flush_concurrent_bufs(profbuf_writer_fd);
+    } while (!stop);
+    return NULL;
+}
+
+static void _close_wakeup_pipe(void)
+{
+    if (profbuf_wakeup[0] != -1) {
+        close(profbuf_wakeup[0]);
+        close(profbuf_wakeup[1]);
+        profbuf_wakeup[0] = profbuf_wakeup[1] = -1;
+    }
+}
+
+int start_writer_thread(int fd, long latency_usec)
+{
+    /* From now on the buffers are written by a thread that wakes up every
+       'latency_usec' microseconds, or earlier if half of the buffers are
+       waiting.  Call after prepare_concurrent_bufs(). */
+    sigset_t signals, saved;
+    int err;
+
+    assert(!profbuf_writer_running);
+    if (pipe(profbuf_wakeup) < 0)
+        return -1;
+    if (fcntl(profbuf_wakeup[0], F_SETFL, O_NONBLOCK) < 0 ||
+        fcntl(profbuf_wakeup[1], F_SETFL, O_NONBLOCK) < 0) {
+        _close_wakeup_pipe();
+        return -1;
+    }
+    memset((void *)profbuf_ring, 0, sizeof(long) * profbuf_ring_size);
+    profbuf_ring_head = profbuf_ring_tail = 0;
+    profbuf_queue_length = 0;
+    profbuf_writer_fd = fd;
+    profbuf_writer_latency_usec = latency_usec;
+    profbuf_writer_stop = 0;
+    profbuf_writer_running = 1;
+
+    /* the profiling signals must not interrupt the writer thread, it
+       inherits the blocked signals */
+    sigemptyset(&signals);
+    sigaddset(&signals, SIGPROF);
+    sigaddset(&signals, SIGALRM);
+    pthread_sigmask(SIG_BLOCK, &signals, &saved);
+    err = pthread_create(&profbuf_writer, NULL, _writer_thread_main, NULL);
+    pthread_sigmask(SIG_SETMASK, &saved, NULL);
+    if (err != 0) {
+        profbuf_writer_running = 0;
+        _close_wakeup_pipe();
+        errno = err;
+        return -1;
+    }
+    return 0;
+}
+
+static void stop_writer_thread(void)
+{
+    char wakeup = 0;
+    profbuf_writer_stop = 1;
+    (void)write(profbuf_wakeup[1], &wakeup, 1);
+    pthread_join(profbuf_writer, NULL);
+    /* buffers that could not be written stay ready, they are retried
+       below */
+    profbuf_writer_running = 0;
+    profbuf_queue_length = 0;
+    _close_wakeup_pipe();
+}
+
 int shutdown_concurrent_bufs(int fd)
 {
     /* no signal handler can be running concurrently here, because we
        already did vmprof_ignore_signals(1) */
+    if (profbuf_writer_running)
+        stop_writer_thread();
     assert(profbuf_write_lock == 0);
     profbuf_write_lock = 2;
 
     /* last attempt to flush buffers */
     int i;
-    for (i = 0; i < MAX_NUM_BUFFERS; i++) {
+    for (i = 0; i < profbuf_count; i++) {
         while (profbuf_state[i] == PROFBUF_READY) {
             if (_write_single_ready_buffer(fd, i) < 0)
                 return -1;
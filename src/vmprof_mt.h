@@ -6,7 +6,7 @@
 #include <string.h>
 #include <sys/mman.h>
 
-/* The idea is that we have MAX_NUM_BUFFERS available, all of size
+/* The idea is that we have NUM_BUFFERS available, all of size
    SINGLE_BUF_SIZE.  Threads and signal handlers can ask to reserve a
    buffer, fill it, and finally "commit" it, at which point its
    content is written into the profile file.  There is no hard
@@ -23,11 +23,14 @@
      code holding the lock could be running in the same thread,
      currently interrupted by the signal handler.
 
-   The value of MAX_NUM_BUFFERS is a trade-off between too high
-   (lots of unnecessary memory, lots of checking all of them)
-   and too low (risk that there is none left).
+   The number of buffers is a trade-off between too high (lots of
+   unnecessary memory, lots of checking all of them) and too low (risk
+   that there is none left, the sample is dropped then).  It can be set
+   with set_concurrent_bufs_count() before prepare_concurrent_bufs(),
+   all buffers are allocated up front.
 */
-#define MAX_NUM_BUFFERS  20
+#define DEFAULT_NUM_BUFFERS  20
+#define MAX_NUM_BUFFERS      4096
 
 #ifndef MAP_ANONYMOUS
 #define MAP_ANONYMOUS MAP_ANON
@@ -44,8 +47,13 @@ struct profbuf_s {
     char data[SINGLE_BUF_SIZE];
 };
 
+int set_concurrent_bufs_count(long count);
 int prepare_concurrent_bufs(void);
 struct profbuf_s *reserve_buffer(int fd);
 void commit_buffer(int fd, struct profbuf_s *buf);
 void cancel_buffer(struct profbuf_s *buf);
+unsigned long buffer_generation(struct profbuf_s *buf);
+long buffer_bytes_written(void);
+int flush_concurrent_bufs(int fd);
+int start_writer_thread(int fd, long latency_usec);
 int shutdown_concurrent_bufs(int fd);
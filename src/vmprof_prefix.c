@@ -0,0 +1,156 @@
+#include "vmprof_prefix.h"
+/* Stack traces that share their root most frames with a previous one
+   (implementation) */
+
+#include <string.h>
+#include <sys/mman.h>
+
+#include "vmprof_common.h"
+
+#ifndef MAP_ANONYMOUS
+#define MAP_ANONYMOUS MAP_ANON
+#endif
+
+/* the body of a record starts at this offset of the buffer, the marker
+   and the length are written in front of it once it is complete */
+#define BODY_OFFSET  8
+#define MAX_VARINT   10
+
+struct prefix_slot_s {
+    int volatile lock;
+    long depth;
+    long records;               /* since the last one without common frames */
+    struct profbuf_s *buffer;   /* of the last record, NULL if none */
+    unsigned long generation;   /* of 'buffer' when it was filled */
+    void *thread;
+    void *stack[MAX_STACK_DEPTH];
+};
+
+static struct prefix_slot_s *prefix_slots = NULL;
+
+int vmp_prefix_prepare(void)
+{
+    vmp_prefix_release();
+    prefix_slots = mmap(NULL, sizeof(struct prefix_slot_s) * PREFIX_SLOTS,
+                        PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS,
+                        -1, 0);
+    if (prefix_slots == MAP_FAILED) {
+        prefix_slots = NULL;
+        return -1;
+    }
+    return 0;
+}
+
+void vmp_prefix_release(void)
+{
+    if (prefix_slots != NULL) {
+        munmap(prefix_slots, sizeof(struct prefix_slot_s) * PREFIX_SLOTS);
+        prefix_slots = NULL;
+    }
+}
+
+static char *write_varint(char *t, uintptr_t value)
+{
+    while (value >= 0x80) {
+        *t++ = (char)(value | 0x80);
+        value >>= 7;
+    }
+    *t++ = (char)value;
+    return t;
+}
+
+static char *write_signed_varint(char *t, intptr_t value)
+{
+    return write_varint(t, ((uintptr_t)value << 1) ^
+                           (uintptr_t)(value >> (sizeof(intptr_t) * 8 - 1)));
+}
+
+int vmp_prefix_encode(struct profbuf_s *p)
+{
+    /* Rewrites the stack trace record in 'p' (see _vmprof_sample_stack)
+       as a MARKER_STACKTRACE_PREFIX record.  Returns 0 if the record is
+       left as it is. */
+    struct prof_stacktrace_s *st = (struct prof_stacktrace_s *)p->data;
+    struct prefix_slot_s *slot;
+    long count = st->count;
+    long depth = st->depth;
+    long words, common, fresh, i;
+    void *thread, *base_thread;
+    intptr_t memory = -1;
+    uintptr_t prev;
+    char *body, *t;
+    size_t length;
+
+    if (prefix_slots == NULL) {
+        return 0;
+    }
+    words = (p->data_size - (sizeof(struct prof_stacktrace_s) -
+                             offsetof(struct prof_stacktrace_s, marker)))
+            / sizeof(void *);
+    thread = st->stack[depth];
+    if (words > depth + 1) {
+        memory = (intptr_t)st->stack[depth + 1];
+    }
+
+    slot = &prefix_slots[((uintptr_t)thread >> 4) % PREFIX_SLOTS];
+    if (!__sync_bool_compare_and_swap(&slot->lock, 0, 1)) {
+        /* another thread with the same slot, never wait for it */
+        return 0;
+    }
+    if (slot->buffer != NULL &&
+            buffer_generation(slot->buffer) == slot->generation) {
+        /* the previous record of the slot is not written yet */
+        __sync_lock_release(&slot->lock);
+        return 0;
+    }
+    common = 0;
+    if (slot->records < PREFIX_KEYFRAME) {
+        while (common < depth && common < slot->depth &&
+               st->stack[depth - 1 - common] ==
+                   slot->stack[slot->depth - 1 - common]) {
+            common++;
+        }
+    }
+    fresh = depth - common;
+    if (BODY_OFFSET + (fresh + 6) * MAX_VARINT > (long)SINGLE_BUF_SIZE) {
+        __sync_lock_release(&slot->lock);
+        return 0;
+    }
+
+    /* the stack trace of the record is the new one of the slot, the
+       record is encoded from there */
+    memcpy(slot->stack, st->stack, depth * sizeof(void *));
+    slot->depth = depth;
+    base_thread = common > 0 ? slot->thread : NULL;
+    slot->thread = thread;
+    slot->records = common > 0 ? slot->records + 1 : 1;
+
+    body = t = p->data + BODY_OFFSET;
+    t = write_varint(t, (uintptr_t)count);
+    t = write_varint(t, (uintptr_t)(slot - prefix_slots));
+    t = write_varint(t, (uintptr_t)common);
+    t = write_varint(t, (uintptr_t)fresh);
+    prev = 0;
+    for (i = 0; i < fresh; i++) {
+        t = write_signed_varint(t, (intptr_t)((uintptr_t)slot->stack[i] - prev));
+        prev = (uintptr_t)slot->stack[i];
+    }
+    t = write_signed_varint(t, (intptr_t)((uintptr_t)thread -
+                                          (uintptr_t)base_thread));
+    if (memory >= 0) {
+        t = write_varint(t, (uintptr_t)memory);
+    }
+    length = t - body;
+
+    /* marker and length (at most two bytes) in front of the body */
+    t = body - 1 - (length >= 0x80);
+    p->data_offset = t - p->data - 1;
+    p->data[p->data_offset] = MARKER_STACKTRACE_PREFIX;
+    write_varint(t, length);
+    p->data_size = body + length - (p->data + p->data_offset);
+
+    slot->buffer = p;
+    slot->generation = buffer_generation(p);
+    __sync_lock_release(&slot->lock);
+    return 1;
+}
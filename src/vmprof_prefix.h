@@ -0,0 +1,35 @@
+#pragma once
+/* Stack traces that share their root most frames with a previous one */
+
+#include "vmprof.h"
+#include "vmprof_mt.h"
+
+/* Consecutive samples of a thread usually differ only in the frames
+   closest to the leaf.  A MARKER_STACKTRACE_PREFIX record stores a stack
+   trace as the 'common' root most frames of the previous stack trace in
+   a slot, followed by the frames that are new.  The slot of a record is
+   chosen by its thread.  All integers are varints, signed ones are zig
+   zag encoded:
+
+       char marker                  MARKER_STACKTRACE_PREFIX
+       varint length                of the rest of the record
+       varint count, slot, common, fresh
+       signed varint * fresh        each frame (leaf first) as the
+                                    difference to the frame before it,
+                                    the first one to 0
+       signed varint thread         difference to the thread of the slot
+       [varint memory]              if memory is profiled
+
+   The record becomes the stack trace of its slot.  A record with no
+   common frames does not depend on the slot, its thread is relative to
+   0.  A slot is only used if the previous record of the slot is already
+   written to the profile, thus a reader always finds the stack trace of
+   a slot before the record that refers to it.  Every PREFIX_KEYFRAME
+   records of a slot, one without common frames is written.
+*/
+#define PREFIX_SLOTS     64
+#define PREFIX_KEYFRAME  64
+
+int vmp_prefix_prepare(void);
+void vmp_prefix_release(void);
+int vmp_prefix_encode(struct profbuf_s *p);
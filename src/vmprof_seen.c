@@ -0,0 +1,111 @@
+#include "vmprof_seen.h"
+/* The set of code ids and native addresses found in the samples
+   (implementation) */
+
+#include <sys/mman.h>
+
+#ifndef MAP_ANONYMOUS
+#define MAP_ANONYMOUS MAP_ANON
+#endif
+
+static uintptr_t volatile *seen_table = NULL;
+static int seen_lines = 0;
+static int volatile seen_overflow = 0;
+
+int vmp_seen_prepare(int profile_lines)
+{
+    vmp_seen_release();
+    seen_table = mmap(NULL, sizeof(uintptr_t) * SEEN_SIZE,
+                      PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS,
+                      -1, 0);
+    if (seen_table == MAP_FAILED) {
+        seen_table = NULL;
+        return -1;
+    }
+    seen_lines = profile_lines;
+    seen_overflow = 0;
+    return 0;
+}
+
+void vmp_seen_release(void)
+{
+    if (seen_table != NULL) {
+        munmap((void *)seen_table, sizeof(uintptr_t) * SEEN_SIZE);
+        seen_table = NULL;
+    }
+}
+
+static void _seen_add(uintptr_t word)
+{
+    size_t index = (size_t)(((word >> 3) * 2654435761u) >> 4);
+    int i;
+    for (i = 0; i < SEEN_PROBES; i++) {
+        uintptr_t volatile *e = &seen_table[(index + i) & (SEEN_SIZE - 1)];
+        uintptr_t current = *e;
+        if (current == word) {
+            return;
+        }
+        if (current == 0) {
+            if (__sync_bool_compare_and_swap(e, 0, word)) {
+                return;
+            }
+            if (*e == word) {   /* another thread added it */
+                return;
+            }
+        }
+    }
+    seen_overflow = 1;
+}
+
+int vmp_seen_remove(uintptr_t word)
+{
+    /* Returns 1 if word was in the set.  The entry is not reused, words
+       are only added to free entries. */
+    size_t index = (size_t)(((word >> 3) * 2654435761u) >> 4);
+    int i;
+    if (seen_table == NULL) {
+        return 0;
+    }
+    for (i = 0; i < SEEN_PROBES; i++) {
+        uintptr_t volatile *e = &seen_table[(index + i) & (SEEN_SIZE - 1)];
+        if (*e == word) {
+            return __sync_bool_compare_and_swap(e, word, SEEN_REMOVED);
+        }
+        if (*e == 0) {
+            return 0;
+        }
+    }
+    return 0;
+}
+
+void vmp_seen_add(void **stack, long depth)
+{
+    /* Adds the native addresses of a stack trace, the code ids are
+       added by vmp_seen_add_code() */
+    long i;
+    if (seen_table == NULL) {
+        return;
+    }
+    /* in the line profiling mode the line number comes first */
+    for (i = seen_lines ? 1 : 0; i < depth; i += seen_lines ? 2 : 1) {
+        if ((uintptr_t)stack[i] & 1) {
+            _seen_add((uintptr_t)stack[i]);
+        }
+    }
+}
+
+void vmp_seen_add_code(uintptr_t code_id)
+{
+    if (seen_table == NULL) {
+        return;
+    }
+    _seen_add(SEEN_CODE(code_id));
+}
+
+const uintptr_t *vmp_seen_words(void)
+{
+    if (seen_overflow) {
+        return NULL;
+    }
+    return (const uintptr_t *)seen_table;
+}
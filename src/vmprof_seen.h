@@ -0,0 +1,41 @@
+#pragma once
+/* The set of code ids and native addresses found in the samples */
+
+#include "vmprof.h"
+
+/* vmprof.disable() writes the names of the native functions and of the
+   code objects that appear in the profile.  Instead of reading the whole
+   profile again to find them, the signal handler adds the native addresses
+   of a stack trace to this set, and the stack walker the ids of the code
+   objects of the frames it walks.  It is an open addressing table
+   allocated by vmp_seen_prepare(), words are added with a compare and
+   swap, so the signal handlers of several threads can add to it at the
+   same time.  With profile_lines every other word of a stack trace is a
+   line number, those are left out.  If a word finds no free entry, the set
+   is incomplete and vmp_seen_words() returns NULL, the profile has to be
+   read then.
+
+   Native addresses have the lowest bit set.  The id of a code object is
+   its address, which is aligned, and is stored as SEEN_CODE(id), so a word
+   of the set is only taken for a code object if the walker added it as
+   one.  A code object that is deallocated is removed with
+   vmp_seen_remove(SEEN_CODE(id)), so the code objects left in the set are
+   alive and can be emitted without looking for them (see
+   write_seen_code_objects in _vmprof.c).  One that is not in the set was
+   never sampled, its name is not written when it dies. */
+#define SEEN_SIZE    (1 << 18)   /* entries, a power of two */
+#define SEEN_PROBES  64
+#define SEEN_REMOVED (~(uintptr_t)0)
+#define SEEN_CODE_TAG  2
+#define SEEN_CODE(id)  ((uintptr_t)(id) | SEEN_CODE_TAG)
+#define SEEN_IS_CODE(word)  (((word) & 3) == SEEN_CODE_TAG)
+#define SEEN_CODE_ID(word)  ((word) & ~(uintptr_t)SEEN_CODE_TAG)
+
+int vmp_seen_prepare(int profile_lines);
+void vmp_seen_release(void);
+void vmp_seen_add(void **stack, long depth);
+void vmp_seen_add_code(uintptr_t code_id);
+int vmp_seen_remove(uintptr_t word);
+/* returns the table of SEEN_SIZE entries, the free ones are 0, the
+   removed ones SEEN_REMOVED */
+const uintptr_t *vmp_seen_words(void);
@@ -0,0 +1,317 @@
+#include "vmprof_thread_timers.h"
+/* One timer per thread (implementation) */
+
+#if VMPROF_LINUX
+
+#include <dirent.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <signal.h>
+#include <stdlib.h>
+#include <string.h>
+#include <syscall.h>
+#include <time.h>
+#include <unistd.h>
+#include <sys/ioctl.h>
+#include <linux/perf_event.h>
+
+#ifndef sigev_notify_thread_id
+#define sigev_notify_thread_id _sigev_un._tid
+#endif
+
+/* the CPU clock of any thread of the process, pthread_getcpuclockid()
+   builds it the same way from the thread id */
+#define THREAD_CPUCLOCK(tid)  ((~(clockid_t)(tid) << 3) | 6)
+
+struct thread_timer_s {
+    pid_t tid;          /* 0 if the slot is free */
+    timer_t timer;      /* THREAD_TIMER_POSIX */
+    int fd;             /* THREAD_TIMER_PERF */
+};
+
+static struct thread_timer_s thread_timers[MAX_THREAD_TIMERS];
+static long volatile thread_timer_count = 0;   /* slots used so far */
+static int volatile timers_running = 0;   /* the kind, 0 if stopped */
+static int timers_signal;
+static int perf_exclude_kernel;
+static int timers_real_time;
+static long volatile timers_interval_usec = 0;
+/* the signal handlers in vmp_thread_timers_arm() or _rearm(), see _free */
+static long volatile timers_users = 0;
+
+static int _arm(timer_t timer, long interval_usec)
+{
+    struct itimerspec spec;
+    spec.it_interval.tv_sec = interval_usec / 1000000;
+    spec.it_interval.tv_nsec = (interval_usec % 1000000) * 1000;
+    spec.it_value = spec.it_interval;
+    return timer_settime(timer, 0, &spec, NULL);
+}
+
+static int _perf_open(pid_t tid)
+{
+    /* Opens the (disabled) CPU clock event of a thread that sends the
+       signal to the thread itself when it overflows. */
+    struct perf_event_attr attr;
+    struct f_owner_ex owner;
+    int fd;
+
+    memset(&attr, 0, sizeof(attr));
+    attr.size = sizeof(attr);
+    attr.type = PERF_TYPE_SOFTWARE;
+    attr.config = PERF_COUNT_SW_CPU_CLOCK;
+    attr.sample_period = 1000000;   /* set by vmp_thread_timers_arm() */
+    attr.wakeup_events = 1;
+    attr.disabled = 1;
+    attr.exclude_hv = 1;
+    /* required with a perf_event_paranoid of 2 or more */
+    attr.exclude_kernel = perf_exclude_kernel;
+    fd = (int)syscall(SYS_perf_event_open, &attr, tid, -1, -1, 0);
+    if (fd < 0 && errno == EACCES && !perf_exclude_kernel) {
+        perf_exclude_kernel = attr.exclude_kernel = 1;
+        fd = (int)syscall(SYS_perf_event_open, &attr, tid, -1, -1, 0);
+    }
+    if (fd < 0) {
+        return -1;
+    }
+    owner.type = F_OWNER_TID;
+    owner.pid = tid;
+    if (fcntl(fd, F_SETFD, FD_CLOEXEC) < 0 ||
+        fcntl(fd, F_SETFL, O_ASYNC) < 0 ||
+        fcntl(fd, F_SETSIG, timers_signal) < 0 ||
+        fcntl(fd, F_SETOWN_EX, &owner) < 0) {
+        close(fd);
+        return -1;
+    }
+    return fd;
+}
+
+static int _perf_arm(int fd, long interval_usec)
+{
+    uint64_t period_ns = (uint64_t)interval_usec * 1000;
+    if (interval_usec == 0) {
+        return ioctl(fd, PERF_EVENT_IOC_DISABLE, 0);
+    }
+    if (ioctl(fd, PERF_EVENT_IOC_PERIOD, &period_ns) < 0) {
+        return -1;
+    }
+    /* enabled until it overflows once, see vmp_thread_timers_rearm */
+    return ioctl(fd, PERF_EVENT_IOC_REFRESH, 1);
+}
+
+static void _delete(struct thread_timer_s *t)
+{
+    if (timers_running == THREAD_TIMER_PERF) {
+        close(t->fd);
+    } else {
+        timer_delete(t->timer);
+    }
+}
+
+static void _free(struct thread_timer_s *t)
+{
+    /* Frees a slot and deletes its timer.  A signal handler that found
+       the slot used before may still arm the timer, it is deleted once
+       no handler uses the timers.  Its timer id or fd could belong to
+       another timer or file by then otherwise. */
+    t->tid = 0;
+    __sync_synchronize();
+    while (timers_users > 0) {
+        usleep(1);
+    }
+    _delete(t);
+}
+
+static void _sweep(void)
+{
+    /* Deletes the timers of the threads that exited.  A CLOCK_MONOTONIC
+       timer (real time mode) would keep sending signals otherwise.  The
+       thread is looked for in this process only, its id may belong to
+       another process by now. */
+    long i;
+    pid_t pid = getpid();
+    for (i = 0; i < thread_timer_count; i++) {
+        pid_t tid = thread_timers[i].tid;
+        if (tid != 0 && syscall(SYS_tgkill, pid, tid, 0) < 0 &&
+                errno == ESRCH) {
+            _free(&thread_timers[i]);
+        }
+    }
+}
+
+static long _free_slot(void)
+{
+    /* Returns a free slot, or -1 if there is none. */
+    long i;
+    for (i = 0; i < thread_timer_count; i++) {
+        if (thread_timers[i].tid == 0) {
+            return i;
+        }
+    }
+    if (thread_timer_count < MAX_THREAD_TIMERS) {
+        return thread_timer_count;
+    }
+    return -1;
+}
+
+static int _add(pid_t tid)
+{
+    struct sigevent event;
+    timer_t timer;
+    clockid_t clock;
+    long i, slot;
+    int fd = -1;
+
+    for (i = 0; i < thread_timer_count; i++) {
+        if (thread_timers[i].tid == tid) {
+            return 0;
+        }
+    }
+    slot = _free_slot();
+    if (slot < 0) {
+        errno = EAGAIN;
+        return -1;
+    }
+    if (timers_running == THREAD_TIMER_PERF) {
+        fd = _perf_open(tid);
+        if (fd < 0) {
+            return -1;
+        }
+        if (timers_interval_usec > 0 && _perf_arm(fd, timers_interval_usec) < 0) {
+            close(fd);
+            return -1;
+        }
+    }
+    else {
+        clock = timers_real_time ? CLOCK_MONOTONIC : THREAD_CPUCLOCK(tid);
+        memset(&event, 0, sizeof(event));
+        event.sigev_notify = SIGEV_THREAD_ID;
+        event.sigev_signo = timers_signal;
+        event.sigev_notify_thread_id = tid;
+        if (timer_create(clock, &event, &timer) < 0) {
+            return -1;
+        }
+        if (timers_interval_usec > 0 && _arm(timer, timers_interval_usec) < 0) {
+            timer_delete(timer);
+            return -1;
+        }
+        thread_timers[slot].timer = timer;
+    }
+    thread_timers[slot].fd = fd;
+    __sync_synchronize();
+    thread_timers[slot].tid = tid;
+    if (slot == thread_timer_count) {
+        thread_timer_count++;
+    }
+    return 0;
+}
+
+int vmp_thread_timer_add(pid_t tid)
+{
+    /* Creates the timer of the thread 'tid', armed with the current
+       interval.  Must not be called from a signal handler. */
+    if (!timers_running) {
+        return 0;
+    }
+    _sweep();
+    return _add(tid);
+}
+
+int vmp_thread_timers_start(int kind, int signal, int real_time)
+{
+    /* Creates the (disarmed) timers of all threads of the process. */
+    DIR *dir;
+    struct dirent *entry;
+
+    vmp_thread_timers_stop();
+    timers_signal = signal;
+    timers_real_time = real_time;
+    timers_interval_usec = 0;
+    perf_exclude_kernel = 0;
+    timers_running = kind;
+
+    dir = opendir("/proc/self/task");
+    if (dir == NULL) {
+        timers_running = 0;
+        return -1;
+    }
+    while ((entry = readdir(dir)) != NULL) {
+        pid_t tid = (pid_t)atol(entry->d_name);
+        if (tid <= 0) {
+            continue;
+        }
+        /* a thread that exits meanwhile has no clock anymore */
+        if (_add(tid) < 0 && errno != EINVAL &&
+                errno != ESRCH) {
+            int error = errno;
+            closedir(dir);
+            vmp_thread_timers_stop();
+            errno = error;
+            return -1;
+        }
+    }
+    closedir(dir);
+    return 0;
+}
+
+int vmp_thread_timers_arm(long interval_usec)
+{
+    /* Sets the interval of all timers, 0 disarms them.  This is
+       async-signal-safe, the adaptive period calls it. */
+    long i;
+    timers_interval_usec = interval_usec;
+    __sync_fetch_and_add(&timers_users, 1);
+    for (i = 0; i < thread_timer_count; i++) {
+        if (thread_timers[i].tid == 0) {
+            continue;
+        }
+        /* fails for the timers of threads that exited, ignore */
+        if (timers_running == THREAD_TIMER_PERF) {
+            (void)_perf_arm(thread_timers[i].fd, interval_usec);
+        } else {
+            (void)_arm(thread_timers[i].timer, interval_usec);
+        }
+    }
+    __sync_fetch_and_sub(&timers_users, 1);
+    return 0;
+}
+
+void vmp_thread_timers_stop(void)
+{
+    long i;
+    for (i = 0; i < thread_timer_count; i++) {
+        if (thread_timers[i].tid != 0) {
+            _free(&thread_timers[i]);
+        }
+    }
+    thread_timer_count = 0;
+    timers_running = 0;
+}
+
+void vmp_thread_timers_rearm(siginfo_t *info)
+{
+    /* Called first thing by the signal handler: a perf event disabled
+       itself when it sent the signal, enable it for the next sample.
+       The signal may have been sent before its fd was closed, so only
+       the fd of a used slot is touched. */
+    long i;
+    __sync_fetch_and_add(&timers_users, 1);
+    if (timers_running == THREAD_TIMER_PERF && timers_interval_usec > 0 &&
+            (info->si_code == POLL_HUP || info->si_code == POLL_IN)) {
+        for (i = 0; i < thread_timer_count; i++) {
+            if (thread_timers[i].tid != 0 &&
+                    thread_timers[i].fd == info->si_fd) {
+                (void)ioctl(info->si_fd, PERF_EVENT_IOC_REFRESH, 1);
+                break;
+            }
+        }
+    }
+    __sync_fetch_and_sub(&timers_users, 1);
+}
+
+int vmp_thread_timers_running(void)
+{
+    return timers_running;
+}
+
+#endif
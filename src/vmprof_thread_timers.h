@@ -0,0 +1,38 @@
+#pragma once
+/* One timer per thread instead of one process wide itimer (Linux) */
+
+#include "vmprof.h"
+
+#include <signal.h>
+#include <sys/types.h>
+
+/* Every thread gets a timer on its own CPU clock (or on CLOCK_MONOTONIC
+   in real time mode) that sends the profiling signal to just this thread
+   (SIGEV_THREAD_ID).  A busy thread is sampled at the full rate no matter
+   how many other threads there are, an idle one costs nothing, and the
+   real time mode does not need to forward the signal to every thread.
+
+   The timers are either POSIX timers (timer_create) or perf events
+   (perf_event_open with the software CPU clock).  A perf event sends
+   the signal through F_SETOWN_EX/F_SETSIG when it overflows and disables
+   itself, the signal handler calls vmp_thread_timers_rearm() to enable
+   it again.  Perf events need no special hardware, but they may be
+   forbidden by /proc/sys/kernel/perf_event_paranoid or a seccomp filter,
+   vmp_thread_timers_start() fails with EACCES, EPERM or ENOSYS then.
+
+   vmp_thread_timers_start() creates the timers of the threads that
+   already exist, vmp_thread_timer_add() the one of a thread started
+   later.  vmp_thread_timer_add() also deletes the timers of the threads
+   that exited and reuses their slots.
+*/
+#define MAX_THREAD_TIMERS  4096
+
+#define THREAD_TIMER_POSIX  1
+#define THREAD_TIMER_PERF   2
+
+int vmp_thread_timers_start(int kind, int signal, int real_time);
+int vmp_thread_timer_add(pid_t tid);
+int vmp_thread_timers_arm(long interval_usec);
+void vmp_thread_timers_stop(void);
+int vmp_thread_timers_running(void);
+void vmp_thread_timers_rearm(siginfo_t *info);
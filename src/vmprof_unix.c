@@ -24,6 +24,20 @@
 #include "vmprof_getpc.h"
 #include "vmprof_common.h"
 #include "vmprof_memory.h"
+#ifndef RPYTHON_VMPROF
+#include "vmprof_aggregate.h"
+#include "vmprof_prefix.h"
+#include "vmprof_seen.h"
+#if VMPROF_LINUX
+#define VMP_THREAD_TIMERS
+#include "vmprof_thread_timers.h"
+#endif
+#if VMPROF_LINUX && PY_VERSION_HEX >= 0x03070000
+/* the thread state is read without the spinlock, see
+   _get_pystate_lockfree() */
+#define VMP_LOCKFREE_PYSTATE
+#endif
+#endif
 #include "compat.h"
 
 
@@ -36,6 +50,12 @@ static char atfork_hook_installed = 0;
 static volatile int spinlock;
 static jmp_buf restore_point;
 static struct profbuf_s *volatile current_codes;
+/* updated by all signal handlers, written as meta data when the
+   profile is closed */
+static struct vmprof_sampler_stats_s volatile sampler_stats;
+static struct timespec sampler_start, sampler_stop;
+static int sampler_running = 0;
+static int per_thread_timers = 0;
 
 
 void vmprof_ignore_signals(int ignored)
@@ -86,6 +106,9 @@ void segfault_handler(int arg)
     longjmp(restore_point, SIGSEGV);
 }
 
+static int _get_stack_trace(PY_THREAD_STATE_T * current, void** result, int max_depth,
+                            intptr_t pc, ucontext_t * uc);
+
 int _vmprof_sample_stack(struct profbuf_s *p, PY_THREAD_STATE_T * tstate, ucontext_t * uc)
 {
     int depth;
@@ -95,7 +118,7 @@ int _vmprof_sample_stack(struct profbuf_s *p, PY_THREAD_STATE_T * tstate, uconte
 #ifdef RPYTHON_VMPROF
     depth = get_stack_trace(get_vmprof_stack(), st->stack, MAX_STACK_DEPTH-1, (intptr_t)GetPC(uc));
 #else
-    depth = get_stack_trace(tstate, st->stack, MAX_STACK_DEPTH-1, (intptr_t)NULL);
+    depth = _get_stack_trace(tstate, st->stack, MAX_STACK_DEPTH-1, (intptr_t)NULL, uc);
 #endif
     // useful for tests (see test_stop_sampling)
 #ifndef RPYTHON_LL2CTYPES
@@ -104,6 +127,9 @@ int _vmprof_sample_stack(struct profbuf_s *p, PY_THREAD_STATE_T * tstate, uconte
     }
 #endif
     st->depth = depth;
+#ifndef RPYTHON_VMPROF
+    vmp_seen_add(st->stack, depth);
+#endif
     st->stack[depth++] = tstate;
     long rss = get_current_proc_rss();
     if (rss >= 0)
@@ -115,6 +141,20 @@ int _vmprof_sample_stack(struct profbuf_s *p, PY_THREAD_STATE_T * tstate, uconte
     return 1;
 }
 
+static int _vmprof_aggregate_sample(int fd, struct profbuf_s *p)
+{
+    /* Returns 1 if the sample in p was added to the aggregation table,
+       the buffer is not needed anymore then */
+#ifndef RPYTHON_VMPROF
+    struct prof_stacktrace_s *st = (struct prof_stacktrace_s *)p->data;
+    if (vmprof_get_aggregate()) {
+        return vmp_aggregate_sample(fd, st->stack, st->depth,
+                                    st->stack[st->depth]);
+    }
+#endif
+    return 0;
+}
+
 #ifndef RPYTHON_VMPROF
 PY_THREAD_STATE_T * _get_pystate_for_this_thread(void) {
     // see issue 116 on github.com/vmprof/vmprof-python.
@@ -122,30 +162,54 @@ PY_THREAD_STATE_T * _get_pystate_for_this_thread(void) {
     //
     PyInterpreterState * istate;
     PyThreadState * state;
-    long mythread_id;
+    unsigned long mythread_id;
 
-    mythread_id = PyThread_get_thread_ident();
+    mythread_id = (unsigned long)PyThread_get_thread_ident();
     istate = PyInterpreterState_Head();
     if (istate == NULL) {
-        fprintf(stderr, "WARNING: interp state head is null (for thread id %ld)\n", mythread_id);
+        fprintf(stderr, "WARNING: interp state head is null (for thread id %lu)\n", mythread_id);
         return NULL;
     }
     // fish fish fish, it will NOT lock the keymutex in pythread
     do {
         state = PyInterpreterState_ThreadHead(istate);
         do {
-            if (state->thread_id == mythread_id) {
+            if ((unsigned long)state->thread_id == mythread_id) {
                 return state;
             }
         } while ((state = PyThreadState_Next(state)) != NULL);
     } while ((istate = PyInterpreterState_Next(istate)) != NULL);
 
     // uh? not found?
-    fprintf(stderr, "WARNING: cannot find thread state (for thread id %ld), sample will be thrown away\n", mythread_id);
+    fprintf(stderr, "WARNING: cannot find thread state (for thread id %lu), sample will be thrown away\n", mythread_id);
     return NULL;
 }
 #endif
 
+#ifdef VMP_LOCKFREE_PYSTATE
+static PyThreadState * _get_pystate_lockfree(void)
+{
+    /* Returns the thread state of this thread, or NULL if it must be
+       looked up by _get_pystate_for_this_thread().  The GIL state API
+       keeps it in a thread specific storage slot that is set when the
+       thread state is created and cleared when it is deleted, a per
+       thread cache that PyThread_tss_get() (pthread_getspecific) reads
+       in O(1) without a lock.  Unlike walking the thread states it
+       cannot fault on Linux, so neither the spinlock nor the SIGSEGV
+       guard is needed. */
+    PyThreadState * state;
+    if (vmprof_get_signal_type() == SIGALRM && !per_thread_timers &&
+            is_main_thread()) {
+        return NULL;   /* the signal is forwarded to the other threads */
+    }
+    state = PyGILState_GetThisThreadState();
+    if (state == NULL || state->thread_id != PyThread_get_thread_ident()) {
+        return NULL;   /* not the main interpreter's (or no) thread state */
+    }
+    return state;
+}
+#endif
+
 void flush_codes(void)
 {
     struct profbuf_s *p = current_codes;
@@ -161,6 +225,193 @@ void set_current_codes(void * to) {
 
 #endif
 
+/* the adaptive sampling period, see vmprof_set_max_overhead() */
+#define ADAPT_WINDOW      64      /* samples between two decisions */
+#define ADAPT_MAX_FACTOR  1000
+#define ADAPT_MAX_INTERVAL_USEC  1000000
+static double max_overhead = 0.0;
+static long period_factor = 1;
+static int volatile adapt_lock = 0;
+static long adapt_samples, adapt_handler_ns;   /* at the last decision */
+static struct timespec adapt_start;            /* of the current window */
+/* the interval the timer really achieved with factor 1, it can be
+   longer than the requested one if the timer is coarser than that */
+static long adapt_base_usec;
+
+static clockid_t _timer_clock(void)
+{
+    /* the clock the timer of the sampler runs on */
+    if (vmprof_get_itimer_type() == ITIMER_PROF) {
+        return CLOCK_PROCESS_CPUTIME_ID;
+    }
+    return CLOCK_MONOTONIC;
+}
+
+static long _ns_since_on(clockid_t clock, struct timespec *start)
+{
+    /* clock_gettime() is async-signal-safe */
+    struct timespec now;
+    clock_gettime(clock, &now);
+    return (now.tv_sec - start->tv_sec) * 1000000000L +
+           (now.tv_nsec - start->tv_nsec);
+}
+
+static long _ns_since(struct timespec *start)
+{
+    return _ns_since_on(CLOCK_MONOTONIC, start);
+}
+
+static void _add_ns(long volatile *total, struct timespec *start)
+{
+    __sync_fetch_and_add(total, _ns_since(start));
+}
+
+void vmprof_get_sampler_stats(struct vmprof_sampler_stats_s *stats)
+{
+    memcpy(stats, (void *)&sampler_stats, sizeof(*stats));
+    if (sampler_running) {
+        stats->elapsed_ns = _ns_since(&sampler_start);
+    } else {
+        stats->elapsed_ns = (sampler_stop.tv_sec - sampler_start.tv_sec) * 1000000000L +
+                            (sampler_stop.tv_nsec - sampler_start.tv_nsec);
+    }
+    stats->bytes_written = buffer_bytes_written();
+    vmp_unwind_cache_stats(&stats->unwind_hits, &stats->unwind_misses);
+    vmp_frame_pointer_stats(&stats->fp_walks, &stats->fp_fallbacks);
+    vmp_walk_cache_stats(&stats->walked_frames, &stats->cached_frames);
+}
+
+void vmprof_set_max_overhead(double value)
+{
+    max_overhead = value;
+}
+
+int vmprof_set_per_thread(int per_thread, int perf_events)
+{
+#ifdef VMP_THREAD_TIMERS
+    if (perf_events) {
+        per_thread_timers = THREAD_TIMER_PERF;
+    } else {
+        per_thread_timers = per_thread ? THREAD_TIMER_POSIX : 0;
+    }
+    return 0;
+#else
+    return (per_thread || perf_events) ? -1 : 0;
+#endif
+}
+
+const char *vmprof_get_sampling_backend(void)
+{
+#ifdef VMP_THREAD_TIMERS
+    if (per_thread_timers == THREAD_TIMER_PERF) {
+        return "perf_event";
+    }
+    if (per_thread_timers == THREAD_TIMER_POSIX) {
+        return "posix_timer";
+    }
+#endif
+    return "itimer";
+}
+
+int vmprof_register_thread(void)
+{
+#ifdef VMP_THREAD_TIMERS
+    return vmp_thread_timer_add((pid_t)syscall(SYS_gettid));
+#else
+    return 0;
+#endif
+}
+
+static int _write_period(int fd, long factor, long interval_usec)
+{
+    struct profbuf_s *p;
+    struct timespec now;
+    int64_t tv[2];
+    char *t;
+
+    p = reserve_buffer(fd);
+    if (p == NULL) {
+        return -1;
+    }
+    clock_gettime(CLOCK_REALTIME, &now);
+    tv[0] = now.tv_sec;
+    tv[1] = now.tv_nsec / 1000;
+    t = p->data;
+    *t++ = MARKER_PERIOD;
+    memcpy(t, &factor, sizeof(long)); t += sizeof(long);
+    memcpy(t, &interval_usec, sizeof(long)); t += sizeof(long);
+    memcpy(t, tv, sizeof(tv)); t += sizeof(tv);
+    p->data_size = t - p->data;
+    commit_buffer(fd, p);
+    return 0;
+}
+
+static void _adapt_period(int fd)
+{
+    /* Called by the signal handler after a sample.  Every ADAPT_WINDOW
+       samples the interval of the timer becomes the smallest multiple
+       of the one achieved at factor 1 that keeps the time spent in the
+       signal handler below max_overhead of the time the timer measures
+       (CPU time, or wall time in real time mode). */
+    long samples, handler_ns, window_ns, factor;
+    clockid_t clock = _timer_clock();
+
+    if (max_overhead <= 0.0 ||
+        !__sync_bool_compare_and_swap(&adapt_lock, 0, 1)) {
+        return;
+    }
+    samples = sampler_stats.samples - adapt_samples;
+    if (samples >= ADAPT_WINDOW) {
+        handler_ns = sampler_stats.handler_ns - adapt_handler_ns;
+        window_ns = _ns_since_on(clock, &adapt_start);
+        clock_gettime(clock, &adapt_start);
+        adapt_samples += samples;
+        adapt_handler_ns += handler_ns;
+        if (period_factor == 1) {
+            adapt_base_usec = window_ns / samples / 1000;
+            if (adapt_base_usec < vmprof_get_prepare_interval_usec()) {
+                adapt_base_usec = vmprof_get_prepare_interval_usec();
+            }
+        }
+        /* the overhead is inversely proportional to the factor */
+        factor = (long)(handler_ns * (double)period_factor /
+                        (max_overhead * (window_ns > 0 ? window_ns : 1))) + 1;
+        if (factor > ADAPT_MAX_FACTOR) {
+            factor = ADAPT_MAX_FACTOR;
+        }
+        if (factor > 1 && factor * adapt_base_usec > ADAPT_MAX_INTERVAL_USEC) {
+            factor = ADAPT_MAX_INTERVAL_USEC / adapt_base_usec;
+            if (factor < 1) {
+                factor = 1;
+            }
+        }
+        /* lengthen at once, shorten only if it halves the interval */
+        if (factor > period_factor || factor * 2 <= period_factor) {
+#ifndef RPYTHON_VMPROF
+            /* the aggregated samples were taken at the old interval */
+            if (vmprof_get_aggregate()) {
+                (void)vmp_aggregate_flush(fd);
+            }
+#endif
+            long interval_usec = vmprof_get_prepare_interval_usec();
+            if (factor > 1) {
+                interval_usec = adapt_base_usec * factor;
+                if (adapt_base_usec >= 2 * vmprof_get_prepare_interval_usec()) {
+                    /* the timer rounds up to its resolution, which is
+                       about adapt_base_usec then */
+                    interval_usec -= adapt_base_usec / 2;
+                }
+            }
+            if (_write_period(fd, factor, interval_usec) == 0) {
+                period_factor = factor;
+                vmprof_set_profile_interval_usec(interval_usec);
+                (void)install_sigprof_timer();
+            }
+        }
+    }
+    __sync_lock_release(&adapt_lock);
+}
+
 void vmprof_aquire_lock(void) {
     while (__sync_lock_test_and_set(&spinlock, 1)) {
     }
@@ -172,15 +423,27 @@ void vmprof_release_lock(void) {
 
 void sigprof_handler(int sig_nr, siginfo_t* info, void *ucontext)
 {
+    /* the interrupted code must not see the errno of the handler */
+    int saved_errno = errno;
     int commit;
     PY_THREAD_STATE_T * tstate = NULL;
     void (*prevhandler)(int);
+    struct timespec handler_start, start;
+    long handler_ns, max_ns;
+
+    clock_gettime(CLOCK_MONOTONIC, &handler_start);
+
+#ifdef VMP_THREAD_TIMERS
+    /* before anything else, the next sample must not depend on this one */
+    vmp_thread_timers_rearm(info);
+#endif
 
 #ifndef RPYTHON_VMPROF
 
     // Even though the docs say that this function call is for 'esoteric use'
     // it seems to be correctly set when the interpreter is teared down!
     if (!Py_IsInitialized()) {
+        errno = saved_errno;
         return;
     }
 
@@ -194,6 +457,13 @@ void sigprof_handler(int sig_nr, siginfo_t* info, void *ucontext)
     //
     // We do the same error detection for linux to ensure that
     // get_current_thread_state returns a sane result
+#ifdef VMP_LOCKFREE_PYSTATE
+    tstate = _get_pystate_lockfree();
+    if (tstate != NULL) {
+        __sync_fetch_and_add(&sampler_stats.pystate_lockfree, 1L);
+        goto found;
+    }
+#endif
     while (__sync_lock_test_and_set(&spinlock, 1)) {
     }
 
@@ -203,9 +473,11 @@ void sigprof_handler(int sig_nr, siginfo_t* info, void *ucontext)
     // because these timers are based on process and system time, and as such, are thread-aware.
     // For the real timer, the signal gets delivered to the main thread, seemingly always.
     // Consequently if we want to sample multiple threads, we need to forward this signal.
-    if (vmprof_get_signal_type() == SIGALRM) {
+    // (not needed if every thread has a timer of its own)
+    if (vmprof_get_signal_type() == SIGALRM && !per_thread_timers) {
         if (is_main_thread() && broadcast_signal_for_threads()) {
             __sync_lock_release(&spinlock);
+            errno = saved_errno;
             return;
         }
     }
@@ -219,29 +491,45 @@ void sigprof_handler(int sig_nr, siginfo_t* info, void *ucontext)
     } else {
         signal(SIGSEGV, prevhandler);
         __sync_lock_release(&spinlock);
+        errno = saved_errno;
         return;
     }
     signal(SIGSEGV, prevhandler);
     __sync_lock_release(&spinlock);
+#ifdef VMP_LOCKFREE_PYSTATE
+ found: ;
+#endif
 #endif
 
     long val = vmprof_enter_signal();
 
     if (val == 0) {
-        int saved_errno = errno;
         int fd = vmp_profile_fileno();
         assert(fd >= 0);
 
+#ifndef RPYTHON_VMPROF
+        /* everything so far was finding the thread state */
+        _add_ns(&sampler_stats.pystate_ns, &handler_start);
+#endif
         struct profbuf_s *p = reserve_buffer(fd);
         if (p == NULL) {
             /* ignore this signal: there are no free buffers right now */
+            __sync_fetch_and_add(&sampler_stats.dropped, 1L);
         } else {
+            clock_gettime(CLOCK_MONOTONIC, &start);
 #ifdef RPYTHON_VMPROF
             commit = _vmprof_sample_stack(p, NULL, (ucontext_t*)ucontext);
 #else
             commit = _vmprof_sample_stack(p, tstate, (ucontext_t*)ucontext);
 #endif
-            if (commit) {
+            _add_ns(&sampler_stats.walk_ns, &start);
+            clock_gettime(CLOCK_MONOTONIC, &start);
+            if (commit && _vmprof_aggregate_sample(fd, p)) {
+                cancel_buffer(p);
+            } else if (commit) {
+#ifndef RPYTHON_VMPROF
+                (void)vmp_prefix_encode(p);
+#endif
                 commit_buffer(fd, p);
             } else {
 #ifndef RPYTHON_VMPROF
@@ -249,14 +537,24 @@ void sigprof_handler(int sig_nr, siginfo_t* info, void *ucontext)
 #else
                 fprintf(stderr, "WARNING: canceled buffer, no stack trace was written\n");
 #endif
+                __sync_fetch_and_add(&sampler_stats.cancelled, 1L);
                 cancel_buffer(p);
             }
+            _add_ns(&sampler_stats.commit_ns, &start);
         }
 
-        errno = saved_errno;
+        __sync_fetch_and_add(&sampler_stats.samples, 1L);
+        handler_ns = _ns_since(&handler_start);
+        __sync_fetch_and_add(&sampler_stats.handler_ns, handler_ns);
+        while ((max_ns = sampler_stats.handler_max_ns) < handler_ns &&
+               !__sync_bool_compare_and_swap(&sampler_stats.handler_max_ns,
+                                             max_ns, handler_ns)) {
+        }
+        _adapt_period(fd);
     }
 
     vmprof_exit_signal();
+    errno = saved_errno;
 }
 
 int install_sigprof_handler(void)
@@ -288,8 +586,14 @@ int remove_sigprof_handler(void)
 int install_sigprof_timer(void)
 {
     static struct itimerval timer;
-    timer.it_interval.tv_sec = 0;
-    timer.it_interval.tv_usec = (int)vmprof_get_profile_interval_usec();
+    long interval_usec = vmprof_get_profile_interval_usec();
+#ifdef VMP_THREAD_TIMERS
+    if (per_thread_timers) {
+        return vmp_thread_timers_arm(interval_usec);
+    }
+#endif
+    timer.it_interval.tv_sec = interval_usec / 1000000;
+    timer.it_interval.tv_usec = interval_usec % 1000000;
     timer.it_value = timer.it_interval;
     if (setitimer(vmprof_get_itimer_type(), &timer, NULL) != 0)
         return -1;
@@ -299,6 +603,11 @@ int install_sigprof_timer(void)
 int remove_sigprof_timer(void)
 {
     static struct itimerval timer;
+#ifdef VMP_THREAD_TIMERS
+    if (per_thread_timers) {
+        return vmp_thread_timers_arm(0);
+    }
+#endif
     timerclear(&(timer.it_interval));
     timerclear(&(timer.it_value));
     if (setitimer(vmprof_get_itimer_type(), &timer, NULL) != 0) {
@@ -340,6 +649,9 @@ void init_cpyprof(int native)
         return;
     }
     vmp_native_enable();
+    if (vmp_native_use_frame_pointers(native == VMP_NATIVE_FRAME_POINTERS) < 0) {
+        fprintf(stderr, "WARNING: cannot walk the frame pointers here, using libunwind\n");
+    }
 }
 
 static void disable_cpyprof(void)
@@ -364,6 +676,25 @@ int vmprof_enable(int memory, int native, int real_time)
 #endif
     if (install_pthread_atfork_hooks() == -1)
         goto error;
+    memset((void *)&sampler_stats, 0, sizeof(sampler_stats));
+    clock_gettime(CLOCK_MONOTONIC, &sampler_start);
+    sampler_running = 1;
+    period_factor = 1;
+    adapt_samples = adapt_handler_ns = 0;
+    clock_gettime(_timer_clock(), &adapt_start);
+#ifdef VMP_THREAD_TIMERS
+    if (per_thread_timers &&
+            vmp_thread_timers_start(per_thread_timers, vmprof_get_signal_type(),
+                                    real_time) == -1) {
+        if (per_thread_timers != THREAD_TIMER_PERF ||
+                (errno != EACCES && errno != EPERM && errno != ENOSYS &&
+                 errno != ENOENT))
+            goto error;
+        /* perf events are forbidden (perf_event_paranoid, seccomp) or not
+           compiled into the kernel, fall back to the itimer */
+        per_thread_timers = 0;
+    }
+#endif
     if (install_sigprof_handler() == -1)
         goto error;
     if (install_sigprof_timer() == -1)
@@ -381,6 +712,36 @@ int vmprof_enable(int memory, int native, int real_time)
 int close_profile(void)
 {
     int fileno = vmp_profile_fileno();
+    struct vmprof_sampler_stats_s stats;
+    char value[32];
+    int i;
+
+    /* a summary of the sampler's own cost in front of the trailer */
+    vmprof_get_sampler_stats(&stats);
+    const struct { const char *key; long value; } summary[] = {
+        {"dropped_samples", stats.dropped},
+        {"cancelled_samples", stats.cancelled},
+        {"sampler_samples", stats.samples},
+        {"sampler_handler_ns", stats.handler_ns},
+        {"sampler_handler_max_ns", stats.handler_max_ns},
+        {"sampler_pystate_ns", stats.pystate_ns},
+        {"sampler_pystate_lockfree", stats.pystate_lockfree},
+        {"sampler_walk_ns", stats.walk_ns},
+        {"sampler_commit_ns", stats.commit_ns},
+        {"sampler_elapsed_ns", stats.elapsed_ns},
+        {"sampler_bytes_written", stats.bytes_written},
+        {"sampler_unwind_hits", stats.unwind_hits},
+        {"sampler_unwind_misses", stats.unwind_misses},
+        {"sampler_fp_walks", stats.fp_walks},
+        {"sampler_fp_fallbacks", stats.fp_fallbacks},
+        {"sampler_walked_frames", stats.walked_frames},
+        {"sampler_cached_frames", stats.cached_frames},
+    };
+    for (i = 0; i < (int)(sizeof(summary) / sizeof(summary[0])); i++) {
+        snprintf(value, sizeof(value), "%ld", summary[i].value);
+        (void)vmp_write_meta(summary[i].key, value);
+    }
+    (void)vmp_write_meta("sampling_backend", vmprof_get_sampling_backend());
     fsync(fileno);
     (void)vmp_write_time_now(MARKER_TRAILER);
     teardown_rss();
@@ -393,6 +754,10 @@ int close_profile(void)
 int vmprof_disable(void)
 {
     signal_handler_ignore = 1;
+    if (sampler_running) {
+        clock_gettime(CLOCK_MONOTONIC, &sampler_stop);
+        sampler_running = 0;
+    }
     vmprof_set_profile_interval_usec(0);
 #ifdef VMP_SUPPORTS_NATIVE_PROFILING
     disable_cpyprof();
@@ -401,6 +766,9 @@ int vmprof_disable(void)
     if (remove_sigprof_timer() == -1) {
         return -1;
     }
+#ifdef VMP_THREAD_TIMERS
+    vmp_thread_timers_stop();
+#endif
     if (remove_sigprof_handler() == -1) {
         return -1;
     }
@@ -410,6 +778,15 @@ int vmprof_disable(void)
     }
 #endif
     flush_codes();
+#ifndef RPYTHON_VMPROF
+    if (vmprof_get_aggregate()) {
+        if (vmp_aggregate_flush(vmp_profile_fileno()) < 0)
+            return -1;
+        vmp_aggregate_release();
+        vmprof_set_aggregate(0);
+    }
+    vmp_prefix_release();
+#endif
     if (shutdown_concurrent_bufs(vmp_profile_fileno()) < 0)
         return -1;
     return close_profile();
@@ -475,6 +852,13 @@ int vmprof_register_virtual_function(char *code_name, intptr_t code_uid,
 
 int get_stack_trace(PY_THREAD_STATE_T * current, void** result, int max_depth, intptr_t pc)
 {
+    return _get_stack_trace(current, result, max_depth, pc, NULL);
+}
+
+static int _get_stack_trace(PY_THREAD_STATE_T * current, void** result, int max_depth,
+                            intptr_t pc, ucontext_t * uc)
+{
+    /* uc is the context of the code the signal interrupted, or NULL */
     PY_STACK_FRAME_T * frame;
 #ifdef RPYTHON_VMPROF
     // do nothing here,
@@ -490,5 +874,10 @@ int get_stack_trace(PY_THREAD_STATE_T * current, void** result, int max_depth, i
         fprintf(stderr, "WARNING: get_stack_trace, frame is NULL\n");
         return 0;
     }
+#ifndef RPYTHON_VMPROF
+    if (uc != NULL) {
+        return vmp_walk_and_record_stack_uc(frame, result, max_depth, uc);
+    }
+#endif
     return vmp_walk_and_record_stack(frame, result, max_depth, 1, pc);
 }
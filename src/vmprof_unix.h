@@ -76,6 +76,55 @@ static void disable_cpyprof(void);
 
 int close_profile(void);
 
+/* counters of the sampler itself, times are in nanoseconds */
+struct vmprof_sampler_stats_s {
+    long samples;           /* signals that took a sample */
+    long dropped;           /* no free buffer */
+    long cancelled;         /* no stack trace could be written */
+    long handler_ns;        /* total time in sigprof_handler */
+    long handler_max_ns;
+    long pystate_ns;        /* finding the thread state */
+    long pystate_lockfree;  /* thread states found without the spinlock */
+    long walk_ns;           /* walking the stack */
+    long commit_ns;         /* committing (or aggregating) the buffer */
+    long elapsed_ns;        /* since the profiling started */
+    long bytes_written;     /* to the profile by the buffers */
+    long unwind_hits;       /* native frames found in the unwind cache */
+    long unwind_misses;
+    long fp_walks;          /* native stacks walked with frame pointers */
+    long fp_fallbacks;      /* of them walked with libunwind after all */
+    long walked_frames;     /* Python frames walked with the walk cache */
+    long cached_frames;     /* Python frames copied from it */
+};
+
+void vmprof_get_sampler_stats(struct vmprof_sampler_stats_s *stats);
+
+/* With an overhead budget the sampler lengthens the interval of the timer
+   to a multiple of the requested one when the signal handler takes more
+   than max_overhead of it, and shortens it again when it gets cheaper.
+   Every change is written as a MARKER_PERIOD record:
+
+       char marker                  MARKER_PERIOD
+       long factor                  the samples after it stand for
+                                    'factor' samples each
+       long interval_usec           the new interval of the timer
+       int64 tv_sec, tv_usec        when the interval changed
+
+   0 disables it. */
+void vmprof_set_max_overhead(double max_overhead);
+
+/* Samples with a timer per thread instead of one for the process (only
+   on Linux, returns -1 elsewhere), see vmprof_thread_timers.h.  With
+   perf_events the timers are perf events on the CPU clock of the thread,
+   vmprof_enable() falls back to the itimer if they are not allowed.
+   Threads started after vmprof_enable() call vmprof_register_thread().
+   vmprof_get_sampling_backend() returns what sends the signal,
+   "itimer", "posix_timer" or "perf_event", it is also written to the
+   meta data of the profile as "sampling_backend". */
+int vmprof_set_per_thread(int per_thread, int perf_events);
+const char *vmprof_get_sampling_backend(void);
+int vmprof_register_thread(void);
+
 RPY_EXTERN
 int vmprof_enable(int memory, int native, int real_time);
 RPY_EXTERN
@@ -1,5 +1,6 @@
 import os
 import sys
+import threading
 try:
     from shutil import which
 except ImportError:
@@ -10,9 +11,10 @@ import _vmprof
 from vmprof import cli
 
 from vmprof.reader import (MARKER_NATIVE_SYMBOLS, FdWrapper,
-        LogReaderState, LogReaderDumpNative)
-from vmprof.stats import Stats
-from vmprof.profiler import Profiler, read_profile
+        LogReaderState, LogReaderDumpNative, write_native_symbols,
+        write_memory_maps)
+from vmprof.stats import Stats, add_sampler_averages
+from vmprof.profiler import Profiler, read_profile, iter_samples
 
 
 PY3  = sys.version_info[0] >= 3
@@ -25,8 +27,36 @@ IS_PYPY = '__pypy__' in sys.builtin_module_names
 # To avoid the problem, we use a period which is "almost" but not exactly
 # 1000Hz
 DEFAULT_PERIOD = 0.00099
+# the sample buffers of the sampler, see src/vmprof_mt.h
+DEFAULT_NUM_BUFFERS = 20
+# the value of native for native='fp', see src/vmp_stack.h
+NATIVE_FRAME_POINTERS = 2
+
+# the threading profile hook that was set before enable(per_thread=True)
+# (or perf_events=True)
+# replaced it, see _register_new_thread
+_saved_profile_hook = None
+_per_thread = False
+# False if enable(symbolize=False) was called, disable() writes the memory
+# maps of the process then, see vmprof.symbolize
+_symbolize = True
+
+def _register_new_thread(frame, event, arg):
+    """ Set as the threading profile hook while per thread timers are used,
+        creates the timer of a thread when it starts.
+    """
+    sys.setprofile(_saved_profile_hook)
+    _vmprof.register_thread()
+
+def _stop_per_thread():
+    global _per_thread
+    if _per_thread:
+        threading.setprofile(_saved_profile_hook)
+        _per_thread = False
 
 def disable():
+    global _symbolize
+    _stop_per_thread()
     try:
         # fish the file descriptor that is still open!
         if hasattr(_vmprof, 'stop_sampling'):
@@ -34,10 +64,28 @@ def disable():
             if fileno >= 0:
                 # TODO does fileobj leak the fd? I dont think so, but need to check 
                 fileobj = FdWrapper(fileno)
-                l = LogReaderDumpNative(fileobj, LogReaderState())
-                l.read_all()
-                if hasattr(_vmprof, 'write_all_code_objects'):
-                    _vmprof.write_all_code_objects(l.dedup)
+                seen = None
+                if hasattr(_vmprof, 'seen_addresses'):
+                    # collected by the signal handler while sampling
+                    seen = _vmprof.seen_addresses()
+                if seen is None:
+                    l = LogReaderDumpNative(fileobj, LogReaderState())
+                    l.symbolize = _symbolize
+                    l.read_all()
+                    if hasattr(_vmprof, 'write_all_code_objects'):
+                        _vmprof.write_all_code_objects(l.dedup)
+                else:
+                    if _symbolize:
+                        # native addresses have the lowest bit set
+                        write_native_symbols(fileobj, [addr for addr in seen if addr & 1])
+                    # the code objects are found by their ids, no need
+                    # to look through all objects
+                    _vmprof.write_seen_code_objects()
+                if not _symbolize:
+                    # the native functions are resolved later
+                    from vmprof.symbolize import read_memory_maps
+                    write_memory_maps(fileobj, read_memory_maps())
+        _symbolize = True
         _vmprof.disable()
     except IOError as e:
         raise Exception("Error while writing profile: " + str(e))
@@ -53,7 +101,11 @@ def _is_native_enabled(native):
     return native
 
 if IS_PYPY:
-    def enable(fileno, period=DEFAULT_PERIOD, memory=False, lines=False, native=None, real_time=False, warn=True):
+    def enable(fileno, period=DEFAULT_PERIOD, memory=False, lines=False, native=None, real_time=False, warn=True, aggregate=False, compact_stacks=False,
+               writer_thread=False, writer_latency=0.01,
+               num_buffers=DEFAULT_NUM_BUFFERS, max_overhead=0.0,
+               per_thread=False, perf_events=False, cache_stacks=False,
+               symbolize=True):
         pypy_version_info = sys.pypy_version_info[:3]
         MAJOR = pypy_version_info[0]
         MINOR = pypy_version_info[1]
@@ -62,6 +114,26 @@ if IS_PYPY:
             raise ValueError("You need to pass a float as an argument")
         if warn and pypy_version_info < (4, 1, 0):
             raise Exception("PyPy <4.1 have various kinds of bugs, pass warn=False if you know what you're doing")
+        if aggregate:
+            raise ValueError('aggregate=True is not supported on PyPy')
+        if compact_stacks:
+            raise ValueError('compact_stacks=True is not supported on PyPy')
+        if writer_thread:
+            raise ValueError('writer_thread=True is not supported on PyPy')
+        if num_buffers != DEFAULT_NUM_BUFFERS:
+            raise ValueError('num_buffers is not supported on PyPy')
+        if max_overhead:
+            raise ValueError('max_overhead is not supported on PyPy')
+        if per_thread:
+            raise ValueError('per_thread=True is not supported on PyPy')
+        if perf_events:
+            raise ValueError('perf_events=True is not supported on PyPy')
+        if native == 'fp':
+            raise ValueError("native='fp' is not supported on PyPy")
+        if cache_stacks:
+            raise ValueError('cache_stacks=True is not supported on PyPy')
+        if not symbolize:
+            raise ValueError('symbolize=False is not supported on PyPy')
         if warn and memory and pypy_version_info <= (7, 1, 0):
             print("Memory profiling is currently unsupported for PyPy. Running without memory statistics.")
             memory = False
@@ -80,11 +152,42 @@ if IS_PYPY:
         _vmprof.enable(fileno, period)
 else:
     # CPYTHON
-    def enable(fileno, period=DEFAULT_PERIOD, memory=False, lines=False, native=None, real_time=False):
+    def enable(fileno, period=DEFAULT_PERIOD, memory=False, lines=False, native=None, real_time=False, aggregate=False,
+               compact_stacks=False, writer_thread=False, writer_latency=0.01,
+               num_buffers=DEFAULT_NUM_BUFFERS, max_overhead=0.0,
+               per_thread=False, perf_events=False, cache_stacks=False,
+               symbolize=True):
+        global _saved_profile_hook, _per_thread, _symbolize
         if not isinstance(period, float):
             raise ValueError("You need to pass a float as an argument")
+        if not symbolize and not sys.platform.startswith('linux'):
+            raise ValueError("symbolize=False is only supported on Linux")
         native = _is_native_enabled(native)
-        _vmprof.enable(fileno, period, memory, lines, native, real_time)
+        if native == 'fp':
+            # walk the native stack along the frame pointers
+            native = NATIVE_FRAME_POINTERS
+        _vmprof.enable(fileno, period, memory, lines, native, real_time,
+                       aggregate=aggregate, compact_stacks=compact_stacks,
+                       writer_thread=writer_thread,
+                       writer_latency=writer_latency,
+                       num_buffers=num_buffers, max_overhead=max_overhead,
+                       per_thread=per_thread, perf_events=perf_events,
+                       cache_stacks=cache_stacks)
+        _symbolize = symbolize
+        if per_thread or perf_events:
+            # the threads that exist already have their timers
+            _saved_profile_hook = getattr(threading, '_profile_hook', None)
+            _per_thread = True
+            threading.setprofile(_register_new_thread)
+
+    def register_thread():
+        """ Creates the timer of the calling thread with per_thread=True
+            or perf_events=True.
+            Threads started with the threading module after enable() and
+            all threads that existed before get one automatically, only
+            threads started differently need to call this.
+        """
+        _vmprof.register_thread()
 
     def sample_stack_now(skip=0):
         """ Helper utility mostly for tests, this is considered
@@ -103,6 +206,31 @@ else:
         """
         return _vmprof.resolve_addr(addr)
 
+    def sampler_stats():
+        """ Returns a dict with the counters of the sampler itself, of the
+            running or the last profile: samples, dropped_samples,
+            cancelled_samples, bytes_written and the time in nanoseconds
+            spent in the signal handler (handler_ns, handler_max_ns),
+            finding the thread state (pystate_ns, pystate_lockfree of
+            them were found without a lock), walking the stack
+            (walk_ns) and committing the sample (commit_ns). elapsed_ns
+            is the time since profiling started, overhead the fraction of
+            it spent in the signal handler. In native mode unwind_hits and
+            unwind_misses count the native frames found (or not) in the
+            cache of procedure starts, unwind_hit_rate is the fraction of
+            hits. With native='fp' fp_walks counts the stacks walked
+            along the frame pointers, fp_fallbacks those of them that
+            were walked with libunwind after all. With cache_stacks=True
+            walked_frames counts the Python frames walked and
+            cached_frames those copied from the cache of the previous
+            stack trace of the thread. backend is what sends
+            the signal: 'itimer', 'posix_timer' (per_thread=True) or
+            'perf_event' (perf_events=True).
+        """
+        if os.name == 'nt':
+            raise NotImplementedError("sampler stats are only supported on Linux & Mac OS X")
+        return add_sampler_averages(_vmprof.get_stats())
+
 def insert_real_time_thread():
     """ Inserts a thread into the list of threads to be sampled in real time mode.
         When enabling real time mode, the caller thread is inserted automatically.
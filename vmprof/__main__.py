@@ -3,6 +3,7 @@ import platform
 import sys, os
 import tempfile
 import vmprof
+import vmprof.symbolize
 from vmshare.service import Service
 try:
     import _jitlog
@@ -28,6 +29,10 @@ def show_stats(filename, output_mode, args):
                        'VM': platform.python_implementation() })
 
 def main():
+    if sys.argv[1:2] == ['symbolize']:
+        # resolves the native functions of a profile, see vmprof.symbolize
+        vmprof.symbolize.main(sys.argv[2:])
+        return
     args = vmprof.cli.parse_args(sys.argv[1:])
 
     # None means default on this platform
@@ -49,8 +54,11 @@ def main():
         prof_name = prof_file.name
 
 
+    kwargs = {}
+    if args.symbolize_later:
+        kwargs['symbolize'] = False
     vmprof.enable(prof_file.fileno(), args.period, args.mem,
-                  args.lines, native=native)
+                  args.lines, native=native, **kwargs)
     if args.jitlog and _jitlog:
         fd = os.open(prof_name + '.jit', os.O_WRONLY | os.O_TRUNC | os.O_CREAT)
         _jitlog.enable(fd)
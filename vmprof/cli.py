@@ -64,6 +64,12 @@ def build_argparser():
         action='store_true',
         help='Disable native profiling for this run'
     )
+    parser.add_argument(
+        '--symbolize-later',
+        action='store_true',
+        help='Store the memory maps instead of the names of native functions, '
+             'see "vmprof symbolize"'
+    )
     output_mode_args = parser.add_mutually_exclusive_group()
     output_mode_args.add_argument(
         '--web',
@@ -1,8 +1,10 @@
 import vmprof
 import tempfile
 
-from vmprof.stats import Stats
-from vmprof.reader import _read_prof
+from vmprof.stats import Stats, StatsBuilder
+from vmprof.reader import (_read_prof, _iter_prof, _read_prof_parallel,
+        LogReaderState)
+from vmprof.statscache import read_profile_state
 
 
 class VMProfError(Exception):
@@ -11,7 +13,11 @@ class VMProfError(Exception):
 class ProfilerContext(object):
     done = False
 
-    def __init__(self, name, period, memory, native, real_time):
+    def __init__(self, name, period, memory, native, real_time,
+                 aggregate=False, compact_stacks=False, writer_thread=False,
+                 writer_latency=0.01, num_buffers=None,
+                 max_overhead=0.0, per_thread=False, perf_events=False,
+                 cache_stacks=False, symbolize=True):
         if name is None:
             self.tmpfile = tempfile.NamedTemporaryFile("w+b", delete=False)
         else:
@@ -21,10 +27,33 @@ class ProfilerContext(object):
         self.memory = memory
         self.native = native
         self.real_time = real_time
+        self.aggregate = aggregate
+        self.compact_stacks = compact_stacks
+        self.writer_thread = writer_thread
+        self.writer_latency = writer_latency
+        if num_buffers is None:
+            # not a default, vmprof imports this module before defining it
+            num_buffers = vmprof.DEFAULT_NUM_BUFFERS
+        self.num_buffers = num_buffers
+        self.max_overhead = max_overhead
+        self.per_thread = per_thread
+        self.perf_events = perf_events
+        self.cache_stacks = cache_stacks
+        self.symbolize = symbolize
 
     def __enter__(self):
         vmprof.enable(self.tmpfile.fileno(), self.period, self.memory,
-                      native=self.native, real_time=self.real_time)
+                      native=self.native, real_time=self.real_time,
+                      aggregate=self.aggregate,
+                      compact_stacks=self.compact_stacks,
+                      writer_thread=self.writer_thread,
+                      writer_latency=self.writer_latency,
+                      num_buffers=self.num_buffers,
+                      max_overhead=self.max_overhead,
+                      per_thread=self.per_thread,
+                      perf_events=self.perf_events,
+                      cache_stacks=self.cache_stacks,
+                      symbolize=self.symbolize)
 
     def __exit__(self, type, value, traceback):
         vmprof.disable()
@@ -32,15 +61,54 @@ class ProfilerContext(object):
         self.done = True
 
 
-def read_profile(prof_file):
+def iter_samples(prof_file, state=None):
+    """ Yields the samples of a profile one at a time as tuples of
+        (trace, count, thread_id, mem_in_kb), without loading all of
+        them into memory. The symbols and the meta data of the profile
+        are read into state (a LogReaderState) before the first sample
+        is yielded.
+    """
+    if state is None:
+        state = LogReaderState()
     file_to_close = None
     if not hasattr(prof_file, 'read'):
         prof_file = file_to_close = open(str(prof_file), 'rb')
-
-    state = _read_prof(prof_file)
-
-    if file_to_close:
-        file_to_close.close()
+    try:
+        for sample in _iter_prof(prof_file, state):
+            yield sample
+    finally:
+        if file_to_close:
+            file_to_close.close()
+
+
+def read_profile(prof_file, streaming=False, cache=None, workers=1):
+    """ Reads a profile and returns its Stats. prof_file is a file object
+        or the path of a profile. For paths the cache next to the profile
+        is used if it is valid, see vmprof.statscache. cache=True always
+        writes a cache, cache=False neither reads nor writes it, None
+        only writes one for large profiles. workers > 1 decodes the
+        profile at a path with that many processes.
+    """
+    if streaming:
+        # identical samples are merged while reading, see StatsBuilder
+        state = LogReaderState()
+        builder = StatsBuilder()
+        for trace, count, thread_id, mem_in_kb in iter_samples(prof_file, state):
+            builder.add_sample(trace, count, thread_id, mem_in_kb)
+        return builder.build(state)
+
+    if hasattr(prof_file, 'read'):
+        state = _read_prof(prof_file)
+    elif cache is False:
+        state = None
+        if workers > 1:
+            state = _read_prof_parallel(str(prof_file), workers)
+        if state is None:
+            with open(str(prof_file), 'rb') as fileobj:
+                state = _read_prof(fileobj)
+    else:
+        state = read_profile_state(str(prof_file), write=cache,
+                                   workers=workers)
 
     jit_frames = {}
     d = dict(state.virtual_ips)
@@ -56,8 +124,16 @@ class Profiler(object):
     def __init__(self):
         self._lib_cache = {}
 
-    def measure(self, name=None, period=0.001, memory=False, native=False, real_time=False):
-        self.ctx = ProfilerContext(name, period, memory, native, real_time)
+    def measure(self, name=None, period=0.001, memory=False, native=False, real_time=False,
+                aggregate=False, compact_stacks=False, writer_thread=False,
+                writer_latency=0.01, num_buffers=None,
+                max_overhead=0.0, per_thread=False, perf_events=False,
+                cache_stacks=False, symbolize=True):
+        self.ctx = ProfilerContext(name, period, memory, native, real_time,
+                                   aggregate, compact_stacks, writer_thread,
+                                   writer_latency, num_buffers, max_overhead,
+                                   per_thread, perf_events, cache_stacks,
+                                   symbolize)
         return self.ctx
 
     def get_stats(self):
@@ -5,7 +5,9 @@ import sys
 from six.moves import xrange
 import io
 import gzip
+import mmap
 import datetime
+from array import array
 
 PY3  = sys.version_info[0] >= 3
 
@@ -18,6 +20,9 @@ MARKER_HEADER = b'\x05'
 MARKER_TIME_N_ZONE = b'\x06'
 MARKER_META = b'\x07'
 MARKER_NATIVE_SYMBOLS = b'\x08'
+MARKER_STACKTRACE_PREFIX = b'\x09'
+MARKER_PERIOD = b'\x0a'
+MARKER_MEMORY_MAPS = b'\x0b'
 
 
 VERSION_BASE = 0
@@ -32,6 +37,10 @@ PROFILE_MEMORY = 1
 PROFILE_LINES = 2
 PROFILE_NATIVE = 4
 PROFILE_RPYTHON = 8
+PROFILE_REAL_TIME = 16
+# samples were aggregated by the sampler, a stack trace record stands for
+# count samples of one thread
+PROFILE_AGGREGATE = 32
 
 VMPROF_CODE_TAG = 1
 VMPROF_BLACKHOLE_TAG = 2
@@ -61,6 +70,78 @@ def wrap_kind(kind, pc):
     assert kind == VMPROF_CODE_TAG
     return pc
 
+def int_format(size):
+    if size == 8:
+        return 'q'
+    elif size == 4:
+        return 'l'
+    raise NotImplementedError("did not implement size %d" % size)
+
+# translation table that keeps the least significant byte of an
+# address only if the address is odd (i.e. it might be native)
+ODD_BYTES = bytes(bytearray([i & 1 for i in range(256)]))
+
+def tag_native_addresses(addrs, lowest_bytes):
+    """ Returns a list of addrs where each native address is wrapped
+        in NativeCode. lowest_bytes holds the least significant byte of
+        each address, it is used to skip stacks without native addresses
+        in one step.
+    """
+    if lowest_bytes.translate(ODD_BYTES).find(b'\x01') < 0:
+        return list(addrs)
+    return [NativeCode(addr) if addr > 0 and addr & 1 == 1 else addr
+            for addr in addrs]
+
+def decode_varints(data, count=-1):
+    """ Returns the first count varints in data as a list, or all of
+        them. See src/vmprof_prefix.h for the encoding.
+    """
+    values = []
+    value = shift = 0
+    for byte in bytearray(data):
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        values.append(value)
+        if len(values) == count:
+            break
+        value = shift = 0
+    return values
+
+def zigzag_decode(value):
+    return (value >> 1) ^ -(value & 1)
+
+try:
+    array('q')
+    ADDR_TYPECODE = 'q'
+except ValueError:
+    # python 2 has no 'q' arrays. Its 'l' arrays only take 32 bits on 32
+    # bit platforms and on 64 bit windows, too few for an address, lists
+    # are used then (see addr_array).
+    ADDR_TYPECODE = 'l' if array('l').itemsize >= 8 else None
+
+def addr_array(values=()):
+    """ Returns a new array of addresses (or counts) with values, a list
+        if there is no array type for them.
+    """
+    if ADDR_TYPECODE is None:
+        return list(values)
+    return array(ADDR_TYPECODE, values)
+
+if PY3:
+    array_to_bytes = array.tobytes
+    array_from_bytes = array.frombytes
+else:
+    array_to_bytes = array.tostring
+    array_from_bytes = array.fromstring
+
+# the classes a frame of a trace can have in a StackTable, the
+# index into this tuple is stored as the kind of the frame
+FRAME_CLASSES = (int, NativeCode, JittedCode, AssemblerCode)
+FRAME_KINDS = dict([(cls, i) for i, cls in enumerate(FRAME_CLASSES)
+                    if i > 0])
+
 def gunzip(fileobj):
     is_gzipped = fileobj.read(2) == b'\037\213'
     fileobj.seek(-2, os.SEEK_CUR)
@@ -92,11 +173,20 @@ def assert_error(condition, error="malformed file"):
 class LogReader(object):
     # NOTE be sure to carry along changes in src/symboltable.c for
     # native symbol resolution if something changes in this function
+    chunk_size = None
     def __init__(self, fileobj, state):
         self.fileobj = fileobj
         self.state = state
         self.word_size = None
         self.addr_size = None
+        # slot -> (addrs, lowest bytes, thread id) of the last stack trace
+        # of the slot, see read_prefix_stacktrace
+        self.prefix_slots = {}
+        # the samples read stand for this many samples each, the sampler
+        # lengthens its period with MARKER_PERIOD records
+        self.period_factor = 1
+        # where the trailer starts, None until it is read
+        self.trailer_offset = None
         self.setup()
 
     def setup(self):
@@ -141,6 +231,21 @@ class LogReader(object):
         assert self.little_endian, "big endian profile are not supported"
         self.word_size = word_size
         self.addr_size = addr_size
+        self.word_struct = struct.Struct('<' + int_format(word_size))
+        self.addr_struct = struct.Struct('<' + int_format(addr_size))
+        # count and depth of a stack trace record
+        self.stacktrace_struct = struct.Struct('<2' + int_format(word_size))
+        # maps a stack depth to a precompiled struct.Struct that decodes
+        # that many addresses at once
+        self.addrs_structs = {}
+
+    def addresses_struct(self, count):
+        try:
+            return self.addrs_structs[count]
+        except KeyError:
+            st = struct.Struct('<%d%s' % (count, int_format(self.addr_size)))
+            self.addrs_structs[count] = st
+            return st
 
     def read_static_header(self):
         r = self.read_word()
@@ -163,33 +268,29 @@ class LogReader(object):
             s.profile_memory = (mode & PROFILE_MEMORY) != 0
             s.profile_lines = (mode & PROFILE_LINES) != 0
             s.profile_rpython = (mode & PROFILE_RPYTHON) != 0
+            s.profile_aggregate = (mode & PROFILE_AGGREGATE) != 0
         else:
             s.profile_memory = s.version == VERSION_MEMORY
             s.profile_lines = False
             s.profile_rpython = False
+            s.profile_aggregate = False
+
+        self.read_interp_name()
 
-        lgt = ord(fileobj.read(1))
-        s.interp_name = fileobj.read(lgt)
+    def read_interp_name(self):
+        s = self.state
+        lgt = ord(self.fileobj.read(1))
+        s.interp_name = self.fileobj.read(lgt)
         if s.interp_name == b'pypy':
             s.profile_rpython = True
         if PY3:
             s.interp_name = s.interp_name.decode()
 
     def read_addr(self):
-        if self.addr_size == 8:
-            return struct.unpack('<q', self.fileobj.read(8))[0]
-        elif self.addr_size == 4:
-            return struct.unpack('<l', self.fileobj.read(4))[0]
-        else:
-            raise NotImplementedError("did not implement size %d" % self.size)
+        return self.addr_struct.unpack(self.fileobj.read(self.addr_size))[0]
 
     def read_word(self):
-        if self.word_size == 8:
-            return struct.unpack('<q', self.fileobj.read(8))[0]
-        elif self.word_size == 4:
-            return struct.unpack('<l', self.fileobj.read(4))[0]
-        else:
-            raise NotImplementedError("did not implement size %d" % self.size)
+        return self.word_struct.unpack(self.fileobj.read(self.word_size))[0]
 
     def read(self, count):
         return self.fileobj.read(count)
@@ -202,32 +303,38 @@ class LogReader(object):
         return bytes
 
     def read_trace(self, depth):
+        return self.decode_trace(*self.read_address_block(depth))
+
+    def decode_trace(self, addrs, lowest_bytes):
+        """ Turns the addresses of a stack trace record (leaf first) into
+            a trace. lowest_bytes holds the least significant byte of
+            every address (see tag_native_addresses).
+        """
         if self.state.profile_rpython:
-            assert depth & 1 == 0
-            depth = depth // 2
-            kinds_and_pcs = self.read_addresses(depth * 2)
-            # kinds_and_pcs is a list of [kind1, pc1, kind2, pc2, ...]
-            return [wrap_kind(kinds_and_pcs[i], kinds_and_pcs[i+1])
-                    for i in xrange(0, len(kinds_and_pcs), 2)]
-        else:
-            trace = self.read_addresses(depth)
+            assert len(addrs) & 1 == 0
+            # addrs is a tuple of (kind1, pc1, kind2, pc2, ...)
+            pcs = tag_native_addresses(addrs[1::2], lowest_bytes[1::2])
+            return [wrap_kind(kind, pc) for kind, pc in zip(addrs[0::2], pcs)]
+        if not self.state.profile_lines:
+            return tag_native_addresses(addrs, lowest_bytes)
+        # In the line profiling mode even items in the trace are line numbers.
+        # Every line number corresponds to the following frame, represented by an address.
+        trace = [0] * len(addrs)
+        trace[0::2] = [-line for line in addrs[0::2]]
+        trace[1::2] = tag_native_addresses(addrs[1::2], lowest_bytes[1::2])
+        return trace
 
-            if self.state.profile_lines:
-                for i in xrange(0, len(trace), 2):
-                    # In the line profiling mode even items in the trace are line numbers.
-                    # Every line number corresponds to the following frame, represented by an address.
-                    trace[i] = -trace[i]
-            return trace
+    def read_address_block(self, count):
+        """ Decodes count addresses in one step. Returns a tuple of ints
+            and the least significant byte of every address.
+        """
+        st = self.addresses_struct(count)
+        data = self.fileobj.read(st.size)
+        return st.unpack(data), bytes(data[0::self.addr_size])
 
     def read_addresses(self, count):
-        addrs = []
-        for i in range(count):
-            addr = self.read_addr()
-            if addr > 0 and addr & 1 == 1:
-                addrs.append(NativeCode(addr))
-            else:
-                addrs.append(addr)
-        return addrs
+        addrs, lowest_bytes = self.read_address_block(count)
+        return tag_native_addresses(addrs, lowest_bytes)
 
     def read_s64(self):
         return struct.unpack('q', self.fileobj.read(8))[0]
@@ -247,17 +354,95 @@ class LogReader(object):
         return None
 
     def read_all(self):
+        for trace, count, thread_id, mem_in_kb in self.iter_samples():
+            self.add_trace(trace, count, thread_id, mem_in_kb)
+        self.finished_reading_profile()
+
+    def read_symbols(self, chunk_size=None):
+        """ Reads every record but the stack traces, which are skipped.
+            Afterwards the state holds all virtual ips, native symbols
+            and meta data of the profile, but no samples.
+
+            Returns the offsets of stack trace records that are at least
+            chunk_size bytes apart. Decoding can start at any of them,
+            see iter_samples. Decoding the chunk at chunk_offsets[i] must
+            warm up at chunk_warmups[i] if the profile has prefix records.
+        """
+        self.chunk_offsets = []
+        self.chunk_warmups = []
+        self.chunk_size = chunk_size
+        self.next_chunk = 0
+        self.chunk_slots = set()
+        self.prefix_keyframes = {} # slot -> offset
+        self.period_offsets = [] # (offset, factor) of MARKER_PERIOD records
+        for sample in self.iter_samples(skip_samples=True):
+            pass
+        return self.chunk_offsets
+
+    def add_chunk_offset(self, offset, slot=None, common=0):
+        """ Called for every stack trace record read by read_symbols.
+            slot and common describe prefix records.
+        """
+        if offset >= self.next_chunk:
+            self.chunk_offsets.append(offset)
+            self.chunk_warmups.append(offset)
+            self.chunk_slots = set()
+            self.next_chunk = offset + self.chunk_size
+        if slot is None:
+            return
+        if common and slot not in self.chunk_slots:
+            # the record needs the stack traces of its slot before the
+            # chunk, from the last record that did not depend on the slot
+            self.chunk_warmups[-1] = min(self.chunk_warmups[-1],
+                                         self.prefix_keyframes.get(slot, offset))
+        self.chunk_slots.add(slot)
+        if not common:
+            self.prefix_keyframes[slot] = offset
+
+    def period_factor_at(self, offset):
+        """ Returns the period factor in effect at offset, read_symbols
+            must have been called with a chunk_size.
+        """
+        factor = 1
+        for period_offset, period_factor in self.period_offsets:
+            if period_offset >= offset:
+                break
+            factor = period_factor
+        return factor
+
+    def iter_samples(self, skip_samples=False, start=None, end=None,
+                     warmup=None):
+        """ Reads the profile and yields the samples one at a time as
+            tuples of (trace, count, thread_id, mem_in_kb). All other
+            records are stored on the state while reading.
+
+            If start is given only the records from offset start up to
+            offset end (or the end of the profile) are read, after the
+            header of the profile. start and end must be offsets of
+            records, see read_symbols. The stack traces from offset
+            warmup to start are decoded, but not yielded.
+        """
         s = self.state
         fileobj = self.fileobj
 
         self.detect_file_sizes()
         self.read_static_header()
+        if start is not None:
+            self.read_profile_header()
+            if warmup is None:
+                warmup = start
+            fileobj.seek(warmup, os.SEEK_SET)
+        warming = start is not None and warmup < start
 
-        while True:
+        while end is None or fileobj.tell() < end:
             marker = fileobj.read(1)
             if marker == MARKER_HEADER:
                 assert not s.version, "multiple headers"
                 self.read_header()
+            elif marker == MARKER_INTERP_NAME:
+                # written by old versions of vmprof instead of MARKER_HEADER
+                assert not s.version, "multiple headers"
+                self.read_interp_name()
             elif marker == MARKER_META:
                 key = self.read_string()
                 value = self.read_string()
@@ -266,25 +451,34 @@ class LogReader(object):
             elif marker == MARKER_TIME_N_ZONE:
                 s.start_time = self.read_time_and_zone()
             elif marker == MARKER_STACKTRACE:
-                count = self.read_word()
-                # for now
-                assert count == 1
-                depth = self.read_word()
-                assert depth <= 2**16, 'stack strace depth too high'
-                trace = self.read_trace(depth)
-                thread_id = 0
-                mem_in_kb = 0
-                if s.version >= VERSION_THREAD_ID:
-                    thread_id = self.read_addr()
-                if s.profile_memory:
-                    mem_in_kb = self.read_addr()
-                trace.reverse()
-                self.add_trace(trace, 1, thread_id, mem_in_kb)
+                if skip_samples:
+                    if self.chunk_size is not None:
+                        self.add_chunk_offset(fileobj.tell() - 1)
+                    self.skip_stacktrace()
+                elif warming and fileobj.tell() <= start:
+                    self.skip_stacktrace()
+                else:
+                    warming = False
+                    yield self.weighted(self.read_stacktrace())
+            elif marker == MARKER_STACKTRACE_PREFIX:
+                if skip_samples:
+                    self.skip_prefix_stacktrace(fileobj.tell() - 1)
+                elif warming and fileobj.tell() <= start:
+                    # only decoded for the stack trace of its slot
+                    self.read_prefix_stacktrace(warming=True)
+                else:
+                    warming = False
+                    yield self.weighted(self.read_prefix_stacktrace())
+            elif marker == MARKER_PERIOD:
+                self.read_period(fileobj.tell() - 1)
             elif marker == MARKER_VIRTUAL_IP or marker == MARKER_NATIVE_SYMBOLS:
                 unique_id = self.read_addr()
                 name = self.read_string()
                 self.add_virtual_ip(marker, unique_id, name)
+            elif marker == MARKER_MEMORY_MAPS:
+                self.read_memory_maps()
             elif marker == MARKER_TRAILER:
+                self.trailer_offset = fileobj.tell() - 1
                 #if not virtual_ips_only:
                 #    symmap = read_ranges(fileobj.read())
                 if s.version >= VERSION_DURATION:
@@ -294,7 +488,132 @@ class LogReader(object):
                 assert not marker, (fileobj.tell(), repr(marker))
                 break
 
-        self.finished_reading_profile()
+    def read_profile_header(self):
+        """ Reads the record that follows the static header, it describes
+            the profile (see read_header).
+        """
+        marker = self.fileobj.read(1)
+        if marker == MARKER_HEADER:
+            self.read_header()
+        elif marker == MARKER_INTERP_NAME:
+            self.read_interp_name()
+        else:
+            self.fileobj.seek(-len(marker), os.SEEK_CUR)
+
+    def read_period(self, offset):
+        """ Reads the body of a MARKER_PERIOD record, the samples after
+            it are weighted with its factor.
+        """
+        factor = self.read_word()
+        interval_usec = self.read_word()
+        timestamp = self.read_timeval()
+        self.period_factor = factor
+        self.state.period_changes.append([timestamp, interval_usec, factor])
+        if self.chunk_size is not None:
+            self.period_offsets.append((offset, factor))
+
+    def read_memory_maps(self):
+        """ Reads the body of a MARKER_MEMORY_MAPS record, see
+            write_memory_maps.
+        """
+        count = self.read_word()
+        for i in xrange(count):
+            start = self.read_addr()
+            end = self.read_addr()
+            offset = self.read_word()
+            path = self.read_string()
+            build_id = self.read_string() or None
+            self.state.memory_maps.append((start, end, offset, path, build_id))
+
+    def weighted(self, sample):
+        if self.period_factor == 1:
+            return sample
+        trace, count, thread_id, mem_in_kb = sample
+        return trace, count * self.period_factor, thread_id, mem_in_kb
+
+    def read_stacktrace(self):
+        """ Reads the body of a MARKER_STACKTRACE record. Returns the
+            trace (root first), its count, the thread id and the memory
+            usage in kb.
+        """
+        s = self.state
+        count = self.read_word()
+        # more than one for samples aggregated by the sampler
+        assert count >= 1
+        depth = self.read_word()
+        assert depth <= 2**16, 'stack strace depth too high'
+        trace = self.read_trace(depth)
+        thread_id = 0
+        mem_in_kb = 0
+        if s.version >= VERSION_THREAD_ID:
+            thread_id = self.read_addr()
+        if s.profile_memory:
+            mem_in_kb = self.read_addr()
+        trace.reverse()
+        return trace, count, thread_id, mem_in_kb
+
+    def read_varint(self):
+        value = shift = 0
+        while True:
+            byte = ord(self.fileobj.read(1))
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def read_prefix_stacktrace(self, warming=False):
+        """ Reads the body of a MARKER_STACKTRACE_PREFIX record, a stack
+            trace that shares its root most frames with the previous one
+            of a slot (see src/vmprof_prefix.h). Returns the same as
+            read_stacktrace. While warming up (see iter_samples) the slot
+            might refer to a record before the warm up, the stack trace is
+            unknown then and None is returned.
+        """
+        s = self.state
+        values = decode_varints(self.read(self.read_varint()))
+        count, slot, common, fresh = values[:4]
+        addrs = []
+        addr = 0
+        for delta in values[4:4 + fresh]:
+            addr += zigzag_decode(delta)
+            addrs.append(addr)
+        lowest_bytes = bytes(bytearray([addr & 0xff for addr in addrs]))
+        thread_id = zigzag_decode(values[4 + fresh])
+        if common:
+            if warming and slot not in self.prefix_slots:
+                return None
+            base, base_lowest_bytes, base_thread_id = self.prefix_slots[slot]
+            addrs.extend(base[len(base) - common:])
+            lowest_bytes += base_lowest_bytes[len(base) - common:]
+            thread_id += base_thread_id
+        addrs = tuple(addrs)
+        self.prefix_slots[slot] = (addrs, lowest_bytes, thread_id)
+        mem_in_kb = 0
+        if s.profile_memory:
+            mem_in_kb = values[5 + fresh]
+        trace = self.decode_trace(addrs, lowest_bytes)
+        trace.reverse()
+        return trace, count, thread_id, mem_in_kb
+
+    def skip_prefix_stacktrace(self, offset):
+        """ Skips a MARKER_STACKTRACE_PREFIX record at offset """
+        length = self.read_varint()
+        if self.chunk_size is None:
+            self.fileobj.seek(length, os.SEEK_CUR)
+            return
+        count, slot, common = decode_varints(self.read(length), 3)
+        self.add_chunk_offset(offset, slot, common)
+
+    def skip_stacktrace(self):
+        s = self.state
+        count = self.read_word()
+        depth = self.read_word()
+        assert depth <= 2**16, 'stack strace depth too high'
+        if s.version >= VERSION_THREAD_ID:
+            depth += 1
+        if s.profile_memory:
+            depth += 1
+        self.fileobj.seek(depth * self.addr_size, os.SEEK_CUR)
 
     def finished_reading_profile(self):
         self.state.virtual_ips.sort() # I think it's sorted, but who knows
@@ -303,45 +622,85 @@ class LogReader(object):
         self.state.virtual_ips.append((unique_id, name))
 
     def add_trace(self, trace, trace_count, thread_id, mem_in_kb):
-        self.state.profiles.append((trace, trace_count, thread_id, mem_in_kb))
+        self.state.profiles.add(trace, trace_count, thread_id, mem_in_kb)
+
+def native_symbol_record(addr, name, lineno, srcfile):
+    """ Returns a MARKER_NATIVE_SYMBOLS record that names the native
+        function at addr.
+    """
+    # must match '<lang>:<name>:<line>:<file>'
+    # 'n' has been chosen as lang here, because the symbol
+    # can be generated from several languages (e.g. C, C++, ...)
+    if not name:
+        name = "<native symbol 0x%x>" % addr
+    if not srcfile:
+        srcfile = "-"
+    string = "n:%s:%d:%s" % (name, lineno, srcfile)
+    bytestring = string.encode('utf-8')
+    return b"".join([MARKER_NATIVE_SYMBOLS, struct.pack("P", addr),
+                     struct.pack("l", len(bytestring)), bytestring])
+
+def write_native_symbols(fileobj, addrs, cache=True):
+    """ Appends a MARKER_NATIVE_SYMBOLS record with the name of every
+        address in addrs to the profile in fileobj. The names are looked
+        up in the symbol cache first (see vmprof.symbolcache), unless
+        cache is False.
+    """
+    import _vmprof
+    if not hasattr(_vmprof, 'resolve_addr'):
+        # windows does not implement that!
+        return
+    from _vmprof import resolve_addr
+    from vmprof.symbolize import resolve_addrs
+    if len(addrs) == 0:
+        return
+    symbols = resolve_addrs(addrs, resolve_addr, cache)
+    fileobj.seek(0, os.SEEK_END)
+    for addr in addrs:
+        result = symbols[addr]
+        if result is None:
+            name, lineno, srcfile = None, 0, None
+        else:
+            name, lineno, srcfile = result
+        fileobj.write(native_symbol_record(addr, name, lineno, srcfile))
+
+def write_memory_maps(fileobj, mappings):
+    """ Appends a MARKER_MEMORY_MAPS record to the profile in fileobj,
+        the native functions of the profile can then be resolved on
+        another machine (see vmprof.symbolize):
+
+            char marker                  MARKER_MEMORY_MAPS
+            long count
+            count times:
+                addr start, end          the mapped addresses
+                long offset              the file offset mapped at start
+                string path
+                string build_id          hex, empty if unknown
+
+        mappings is a list of (start, end, offset, path, build_id).
+    """
+    bytelist = [MARKER_MEMORY_MAPS, struct.pack("l", len(mappings))]
+    for start, end, offset, path, build_id in mappings:
+        bytelist.append(struct.pack("PPl", start, end, offset))
+        for string in (path, build_id or ''):
+            bytestring = string.encode('utf-8')
+            bytelist.append(struct.pack("l", len(bytestring)))
+            bytelist.append(bytestring)
+    fileobj.seek(0, os.SEEK_END)
+    fileobj.write(b"".join(bytelist))
 
 class LogReaderDumpNative(LogReader):
+    # False if the native functions are resolved later from the memory
+    # maps of the profile, see vmprof.symbolize
+    symbolize = True
+
     def setup(self):
         self.dedup = set()
 
     def finished_reading_profile(self):
-        import _vmprof
-        if not hasattr(_vmprof, 'resolve_addr'):
-            # windows does not implement that!
-            return
-
-        resolve_addr = _vmprof.resolve_addr
-        from _vmprof import resolve_addr
         LogReader.finished_reading_profile(self)
-        if len(self.dedup) == 0:
-            return
-        self.fileobj.seek(0, os.SEEK_END)
-        # must match '<lang>:<name>:<line>:<file>'
-        # 'n' has been chosen as lang here, because the symbol
-        # can be generated from several languages (e.g. C, C++, ...)
-
-        for addr in self.dedup:
-            bytelist = [b"\x08"]
-            result = resolve_addr(addr)
-            if result is None:
-                name, lineno, srcfile = None, 0, None
-            else:
-                name, lineno, srcfile = result
-            if not name:
-                name = "<native symbol 0x%x>" % addr
-            if not srcfile:
-                srcfile = "-"
-            string = "n:%s:%d:%s" % (name, lineno, srcfile)
-            bytestring = string.encode('utf-8')
-            bytelist.append(struct.pack("P", addr))
-            bytelist.append(struct.pack("l", len(bytestring)))
-            bytelist.append(bytestring)
-            self.fileobj.write(b"".join(bytelist))
+        if self.symbolize:
+            write_native_symbols(self.fileobj, self.dedup)
 
     def add_virtual_ip(self, marker, unique_id, name):
         pass # do nothing, no need to save this data
@@ -351,34 +710,395 @@ class LogReaderDumpNative(LogReader):
             if addr not in self.dedup:
                 self.dedup.add(addr)
 
+class StackTable(object):
+    """ Stores every unique stack trace once and the samples as parallel
+        arrays. Stack i is frames[offsets[i]:offsets[i+1]], the kinds of
+        its frames (an index into FRAME_CLASSES) are stored next to it.
+        Stacks are found by the hash of their frames, no tuples are kept.
+
+        It behaves like a list of (trace, count, thread_id, mem_in_kb)
+        samples, the format LogReaderState.profiles used to have. If
+        merge_samples is set, samples with the same stack, thread and
+        memory usage are stored once, their counts are added up.
+    """
+    def __init__(self, merge_samples=False):
+        self.frames = addr_array()
+        self.kinds = bytearray()
+        self.offsets = addr_array([0])
+        self.stack_counts = addr_array() # samples per stack
+        self.stack_ids = {} # hash -> stack id
+        self.collisions = {} # packed frames -> stack id, rare
+        self.frame_structs = {}
+        self.sample_stacks = addr_array()
+        self.sample_counts = addr_array()
+        self.sample_threads = addr_array()
+        self.sample_mem = addr_array()
+        self.merged_samples = None
+        if merge_samples:
+            self.merged_samples = {} # (stack id, thread, mem) -> sample
+        self._thread_counts = None
+
+    # the arrays that hold the contents of the table, in the order they
+    # are stored by vmprof.statscache
+    ARRAYS = ('frames', 'offsets', 'stack_counts', 'sample_stacks',
+              'sample_counts', 'sample_threads', 'sample_mem')
+
+    @staticmethod
+    def from_profiles(profiles):
+        """ Builds a table from (trace, count[, thread_id[, mem_in_kb]])
+            tuples.
+        """
+        table = StackTable()
+        for profile in profiles:
+            table.add(*profile)
+        return table
+
+    def intern(self, trace):
+        """ Returns the id of the stack trace, it is added if it is new.
+            Stacks are compared by the values of their frames, the kinds
+            are taken from the first trace of a stack. In a profile the
+            kind of a frame follows from its address.
+        """
+        frames = tuple(trace)
+        key = hash(frames)
+        if self.stack_ids is None:
+            self.rebuild_stack_ids()
+        stack_id = self.stack_ids.get(key)
+        known_hash = stack_id is not None
+        if known_hash:
+            packed = self.pack(frames)
+            if self.packed_stack(stack_id) == packed:
+                return stack_id
+            stack_id = self.collisions.get(packed)
+            if stack_id is not None:
+                return stack_id
+        stack_id = len(self.stack_counts)
+        if known_hash:
+            self.collisions[packed] = stack_id
+        else:
+            self.stack_ids[key] = stack_id
+        self.frames.extend(frames)
+        self.kinds.extend([FRAME_KINDS.get(type(addr), 0) for addr in frames])
+        self.offsets.append(len(self.frames))
+        self.stack_counts.append(0)
+        return stack_id
+
+    def rebuild_stack_ids(self):
+        """ Rebuilds the hash index of the stacks, e.g. after the arrays
+            were loaded from a cache file.
+        """
+        self.stack_ids = {}
+        self.collisions = {}
+        for stack_id in range(len(self.stack_counts)):
+            start = self.offsets[stack_id]
+            stop = self.offsets[stack_id + 1]
+            key = hash(tuple(self.frames[start:stop]))
+            if key in self.stack_ids:
+                self.collisions[self.packed_stack(stack_id)] = stack_id
+            else:
+                self.stack_ids[key] = stack_id
+
+    def pack(self, frames):
+        """ Returns the frames in the memory layout of self.frames, as
+            a tuple if it is a list.
+        """
+        if ADDR_TYPECODE is None:
+            return tuple(frames)
+        try:
+            st = self.frame_structs[len(frames)]
+        except KeyError:
+            st = struct.Struct('%d%s' % (len(frames), ADDR_TYPECODE))
+            self.frame_structs[len(frames)] = st
+        return st.pack(*frames)
+
+    def packed_stack(self, stack_id):
+        """ Returns the frames of a stack like pack() """
+        frames = self.frames[self.offsets[stack_id]:self.offsets[stack_id + 1]]
+        if ADDR_TYPECODE is None:
+            return tuple(frames)
+        return array_to_bytes(frames)
+
+    def add(self, trace, count, thread_id=0, mem_in_kb=0):
+        self.add_sample(self.intern(trace), count, thread_id, mem_in_kb)
+
+    def add_sample(self, stack_id, count, thread_id=0, mem_in_kb=0):
+        self.stack_counts[stack_id] += count
+        self._thread_counts = None
+        if self.merged_samples is not None:
+            key = (stack_id, thread_id, mem_in_kb)
+            index = self.merged_samples.get(key)
+            if index is not None:
+                self.sample_counts[index] += count
+                return
+            self.merged_samples[key] = len(self.sample_stacks)
+        self.sample_stacks.append(stack_id)
+        self.sample_counts.append(count)
+        self.sample_threads.append(thread_id)
+        self.sample_mem.append(mem_in_kb)
+
+    def merge(self, other):
+        """ Adds all samples of the StackTable other to this table """
+        stack_ids = [self.intern(other.get_stack(stack_id))
+                     for stack_id in range(len(other.stack_counts))]
+        for stack_id, count, thread_id, mem_in_kb in zip(other.sample_stacks,
+                other.sample_counts, other.sample_threads, other.sample_mem):
+            self.add_sample(stack_ids[stack_id], count, thread_id, mem_in_kb)
+
+    @staticmethod
+    def from_arrays(arrays, kinds):
+        """ Builds a table from the values of the arrays named in ARRAYS
+            and the kinds of the frames.
+        """
+        table = StackTable()
+        for name, values in zip(StackTable.ARRAYS, arrays):
+            setattr(table, name, values)
+        table.kinds = kinds
+        table.stack_ids = None # rebuilt when a stack is added
+        return table
+
+    def __reduce__(self):
+        # the hash index is not pickled, it is rebuilt when needed
+        return (StackTable.from_arrays,
+                ([getattr(self, name) for name in StackTable.ARRAYS],
+                 self.kinds))
+
+    def get_stack(self, stack_id):
+        """ Returns the trace of a stack as a new list """
+        start = self.offsets[stack_id]
+        stop = self.offsets[stack_id + 1]
+        trace = self.frames[start:stop]
+        if ADDR_TYPECODE is not None:
+            trace = trace.tolist()
+        kinds = self.kinds[start:stop]
+        if any(kinds):
+            for i, kind in enumerate(kinds):
+                if kind:
+                    trace[i] = FRAME_CLASSES[kind](trace[i])
+        return trace
+
+    def iter_stacks(self):
+        """ Yields (trace, count) for every unique stack, in the order
+            the stacks were first seen. count is the sum of the counts
+            of all samples of the stack.
+        """
+        for stack_id, count in enumerate(self.stack_counts):
+            yield self.get_stack(stack_id), count
+
+    def total_count(self):
+        return sum(self.stack_counts)
+
+    def thread_counts(self):
+        """ Returns a dict that maps thread ids to their number of samples
+        """
+        if self._thread_counts is None:
+            counts = {}
+            for thread_id, count in zip(self.sample_threads, self.sample_counts):
+                counts[thread_id] = counts.get(thread_id, 0) + count
+            self._thread_counts = counts
+        return self._thread_counts
+
+    def __len__(self):
+        return len(self.sample_stacks)
+
+    def __getitem__(self, index):
+        return (self.get_stack(self.sample_stacks[index]),
+                self.sample_counts[index], self.sample_threads[index],
+                self.sample_mem[index])
+
+    def __iter__(self):
+        for index in range(len(self.sample_stacks)):
+            yield self[index]
+
 class ReaderState(object):
     pass
 
 class LogReaderState(ReaderState):
     def __init__(self):
         self.virtual_ips = []
-        self.profiles = []
+        self.profiles = StackTable()
         self.interp_name = None
         self.start_time = None
         self.end_time = None
         self.version = 0
         self.profile_memory = False
         self.profile_lines = False
+        self.profile_rpython = False
+        self.profile_aggregate = False
         self.meta = {}
         self.little_endian = True
         self.period = 0
+        # [timestamp in microseconds, interval in microseconds, factor]
+        # for every change of the sampling period, see MARKER_PERIOD
+        self.period_changes = []
+        # (start, end, offset, path, build_id) of the executable mappings
+        # of the process, see MARKER_MEMORY_MAPS
+        self.memory_maps = []
 
-def _read_prof(fileobj, virtual_ips_only=False):
-    fileobj = gunzip(fileobj)
+class MMapLogReader(LogReader):
+    """ Reads a profile from a read only memory map (see mmap_profile).
+        The mmap object itself is the file object. Stack trace records
+        are decoded straight from the mapped buffer, one struct unpack
+        per record, without copying them into bytes objects.
+    """
+    def read_address_block(self, count):
+        st = self.addresses_struct(count)
+        buf = self.fileobj
+        pos = buf.tell()
+        addrs = st.unpack_from(buf, pos)
+        end = pos + st.size
+        buf.seek(end)
+        return addrs, buf[pos:end:self.addr_size]
+
+    def read_stacktrace(self):
+        s = self.state
+        buf = self.fileobj
+        pos = buf.tell()
+        count, depth = self.stacktrace_struct.unpack_from(buf, pos)
+        # more than one for samples aggregated by the sampler
+        assert count >= 1
+        assert depth <= 2**16, 'stack strace depth too high'
+        pos += self.stacktrace_struct.size
+        # the thread id and the memory usage follow the trace
+        extra = int(s.version >= VERSION_THREAD_ID) + int(bool(s.profile_memory))
+        st = self.addresses_struct(depth + extra)
+        record = st.unpack_from(buf, pos)
+        end = pos + depth * self.addr_size
+        buf.seek(pos + st.size)
+        trace = self.decode_trace(record[:depth], buf[pos:end:self.addr_size])
+        thread_id = 0
+        mem_in_kb = 0
+        if s.version >= VERSION_THREAD_ID:
+            thread_id = record[depth]
+        if s.profile_memory:
+            mem_in_kb = record[-1]
+        trace.reverse()
+        return trace, count, thread_id, mem_in_kb
+
+def mmap_profile(fileobj):
+    """ Returns a read only memory map of the whole profile fileobj is
+        opened on. None is returned if fileobj is not a real file, if
+        it cannot be mapped (e.g. empty) or if it is gzipped.
+    """
+    try:
+        fileno = fileobj.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return None
+    try:
+        buf = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+        return None
+    if buf[:2] == b'\037\213':
+        buf.close()
+        return None
+    return buf
 
+def _open_prof(fileobj, state):
+    """ Returns a reader for the profile fileobj and the memory map it
+        reads from, None if the profile is not mapped (see mmap_profile).
+    """
+    buf = mmap_profile(fileobj)
+    if buf is not None:
+        return MMapLogReader(buf, state), buf
+    return LogReader(gunzip(fileobj), state), None
+
+def _read_prof(fileobj, virtual_ips_only=False):
     state = LogReaderState()
-    reader = LogReader(fileobj, state)
-    reader.read_all()
+    reader, buf = _open_prof(fileobj, state)
+    try:
+        reader.read_all()
+    finally:
+        if buf is not None:
+            buf.close()
 
     if virtual_ips_only:
         return state.virtual_ips
     return state
 
+def _iter_prof(fileobj, state):
+    """ Yields the samples of the profile fileobj. The file is read
+        twice, the first pass only fills state with the symbols and
+        the meta data, the second one decodes the samples.
+    """
+    fileobj.seek(0, os.SEEK_SET)
+    reader, buf = _open_prof(fileobj, state)
+    try:
+        reader.read_symbols()
+        reader.finished_reading_profile()
+    finally:
+        if buf is not None:
+            buf.close()
+
+    fileobj.seek(0, os.SEEK_SET)
+    reader, buf = _open_prof(fileobj, LogReaderState())
+    try:
+        for sample in reader.iter_samples():
+            yield sample
+    finally:
+        if buf is not None:
+            buf.close()
+
+# a chunk of a profile that is decoded by a worker process has at least
+# this size, smaller ones are not worth the overhead
+MIN_CHUNK_SIZE = 4 * 1024 * 1024
+
+def _read_prof_parallel(path, workers):
+    """ Decodes the profile at path in chunks with a pool of worker
+        processes. The first pass only collects the symbols and the
+        offsets the chunks start at. Samples with the same stack, thread
+        and memory usage are merged. Returns None if the profile cannot
+        be decoded in chunks, i.e. if it is gzipped.
+    """
+    try:
+        from concurrent.futures import ProcessPoolExecutor
+    except ImportError:
+        return None
+    state = LogReaderState()
+    with open(path, 'rb') as fileobj:
+        buf = mmap_profile(fileobj)
+        if buf is None:
+            return None
+        try:
+            reader = MMapLogReader(buf, state)
+            chunk_size = max(MIN_CHUNK_SIZE, len(buf) // (workers * 4))
+            starts = reader.read_symbols(chunk_size)
+            warmups = reader.chunk_warmups
+            factors = [reader.period_factor_at(offset) for offset in warmups]
+            reader.finished_reading_profile()
+        finally:
+            buf.close()
+    ends = starts[1:] + [None]
+    table = state.profiles = StackTable(merge_samples=True)
+    if len(starts) < 2:
+        chunks = map(_read_chunk, [path] * len(starts), starts, ends,
+                     warmups, factors)
+        for chunk in chunks:
+            table.merge(chunk)
+        return state
+    with ProcessPoolExecutor(min(workers, len(starts))) as pool:
+        for chunk in pool.map(_read_chunk, [path] * len(starts), starts, ends,
+                              warmups, factors):
+            table.merge(chunk)
+    return state
+
+def _read_chunk(path, start, end, warmup=None, period_factor=1):
+    """ Returns a StackTable of the samples of the profile at path that
+        are between the offsets start and end, see iter_samples.
+        period_factor is the one in effect at offset warmup (or start).
+    """
+    table = StackTable(merge_samples=True)
+    with open(path, 'rb') as fileobj:
+        reader, buf = _open_prof(fileobj, LogReaderState())
+        reader.period_factor = period_factor
+        try:
+            for trace, count, thread_id, mem_in_kb in \
+                    reader.iter_samples(start=start, end=end,
+                                        warmup=warmup):
+                table.add(trace, count, thread_id, mem_in_kb)
+        finally:
+            if buf is not None:
+                buf.close()
+    return table
+
 class FdWrapper(object):
     """ This wrapper behaves like a file object. Could not find
         an stdlib API function that creates such an object without
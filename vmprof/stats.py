@@ -1,12 +1,31 @@
 import six
-from vmprof.reader import AssemblerCode, JittedCode, NativeCode
+from vmprof.reader import (AssemblerCode, JittedCode, NativeCode, StackTable,
+        FRAME_CLASSES, FRAME_KINDS, addr_array)
 
 class EmptyProfileFile(Exception):
     pass
 
+def add_sampler_averages(stats):
+    """ Adds the averages handler_avg_ns and walk_avg_ns per sample, the
+        overhead (the fraction of the elapsed time spent in the signal
+        handler) and the unwind_hit_rate (of the native frames found in the
+        unwind cache) to a dict of sampler counters.
+    """
+    samples = stats.get('samples', 0)
+    elapsed = stats.get('elapsed_ns', 0)
+    stats['handler_avg_ns'] = stats.get('handler_ns', 0) // samples if samples else 0
+    stats['walk_avg_ns'] = stats.get('walk_ns', 0) // samples if samples else 0
+    stats['overhead'] = stats.get('handler_ns', 0) / float(elapsed) if elapsed else 0.0
+    lookups = stats.get('unwind_hits', 0) + stats.get('unwind_misses', 0)
+    stats['unwind_hit_rate'] = stats.get('unwind_hits', 0) / float(lookups) if lookups else 0.0
+    return stats
+
 class Stats(object):
     def __init__(self, profiles, adr_dict=None, jit_frames=None, interp=None,
                  meta=None, start_time=None, end_time=None, state=None):
+        if not isinstance(profiles, StackTable):
+            profiles = StackTable.from_profiles(profiles)
+        # the samples, the analysis works on profiles.iter_stacks()
         self.profiles = profiles
         self.adr_dict = adr_dict
         self.functions = {}
@@ -14,10 +33,14 @@ class Stats(object):
         if state:
             self.profile_lines = state.profile_lines
             self.profile_memory = state.profile_memory
+            self.profile_aggregate = state.profile_aggregate
+            self.period_changes = state.period_changes
         else:
             # unkown, for tests only
             self.profile_lines = False
             self.profile_memory = False
+            self.profile_aggregate = False
+            self.period_changes = []
         self.generate_top()
         if jit_frames is None:
             jit_frames = set()
@@ -28,6 +51,9 @@ class Stats(object):
         self.meta = meta or {}
         self.start_time = start_time
         self.end_time = end_time
+        # built on first use, see get_stack_index and get_symbol_index
+        self._stack_index = None
+        self._symbol_index = None
 
     def get_runtime_in_microseconds(self):
         if self.start_time is None or self.end_time is None:
@@ -41,11 +67,27 @@ class Stats(object):
         line = self.adr_dict[addr]
         return line.split(":")[1]
 
+    def get_symbol_index(self):
+        """ Returns a dict that maps the symbol names of adr_dict to lists
+            of their addresses. It is built on first use.
+        """
+        if self._symbol_index is None:
+            index = {}
+            for adr, name in six.iteritems(self.adr_dict or {}):
+                parts = name.split(':', 3)
+                if len(parts) == 4:
+                    index.setdefault(parts[1], []).append(adr)
+            self._symbol_index = index
+        return self._symbol_index
+
     def find_addrs_containing_name(self, part):
-        for adr, name in self.adr_dict.items():
-            n, symbol, _, _ = name.split(':', 3)
+        for symbol, addrs in six.iteritems(self.get_symbol_index()):
             if part in symbol:
-                yield adr
+                for adr in addrs:
+                    yield adr
+
+    def find_addrs_by_name(self, symbol):
+        return list(self.get_symbol_index().get(symbol, ()))
 
     def get_addr_info(self, addr):
         name = self.adr_dict.get(addr, None)
@@ -54,26 +96,65 @@ class Stats(object):
         lang, symbol, line, file = name.split(':', 3)
         return lang, symbol, line, file
 
+    def get_thread_counts(self):
+        """ Returns a dict that maps thread ids to their number of samples
+        """
+        return self.profiles.thread_counts()
+
     def getargv(self):
         return self.meta.get('argv', '')
 
     def getmeta(self, key, default):
         return self.meta.get(key, default) 
 
+    def get_lost_samples(self):
+        """ Returns the number of samples that are not in the profile,
+            because all buffers of the sampler were busy or because the
+            stack could not be walked. 0 for profiles of older versions.
+        """
+        return (int(self.meta.get('dropped_samples', 0)) +
+                int(self.meta.get('cancelled_samples', 0)))
+
+    def get_sampler_stats(self):
+        """ Returns the counters of the sampler written to the end of the
+            profile, see vmprof.sampler_stats. Empty for profiles of
+            older versions.
+        """
+        stats = {}
+        for key, value in six.iteritems(self.meta):
+            if key.startswith('sampler_'):
+                stats[key[len('sampler_'):]] = int(value)
+        if not stats:
+            return stats
+        stats['dropped_samples'] = int(self.meta.get('dropped_samples', 0))
+        stats['cancelled_samples'] = int(self.meta.get('cancelled_samples', 0))
+        stats['backend'] = self.meta.get('sampling_backend', 'itimer')
+        return add_sampler_averages(stats)
+
+    def get_drop_ratio(self):
+        """ Returns the fraction of all samples taken that is lost, see
+            get_lost_samples.
+        """
+        lost = self.get_lost_samples()
+        total = self.profiles.total_count() + lost
+        if total == 0:
+            return 0.0
+        return lost / float(total)
+
     def display(self, no):
         prof = self.profiles[no][0]
         return [self._get_name(elem) for elem in prof]
 
     def generate_top(self):
-        for profile in self.profiles:
+        for trace, count in self.profiles.iter_stacks():
             current_iter = {}
-            for i, addr in enumerate(profile[0]):
+            for i, addr in enumerate(trace):
                 if self.profile_lines and i % 2 == 1:
                     # this entry in the profile is a negative number indicating a line
                     assert addr <= 0
                     continue
                 if addr not in current_iter:  # count only topmost
-                    self.functions[addr] = self.functions.get(addr, 0) + 1
+                    self.functions[addr] = self.functions.get(addr, 0) + count
                     current_iter[addr] = None
 
     def top_profile(self):
@@ -85,68 +166,118 @@ class Stats(object):
 
         return addr
 
+    def get_stack_index(self):
+        """ Returns a dict that maps every address to an array of the ids
+            of the stacks it occurs in (see StackTable). It is built on
+            first use, queries then only look at the matching stacks.
+        """
+        if self._stack_index is None:
+            index = {}
+            for stack_id, (trace, count) in enumerate(self.profiles.iter_stacks()):
+                if self.profile_lines:
+                    trace = trace[0::2] # skip the line numbers
+                for addr in set(trace):
+                    stack_ids = index.get(addr)
+                    if stack_ids is None:
+                        stack_ids = index[addr] = addr_array()
+                    stack_ids.append(stack_id)
+            self._stack_index = index
+        return self._stack_index
+
     def function_profile(self, top_function):
         """ Show functions that we call (directly or indirectly) under
         a given addr
         """
         result = {}
         total = 0
-        for profile in self.profiles:
+        profiles = self.profiles
+        for stack_id in self.get_stack_index().get(top_function, ()):
+            trace = profiles.get_stack(stack_id)
+            count = profiles.stack_counts[stack_id]
+            total += count
             current_iter = {}  # don't count twice
-            counting = False
-            for addr in profile[0]:
-                if counting:
-                    if addr in current_iter:
-                        continue
-                    current_iter[addr] = None
-                    result[addr] = result.get(addr, 0) + 1
-                else:
-                    if addr == top_function:
-                        counting = True
-                        total += 1
+            for addr in trace[trace.index(top_function) + 1:]:
+                if addr in current_iter:
+                    continue
+                current_iter[addr] = None
+                result[addr] = result.get(addr, 0) + count
+        result = sorted(result.items(), key=lambda a: a[1])
+        return result, total
+
+    def get_callers(self, addr):
+        """ Show functions that directly call addr. Returns a list of
+        (addr, count) sorted by count and the number of samples of addr
+        """
+        return self._direct_neighbours(addr, -1)
+
+    def get_callees(self, addr):
+        """ Show functions directly called by addr, see get_callers
+        """
+        return self._direct_neighbours(addr, 1)
+
+    def _direct_neighbours(self, addr, offset):
+        result = {}
+        total = 0
+        profiles = self.profiles
+        for stack_id in self.get_stack_index().get(addr, ()):
+            trace = profiles.get_stack(stack_id)
+            if self.profile_lines:
+                trace = trace[0::2]
+            count = profiles.stack_counts[stack_id]
+            total += count
+            neighbours = set()  # don't count twice
+            for i, frame in enumerate(trace):
+                if frame == addr and 0 <= i + offset < len(trace):
+                    neighbours.add(trace[i + offset])
+            for neighbour in neighbours:
+                result[neighbour] = result.get(neighbour, 0) + count
         result = sorted(result.items(), key=lambda a: a[1])
         return result, total
 
     def get_top(self, profiles):
-        for prof in profiles:
-            if prof[0]:
+        if not isinstance(profiles, StackTable):
+            profiles = StackTable.from_profiles(profiles)
+        for trace, count in profiles.iter_stacks():
+            if trace:
                 break
         else:
             raise EmptyProfileFile()
-        top_addr = prof[0][0]
+        top_addr = trace[0]
         top = Node(top_addr, self._get_name(top_addr))
-        top.count = len(self.profiles)
+        top.count = self.profiles.total_count()
         return top
 
     def get_tree(self):
         # fine the first non-empty profile
 
         top = self.get_top(self.profiles)
+        tree = CallTree(top.addr, top.name, top.count)
         addr = None
-        for profile in self.profiles:
+        for trace, count in self.profiles.iter_stacks():
             last_addr = top.addr
-            cur = top
-            for i in range(0, len(profile[0])):
-                if isinstance(profile[0][i], AssemblerCode):
+            cur = 0
+            for frame in trace:
+                if isinstance(frame, AssemblerCode):
                     continue # just ignore it for now
-                addr = profile[0][i]
+                addr = frame
 
                 if addr <= 0:
                     # negative address means line number
-                    cur.lines[-addr] = cur.lines.get(-addr, 0) + 1
+                    tree.add_line(cur, -addr, count)
                 else:
                     if addr == last_addr:
                         continue  # ignore duplicates
                     last_addr = addr
                     name = self._get_name(addr)
-                    cur = cur.add_child(addr, name)
+                    cur = tree.add_child(cur, addr, name, count)
             if isinstance(addr, JittedCode):
-                cur.meta['jit'] = cur.meta.get('jit', 0) + 1
+                tree.add_meta(cur, 'jit', count)
             if isinstance(addr, NativeCode):
-                cur.meta['native'] = cur.meta.get('native', 0) + 1
+                tree.add_meta(cur, 'native', count)
         # get the first "interesting" node, that is after vmprof and pypy
         # mess
 
+        top = TreeNode(tree, 0)
         return self.filter_top(top)
 
     def filter_top(self, top):
@@ -173,22 +304,38 @@ class Stats(object):
         return first_top
 
 
-class Node(object):
-    """ children is a dict of addr -> Node
+class StatsBuilder(object):
+    """ Builds Stats from samples that are added one at a time, e.g. from
+        vmprof.iter_samples. Samples with the same trace, thread and
+        memory usage are stored only once, together with their count.
     """
-    _self_count = None
-    flat = False
+    def __init__(self):
+        self.profiles = StackTable(merge_samples=True)
 
-    def __init__(self, addr, name, count=1, children=None):
-        if children is None:
-            children = {}
-        self.children = children
-        self.name = name
-        self.addr = addr
-        self.count = count # starts at 1
-        self.jitcodes = {}
-        self.meta = {}
-        self.lines = {}
+    def add_sample(self, trace, count, thread_id, mem_in_kb):
+        self.profiles.add(trace, count, thread_id, mem_in_kb)
+
+    def get_profiles(self):
+        """ Returns the merged samples in the order they were first seen,
+            in the same format as state.profiles.
+        """
+        return list(self.profiles)
+
+    def build(self, state):
+        """ Returns the Stats of the samples added so far. state is the
+            LogReaderState the symbols and meta data were read into.
+        """
+        return Stats(self.profiles, dict(state.virtual_ips), {},
+                     interp=state.interp_name, start_time=state.start_time,
+                     end_time=state.end_time, meta=state.meta, state=state)
+
+
+class BaseNode(object):
+    """ The interface of a node of a call tree, shared by Node and the
+        TreeNode view of a CallTree.
+    """
+    __slots__ = ()
+    flat = False
 
     def __getitem__(self, item):
         if isinstance(item, int):
@@ -229,9 +376,44 @@ class Node(object):
             d[k] = d.get(k, 0) + v
         return d
 
+    self_count = property(lambda self: self.get_self_count())
+
+    def __eq__(self, other):
+        if not isinstance(other, BaseNode):
+            return False
+        return self.name == other.name and self.addr == other.addr and self.count == other.count and self.children == other.children
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        items = sorted(self.children.items())
+        child_str = ", ".join([("(%d, %s)" % (v.count, v.name))
+                               for k, v in items])
+        return '<Node: %s (%d) [%s]>' % (self.name, self.count, child_str)
+
+
+class Node(BaseNode):
+    """ children is a dict of addr -> Node
+    """
+    __slots__ = ('children', 'name', 'addr', 'count', 'jitcodes', 'meta',
+                 'lines', '_self_count')
+
+    def __init__(self, addr, name, count=1, children=None):
+        if children is None:
+            children = {}
+        self.children = children
+        self.name = name
+        self.addr = addr
+        self.count = count # starts at 1
+        self.jitcodes = {}
+        self.meta = {}
+        self.lines = {}
+        self._self_count = None
+
     def _filter(self, count):
         # XXX make a copy
-        for key, c in self.children.items():
+        for key, c in list(self.children.items()):
             if c.count < count:
                 del self.children[key]
             else:
@@ -245,27 +427,184 @@ class Node(object):
             self._self_count -= elem.count
         return self._self_count
 
-    self_count = property(get_self_count)
-
-    def add_child(self, addr, name):
+    def add_child(self, addr, name, count=1):
         try:
             next = self.children[addr]
-            next.count += 1
+            next.count += count
         except KeyError:
-            next = Node(addr, name)
+            next = Node(addr, name, count)
             self.children[addr] = next
         return next
 
-    def __eq__(self, other):
-        if not isinstance(other, Node):
-            return False
-        return self.name == other.name and self.addr == other.addr and self.count == other.count and self.children == other.children
 
-    def __ne__(self, other):
-        return not self == other
+def child_key(parent, addr):
+    # a single int takes less memory than a tuple of two
+    return (addr << 32) | parent
 
-    def __repr__(self):
-        items = sorted(self.children.items())
-        child_str = ", ".join([("(%d, %s)" % (v.count, v.name))
-                               for k, v in items])
-        return '<Node: %s (%d) [%s]>' % (self.name, self.count, child_str)
+class CallTree(object):
+    """ A call tree stored in parallel arrays with one entry per node,
+        node 0 is the root. The children of a node are a linked list
+        (first_child, next_sibling). Meta data, line and jit code counts
+        are only stored for the nodes that have them.
+
+        TreeNode gives a Node compatible view of a node.
+    """
+    def __init__(self, addr, name, count):
+        self.parents = addr_array()
+        self.addrs = addr_array()
+        self.kinds = bytearray() # the kinds of the addrs, see FRAME_KINDS
+        self.names = []
+        self.counts = addr_array()
+        self.self_counts = addr_array()
+        self.first_child = addr_array()
+        self.next_sibling = addr_array()
+        self.child_index = {} # child_key(parent, addr) -> node
+        self.meta = {} # node -> dict
+        self.lines = {} # node -> dict
+        self.jitcodes = {} # node -> dict
+        self.add_node(-1, addr, name, count)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add_node(self, parent, addr, name, count):
+        node = len(self.counts)
+        self.parents.append(parent)
+        self.addrs.append(addr)
+        self.kinds.append(FRAME_KINDS.get(type(addr), 0))
+        self.names.append(name)
+        self.counts.append(count)
+        self.self_counts.append(count)
+        self.first_child.append(-1)
+        if parent < 0:
+            self.next_sibling.append(-1)
+        else:
+            self.next_sibling.append(self.first_child[parent])
+            self.first_child[parent] = node
+            self.child_index[child_key(parent, addr)] = node
+        return node
+
+    def add_child(self, parent, addr, name, count=1):
+        """ Adds count samples to the child addr of parent, the child is
+            created if it does not exist. Returns the child.
+        """
+        node = self.child_index.get(child_key(parent, addr))
+        if node is None:
+            node = self.add_node(parent, addr, name, 0)
+        self.counts[node] += count
+        self.self_counts[node] += count
+        self.self_counts[parent] -= count
+        return node
+
+    def get_addr(self, node):
+        """ Returns the addr of node as the class it was added with """
+        kind = self.kinds[node]
+        if kind:
+            return FRAME_CLASSES[kind](self.addrs[node])
+        return self.addrs[node]
+
+    def add_line(self, node, line, count=1):
+        lines = self.lines.setdefault(node, {})
+        lines[line] = lines.get(line, 0) + count
+
+    def add_meta(self, node, key, count=1):
+        meta = self.meta.setdefault(node, {})
+        meta[key] = meta.get(key, 0) + count
+
+    def get_children(self, node):
+        """ Returns the children of node in the order they were added """
+        children = []
+        child = self.first_child[node]
+        while child >= 0:
+            children.append(child)
+            child = self.next_sibling[child]
+        children.reverse()
+        return children
+
+    def filter(self, node, count):
+        """ Removes all subtrees below node with less than count samples """
+        todo = [node]
+        while todo:
+            node = todo.pop()
+            kept = -1
+            for child in reversed(self.get_children(node)):
+                if self.counts[child] < count:
+                    del self.child_index[child_key(node, self.addrs[child])]
+                    self.self_counts[node] += self.counts[child]
+                else:
+                    self.next_sibling[child] = kept
+                    kept = child
+                    todo.append(child)
+            self.first_child[node] = kept
+
+
+EMPTY = {}
+
+class TreeNode(BaseNode):
+    """ A Node compatible view of a node of a CallTree. """
+    __slots__ = ('tree', 'index')
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    @property
+    def addr(self):
+        return self.tree.get_addr(self.index)
+
+    @property
+    def name(self):
+        return self.tree.names[self.index]
+
+    def get_count(self):
+        return self.tree.counts[self.index]
+
+    def set_count(self, count):
+        self.tree.counts[self.index] = count
+
+    count = property(get_count, set_count)
+
+    def get_self_count(self):
+        return self.tree.self_counts[self.index]
+
+    @property
+    def children(self):
+        tree = self.tree
+        return dict([(tree.get_addr(child), TreeNode(tree, child))
+                     for child in tree.get_children(self.index)])
+
+    @property
+    def meta(self):
+        return self.tree.meta.setdefault(self.index, {})
+
+    @property
+    def lines(self):
+        return self.tree.lines.setdefault(self.index, {})
+
+    @property
+    def jitcodes(self):
+        return self.tree.jitcodes.setdefault(self.index, {})
+
+    def _serialize(self):
+        chld = [ch._serialize() for ch in six.itervalues(self.children)]
+        return [self.name, str(self.addr), self.count,
+                self.tree.meta.get(self.index, EMPTY), chld]
+
+    def cumulative_meta(self, d=None):
+        if d is None:
+            d = {}
+        tree = self.tree
+        todo = [self.index]
+        while todo:
+            node = todo.pop()
+            todo.extend(tree.get_children(node))
+            for k, v in six.iteritems(tree.meta.get(node, EMPTY)):
+                d[k] = d.get(k, 0) + v
+        return d
+
+    def _filter(self, count):
+        self.tree.filter(self.index, count)
+
+    def add_child(self, addr, name, count=1):
+        return TreeNode(self.tree, self.tree.add_child(self.index, addr, name,
+                                                       count))
@@ -0,0 +1,198 @@
+""" A cache of the decoded contents of a profile, stored next to it in
+<profile>.stats. Reading a large profile a second time loads the unique
+stacks, the samples and the symbols from the cache instead of decoding
+the whole profile again.
+
+A cache file starts with MAGIC, followed by the length of a JSON header
+(8 bytes little endian) and the header itself. After padding to 8 bytes
+the arrays of the StackTable follow in the order of StackTable.ARRAYS,
+in native byte order, and finally the kinds of the frames.
+
+A cache is only used while the size, the modification time and the hash
+of the beginning and the end of the profile are unchanged. Profiles are
+not cached if the StackTable holds lists (see vmprof.reader.addr_array).
+"""
+import os
+import sys
+import json
+import struct
+import hashlib
+import datetime
+from array import array
+
+from vmprof.reader import (LogReaderState, StackTable, ADDR_TYPECODE, PY3,
+        array_from_bytes, _read_prof, _read_prof_parallel)
+
+MAGIC = b'VMPSTATS'
+FORMAT_VERSION = 2
+# hashed at the start and at the end of the profile
+HASH_BYTES = 1024 * 1024
+# read_profile_state writes a cache by default for profiles of this size
+MIN_PROFILE_SIZE = 16 * 1024 * 1024
+
+STATE_ATTRIBUTES = ('interp_name', 'version', 'profile_memory',
+                    'profile_lines', 'profile_rpython', 'profile_aggregate',
+                    'meta',
+                    'little_endian', 'period', 'period_changes',
+                    'memory_maps')
+
+def cache_path(path):
+    return path + '.stats'
+
+def profile_key(path):
+    """ Returns what identifies the contents of the profile at path """
+    st = os.stat(path)
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fileobj:
+        digest.update(fileobj.read(HASH_BYTES))
+        if st.st_size > HASH_BYTES:
+            fileobj.seek(max(HASH_BYTES, st.st_size - HASH_BYTES))
+            digest.update(fileobj.read(HASH_BYTES))
+    return {'size': st.st_size, 'mtime': st.st_mtime,
+            'hash': digest.hexdigest()}
+
+def encode_time(time):
+    if time is None:
+        return None
+    return [time.year, time.month, time.day, time.hour, time.minute,
+            time.second, time.microsecond]
+
+def decode_time(fields):
+    if fields is None:
+        return None
+    return datetime.datetime(*fields)
+
+def padding(pos):
+    return -pos % 8
+
+def write_cache(path, state, key):
+    """ Writes the cache of the profile at path. key is the profile_key
+        of the profile state was read from. Returns False if the cache
+        could not be written.
+    """
+    if ADDR_TYPECODE is None:
+        # the table holds lists, see vmprof.reader.addr_array
+        return False
+    table = state.profiles
+    header = {
+        'version': FORMAT_VERSION,
+        'key': key,
+        'typecode': ADDR_TYPECODE,
+        'itemsize': table.frames.itemsize,
+        'byteorder': sys.byteorder,
+        'state': dict([(name, getattr(state, name))
+                       for name in STATE_ATTRIBUTES]),
+        'start_time': encode_time(state.start_time),
+        'end_time': encode_time(state.end_time),
+        'virtual_ips': state.virtual_ips,
+        'thread_counts': list(table.thread_counts().items()),
+        'arrays': [len(getattr(table, name)) for name in StackTable.ARRAYS],
+        'kinds': len(table.kinds),
+    }
+    filename = cache_path(path)
+    tmpname = '%s.%d.tmp' % (filename, os.getpid())
+    try:
+        # on python 2 the names and paths are byte strings, that are not
+        # necessarily utf-8
+        header = json.dumps(header).encode('utf-8')
+        with open(tmpname, 'wb') as fileobj:
+            fileobj.write(MAGIC)
+            fileobj.write(struct.pack('<Q', len(header)))
+            fileobj.write(header)
+            fileobj.write(b'\x00' * padding(len(MAGIC) + 8 + len(header)))
+            for name in StackTable.ARRAYS:
+                getattr(table, name).tofile(fileobj)
+            fileobj.write(table.kinds)
+        if sys.platform == 'win32' and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmpname, filename)
+    except (EnvironmentError, ValueError, TypeError, UnicodeError):
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        return False
+    return True
+
+def load_cache(path, key=None):
+    """ Returns the LogReaderState cached for the profile at path, or
+        None if there is no valid cache.
+    """
+    if ADDR_TYPECODE is None:
+        return None
+    if key is None:
+        key = profile_key(path)
+    try:
+        with open(cache_path(path), 'rb') as fileobj:
+            data = fileobj.read()
+    except EnvironmentError:
+        return None
+    start = len(MAGIC) + 8
+    if len(data) < start or data[:len(MAGIC)] != MAGIC:
+        return None
+    length, = struct.unpack('<Q', data[len(MAGIC):start])
+    try:
+        header = json.loads(data[start:start + length].decode('utf-8'))
+    except ValueError:
+        return None
+    if (header.get('version') != FORMAT_VERSION or header['key'] != key or
+            header['typecode'] != ADDR_TYPECODE or
+            header['itemsize'] != array(ADDR_TYPECODE).itemsize or
+            header['byteorder'] != sys.byteorder):
+        return None
+    pos = start + length
+    pos += padding(pos)
+    itemsize = header['itemsize']
+    if len(data) != pos + sum(header['arrays']) * itemsize + header['kinds']:
+        return None # truncated
+
+    state = LogReaderState()
+    for name, value in header['state'].items():
+        setattr(state, name, value)
+    state.start_time = decode_time(header['start_time'])
+    state.end_time = decode_time(header['end_time'])
+    state.virtual_ips = [tuple(item) for item in header['virtual_ips']]
+    state.memory_maps = [tuple(item) for item in state.memory_maps]
+    view = memoryview(data) if PY3 else data
+    arrays = []
+    for count in header['arrays']:
+        values = array(ADDR_TYPECODE)
+        array_from_bytes(values, view[pos:pos + count * itemsize])
+        arrays.append(values)
+        pos += count * itemsize
+    table = state.profiles = StackTable.from_arrays(arrays,
+                                                    bytearray(view[pos:]))
+    table._thread_counts = dict([(thread_id, count) for thread_id, count
+                                 in header['thread_counts']])
+    return state
+
+def read_profile_state(path, write=None, workers=1):
+    """ Returns the LogReaderState of the profile at path. It is loaded
+        from the cache if there is a valid one. Otherwise the profile is
+        decoded and the cache is written if write is true. If write is
+        None, it is written for profiles of at least MIN_PROFILE_SIZE
+        bytes and to replace an outdated cache. With more than one worker
+        the profile is decoded by a pool of processes, identical samples
+        are merged then.
+    """
+    key = None
+    if os.path.exists(cache_path(path)):
+        key = profile_key(path)
+        state = load_cache(path, key)
+        if state is not None:
+            return state
+    if write is None:
+        # an outdated cache is replaced
+        write = (key is not None or
+                 os.path.getsize(path) >= MIN_PROFILE_SIZE)
+    if write and key is None:
+        # computed before reading, a profile that changes while it is
+        # read must not be cached
+        key = profile_key(path)
+    state = None
+    if workers > 1:
+        state = _read_prof_parallel(path, workers)
+    if state is None:
+        with open(path, 'rb') as fileobj:
+            state = _read_prof(fileobj)
+    if write:
+        write_cache(path, state, key)
+    return state
@@ -0,0 +1,154 @@
+""" A persistent cache of the names of native functions, shared by all
+profiles. It maps the GNU build id of a binary and the file offset of a
+function in it to the name, the line and the source file of the function,
+so a build of a binary is only symbolized once. Both vmprof.symbolize and
+disable() (see vmprof.reader.write_native_symbols) use it.
+
+The symbols of a build are stored in <build id>.json in the directory
+$XDG_CACHE_HOME/vmprof/symbols (~/.cache/vmprof/symbols by default), as
+a JSON list of [offset, name, lineno, srcfile]. VMPROF_SYMBOL_CACHE
+overrides the directory, an empty VMPROF_SYMBOL_CACHE disables the cache.
+The files take at most max_bytes together, the builds that were used
+least recently are evicted first. If the directory cannot be written the
+cache is always empty.
+
+A symbol with an empty name is a function the in-process resolver could
+not name, disable() does not try again, vmprof.symbolize does.
+"""
+import os
+import json
+import string
+import time
+
+FORMAT_VERSION = 1
+MAX_BYTES = 64 * 1024 * 1024
+# the time a build was last used is only updated if it is older than this
+# many seconds, most lookups do not write to the cache then
+USED_INTERVAL = 3600
+
+def default_cache_dir():
+    """ Returns the directory of the cache, None if it is disabled """
+    if 'VMPROF_SYMBOL_CACHE' in os.environ:
+        return os.environ['VMPROF_SYMBOL_CACHE'] or None
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'vmprof', 'symbols')
+
+def is_build_id(build_id):
+    return bool(build_id) and all([c in string.hexdigits for c in build_id])
+
+class SymbolCache(object):
+    def __init__(self, path=None, max_bytes=MAX_BYTES):
+        if path is None:
+            path = default_cache_dir()
+        self.path = path
+        self.max_bytes = max_bytes
+        # build id -> {offset: (name, lineno, srcfile)}, see read_build
+        self.builds = {}
+        # the builds put changed, written by commit
+        self.changed = set()
+
+    def build_path(self, build_id):
+        return os.path.join(self.path, build_id + '.json')
+
+    def read_build(self, build_id):
+        symbols = self.builds.get(build_id)
+        if symbols is not None:
+            return symbols
+        symbols = self.builds[build_id] = {}
+        if self.path is None or not is_build_id(build_id):
+            return symbols
+        path = self.build_path(build_id)
+        try:
+            with open(path) as fileobj:
+                data = json.load(fileobj)
+            if data['version'] == FORMAT_VERSION:
+                for offset, name, lineno, srcfile in data['symbols']:
+                    symbols[offset] = (name, lineno, srcfile)
+            if os.stat(path).st_mtime < time.time() - USED_INTERVAL:
+                # used recently, see evict
+                os.utime(path, None)
+        except (EnvironmentError, ValueError, KeyError, TypeError):
+            pass
+        return symbols
+
+    def get(self, build_id, offsets):
+        """ Returns a dict that maps the offsets in the binary build_id
+            that are cached to (name, lineno, srcfile).
+        """
+        symbols = self.read_build(build_id)
+        return dict([(offset, symbols[offset]) for offset in offsets
+                     if offset in symbols])
+
+    def put(self, build_id, symbols):
+        """ Stores symbols, a dict that maps offsets in the binary
+            build_id to (name, lineno, srcfile), when commit() is called.
+        """
+        if not symbols:
+            return
+        self.read_build(build_id).update(symbols)
+        self.changed.add(build_id)
+
+    def commit(self):
+        """ Writes the builds that were changed and evicts the least
+            recently used builds if the cache got too large.
+        """
+        changed, self.changed = self.changed, set()
+        if self.path is None:
+            return
+        for build_id in changed:
+            if not is_build_id(build_id):
+                continue
+            rows = [[offset, name, lineno, srcfile] for offset,
+                    (name, lineno, srcfile) in sorted(self.builds[build_id].items())]
+            path = self.build_path(build_id)
+            tmp_path = '%s.%d.tmp' % (path, os.getpid())
+            try:
+                if not os.path.isdir(self.path):
+                    os.makedirs(self.path)
+                with open(tmp_path, 'w') as fileobj:
+                    json.dump({'version': FORMAT_VERSION, 'symbols': rows},
+                              fileobj)
+                # readers never see a partly written file
+                os.rename(tmp_path, path)
+            except EnvironmentError:
+                try:
+                    os.remove(tmp_path)
+                except EnvironmentError:
+                    pass
+                continue
+        if changed:
+            self.evict()
+
+    def evict(self):
+        """ Removes the least recently used builds if the cache takes
+            more than max_bytes, down to 90% of it so that not every
+            commit has to evict.
+        """
+        builds = []
+        size = 0
+        try:
+            for name in os.listdir(self.path):
+                if not name.endswith('.json'):
+                    continue
+                st = os.stat(os.path.join(self.path, name))
+                builds.append((st.st_mtime, st.st_size, name))
+                size += st.st_size
+        except EnvironmentError:
+            return
+        if size <= self.max_bytes:
+            return
+        builds.sort()
+        for mtime, build_size, name in builds:
+            if size <= self.max_bytes * 9 // 10:
+                break
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except EnvironmentError:
+                continue
+            self.builds.pop(name[:-len('.json')], None)
+            size -= build_size
+
+    def close(self):
+        self.commit()
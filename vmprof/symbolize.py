@@ -0,0 +1,469 @@
+""" Resolves the native functions of a profile after profiling, on any
+machine that has the same binaries (or a copy of them in a sysroot).
+
+vmprof.enable(..., symbolize=False) writes the executable mappings of the
+process into the profile instead of the names of its native functions,
+see read_memory_maps and vmprof.reader.write_memory_maps. Later
+
+    python -m vmprof symbolize <profile>
+
+maps every native address of the profile to a binary and an offset in
+it, finds the names with addr2line, one process per binary (or chunk of
+offsets in it), and adds them to the profile. The binaries are
+recognized by their GNU build id, a binary that was rebuilt in the
+meantime is not used. Names are kept in the symbol cache (see
+vmprof.symbolcache) by build id and offset, so every build of a binary
+is only symbolized once.
+"""
+from __future__ import print_function
+import argparse
+import bisect
+import collections
+import os
+import struct
+import sys
+try:
+    from shutil import which
+except ImportError:
+    from backports.shutil_which import which
+
+from vmprof.reader import (LogReaderState, NativeCode, _open_prof,
+        native_symbol_record)
+from vmprof.symbolcache import SymbolCache
+
+ELF_MAGIC = b'\x7fELF'
+PT_LOAD = 1
+PT_NOTE = 4
+NT_GNU_BUILD_ID = 3
+# addr2line is run for at most this many offsets at once
+MAX_OFFSETS_PER_TASK = 2000
+
+Mapping = collections.namedtuple('Mapping',
+                                 'start end offset path build_id')
+
+class ElfFile(collections.namedtuple('ElfFile', 'build_id segments')):
+    """ The GNU build id of an ELF file (hex, None if it has none) and
+        (file offset, virtual address, size) of its PT_LOAD segments.
+    """
+
+    def vaddr(self, offset):
+        """ Returns the virtual address the file offset is loaded at,
+            None if it is not in a segment.
+        """
+        for seg_offset, seg_vaddr, seg_size in self.segments:
+            if seg_offset <= offset < seg_offset + seg_size:
+                return offset - seg_offset + seg_vaddr
+        return None
+
+def read_elf(path):
+    """ Reads the program headers of the ELF file at path, returns an
+        ElfFile or None if path cannot be read or is not an ELF file.
+    """
+    try:
+        with open(path, 'rb') as fileobj:
+            return _read_elf(fileobj)
+    except (EnvironmentError, struct.error):
+        return None
+
+def _read_elf(fileobj):
+    ident = fileobj.read(16)
+    if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+        return None
+    is64 = ident[4:5] == b'\x02'
+    endian = '<' if ident[5:6] == b'\x01' else '>'
+    if is64:
+        header = struct.Struct(endian + 'HHIQQQIHHHHHH')
+        # p_type, p_flags, p_offset, p_vaddr, p_paddr, p_filesz
+        phdr = struct.Struct(endian + 'IIQQQQ')
+    else:
+        header = struct.Struct(endian + 'HHIIIIIHHHHHH')
+        # p_type, p_offset, p_vaddr, p_paddr, p_filesz
+        phdr = struct.Struct(endian + 'IIIII')
+    fields = header.unpack(fileobj.read(header.size))
+    phoff, phentsize, phnum = fields[4], fields[8], fields[9]
+    fileobj.seek(phoff)
+    table = fileobj.read(phentsize * phnum)
+    build_id = None
+    segments = []
+    notes = []
+    for i in range(phnum):
+        entry = phdr.unpack_from(table, i * phentsize)
+        if is64:
+            p_type, p_offset, p_vaddr, p_filesz = (entry[0], entry[2],
+                                                   entry[3], entry[5])
+        else:
+            p_type, p_offset, p_vaddr, p_filesz = (entry[0], entry[1],
+                                                   entry[2], entry[4])
+        if p_type == PT_LOAD:
+            segments.append((p_offset, p_vaddr, p_filesz))
+        elif p_type == PT_NOTE:
+            notes.append((p_offset, p_filesz))
+    for offset, size in notes:
+        fileobj.seek(offset)
+        build_id = _find_build_id(fileobj.read(size), endian)
+        if build_id is not None:
+            break
+    return ElfFile(build_id, segments)
+
+def _find_build_id(data, endian):
+    """ Returns the GNU build id in the notes data as a hex string """
+    note = struct.Struct(endian + 'III')
+    pos = 0
+    while pos + note.size <= len(data):
+        namesz, descsz, kind = note.unpack_from(data, pos)
+        pos += note.size
+        name = data[pos:pos + namesz]
+        pos += (namesz + 3) & ~3
+        desc = data[pos:pos + descsz]
+        pos += (descsz + 3) & ~3
+        if kind == NT_GNU_BUILD_ID and name.rstrip(b'\x00') == b'GNU':
+            return ''.join(['%02x' % byte for byte in bytearray(desc)])
+    return None
+
+def read_build_id(path):
+    elf = read_elf(path)
+    if elf is None:
+        return None
+    return elf.build_id
+
+def mapped_build_id(path, file_id):
+    """ Returns the build id of the file at path if it is the file that
+        was mapped, file_id is (major, minor, inode) of the mapped file
+        (see _read_maps). A binary replaced since, e.g. by an upgrade, is
+        another file and None is returned for it.
+    """
+    try:
+        with open(path, 'rb') as fileobj:
+            st = os.fstat(fileobj.fileno())
+            if (os.major(st.st_dev), os.minor(st.st_dev), st.st_ino) != file_id:
+                return None
+            elf = _read_elf(fileobj)
+    except (EnvironmentError, struct.error):
+        return None
+    if elf is None:
+        return None
+    return elf.build_id
+
+def _read_maps(path):
+    """ Returns the executable mappings of files in path as a list of
+        (Mapping without build id, (major, minor, inode) of the file).
+    """
+    maps = []
+    with open(path) as fileobj:
+        for line in fileobj:
+            fields = line.split(None, 5)
+            if len(fields) < 6 or 'x' not in fields[1]:
+                continue
+            filename = fields[5].strip()
+            if not filename.startswith('/'):
+                # anonymous memory, [vdso], ...
+                continue
+            start, end = [int(addr, 16) for addr in fields[0].split('-')]
+            major, minor = [int(part, 16) for part in fields[3].split(':')]
+            maps.append((Mapping(start, end, int(fields[2], 16), filename,
+                                 None), (major, minor, int(fields[4]))))
+    return maps
+
+def read_memory_maps(path='/proc/self/maps', build_ids=True):
+    """ Returns the executable mappings of files in path as a list of
+        Mapping, with the build ids of the files unless build_ids is
+        False. The build id of a file that was replaced after it was
+        mapped is None. Linux only.
+    """
+    mappings = []
+    known = {}
+    for mapping, file_id in _read_maps(path):
+        if build_ids:
+            key = (mapping.path, file_id)
+            if key not in known:
+                known[key] = mapped_build_id(mapping.path, file_id)
+            mapping = mapping._replace(build_id=known[key])
+        mappings.append(mapping)
+    return mappings
+
+def find_binary(filename, build_id, sysroot=None):
+    """ Returns the path of the binary that was mapped from filename
+        when profiling, None if it is missing or has another build id.
+    """
+    candidates = [filename]
+    if sysroot:
+        candidates.insert(0, os.path.join(sysroot, filename.lstrip('/')))
+    for path in candidates:
+        if not os.path.isfile(path):
+            continue
+        if build_id is None or read_build_id(path) == build_id:
+            return path
+    return None
+
+def find_debug_file(build_id, sysroot=None):
+    """ Returns the separate debug info file of the build, if installed """
+    if not build_id or len(build_id) < 3:
+        return None
+    path = os.path.join('/usr/lib/debug/.build-id', build_id[:2],
+                        build_id[2:] + '.debug')
+    if sysroot:
+        path = os.path.join(sysroot, path.lstrip('/'))
+    if os.path.isfile(path):
+        return path
+    return None
+
+def resolve_offsets(filename, build_id, offsets, sysroot=None):
+    """ Returns (name, lineno, srcfile) for every file offset in the
+        binary that was mapped from filename, None for the offsets
+        addr2line does not know.
+    """
+    symbols = [None] * len(offsets)
+    path = find_binary(filename, build_id, sysroot)
+    addr2line = which('addr2line')
+    if path is None or addr2line is None:
+        return symbols
+    elf = read_elf(path)
+    if elf is None:
+        return symbols
+    indices = []
+    vaddrs = []
+    for i, offset in enumerate(offsets):
+        vaddr = elf.vaddr(offset)
+        if vaddr is not None:
+            indices.append(i)
+            vaddrs.append('%x' % vaddr)
+    if not vaddrs:
+        return symbols
+    debug_file = find_debug_file(build_id, sysroot)
+    # not imported at the top, disable() imports this module
+    import subprocess
+    try:
+        proc = subprocess.Popen([addr2line, '-f', '-C', '-e',
+                                 debug_file or path],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        output, _ = proc.communicate('\n'.join(vaddrs).encode('ascii'))
+    except EnvironmentError:
+        return symbols
+    lines = output.decode('utf-8', 'replace').splitlines()
+    for j, i in enumerate(indices):
+        if 2 * j + 1 >= len(lines):
+            break
+        symbols[i] = _parse_addr2line(lines[2 * j], lines[2 * j + 1])
+    return symbols
+
+def _parse_addr2line(name, location):
+    if not name or name == '??':
+        return None
+    # 'file:line', optionally followed by ' (discriminator n)'
+    srcfile, _, lineno = location.split(' (')[0].rpartition(':')
+    if not srcfile or srcfile == '??':
+        srcfile = None
+    try:
+        lineno = int(lineno)
+    except ValueError:
+        lineno = 0
+    return name, lineno, srcfile
+
+def _resolve_task(task):
+    return resolve_offsets(*task)
+
+def _map(function, tasks, workers):
+    if workers is None:
+        import multiprocessing
+        workers = multiprocessing.cpu_count()
+    if workers > 1 and len(tasks) > 1:
+        try:
+            from concurrent.futures import ProcessPoolExecutor
+        except ImportError:
+            pass
+        else:
+            with ProcessPoolExecutor(min(workers, len(tasks))) as pool:
+                return list(pool.map(function, tasks))
+    return [function(task) for task in tasks]
+
+def read_native_addresses(fileobj, state):
+    """ Reads the profile in fileobj into state (without the samples),
+        returns the native addresses of its samples and the offset of
+        its trailer (None if it has none).
+    """
+    reader, buf = _open_prof(fileobj, state)
+    addrs = set()
+    try:
+        for trace, count, thread_id, mem_in_kb in reader.iter_samples():
+            addrs.update([addr for addr in trace
+                          if isinstance(addr, NativeCode)])
+    finally:
+        if buf is not None:
+            buf.close()
+    return addrs, reader.trailer_offset
+
+def binary_offsets(mappings, addrs):
+    """ Returns a dict that maps (path, build_id) of the binaries the
+        native addresses addrs are in to a dict of {file offset: [addrs]}.
+        Addresses that are not in mappings are left out.
+    """
+    mappings = sorted(mappings)
+    starts = [mapping[0] for mapping in mappings]
+    binaries = {}
+    for addr in addrs:
+        # the lowest bit marks native addresses
+        pc = addr & ~1
+        i = bisect.bisect_right(starts, pc) - 1
+        if i < 0 or pc >= mappings[i][1]:
+            continue
+        start, end, offset, filename, build_id = mappings[i]
+        offsets = binaries.setdefault((filename, build_id), {})
+        offsets.setdefault(pc - start + offset, []).append(addr)
+    return binaries
+
+def resolve_addrs(addrs, resolve_addr, cache=True):
+    """ Returns a dict that maps the native addresses addrs of this
+        process to (name, lineno, srcfile), None for those that cannot
+        be resolved. The symbol cache is looked at first, resolve_addr
+        (see _vmprof.resolve_addr) finds the others, they are added to
+        the cache. The cache is only used on Linux.
+    """
+    symbols = {}
+    keys = {} # addr -> (build_id, offset)
+    symbol_cache = None
+    if cache and sys.platform.startswith('linux'):
+        symbol_cache = SymbolCache(None if cache is True else cache)
+        if symbol_cache.path is None:
+            symbol_cache = None
+    if symbol_cache is not None:
+        try:
+            # only the build ids of binaries with addrs are needed, until
+            # then the device and inode of the file stand in for it
+            mappings = [mapping._replace(build_id=file_id) for mapping, file_id
+                        in _read_maps('/proc/self/maps')]
+        except EnvironmentError:
+            mappings = []
+        for (filename, file_id), offsets in binary_offsets(mappings, addrs).items():
+            # None if the file was replaced since it was mapped, the
+            # symbols of the mapped one must not be cached as its
+            build_id = mapped_build_id(filename, file_id)
+            if not build_id:
+                continue
+            found = symbol_cache.get(build_id, offsets)
+            for offset, addrs_at in offsets.items():
+                for addr in addrs_at:
+                    if offset in found:
+                        symbols[addr] = found[offset]
+                    else:
+                        keys[addr] = (build_id, offset)
+    new = {} # build_id -> {offset: symbol}
+    for addr in addrs:
+        if addr in symbols:
+            continue
+        symbol = symbols[addr] = resolve_addr(addr)
+        if symbol is not None and addr in keys:
+            # unnamed functions are stored as well, see vmprof.symbolcache
+            build_id, offset = keys[addr]
+            new.setdefault(build_id, {})[offset] = tuple(symbol)
+    if symbol_cache is not None:
+        for build_id, found in new.items():
+            symbol_cache.put(build_id, found)
+        symbol_cache.close()
+    return symbols
+
+def symbolize(path, workers=None, cache=True, sysroot=None):
+    """ Adds the names of the native functions of the profile at path
+        that have none yet, using the memory maps recorded in it.
+        workers is the number of addr2line processes run at once (the
+        number of CPUs by default). cache=False does not use the symbol
+        cache, a path uses the cache there. Binaries are looked up in
+        the directory sysroot first. Returns the number of functions
+        that were named.
+    """
+    state = LogReaderState()
+    with open(path, 'rb') as fileobj:
+        if fileobj.read(2) == b'\037\213':
+            raise ValueError("%s is gzipped, cannot add symbols to it" % path)
+        fileobj.seek(0, os.SEEK_SET)
+        addrs, trailer_offset = read_native_addresses(fileobj, state)
+    if not state.memory_maps:
+        raise ValueError("%s has no memory maps, it must be written "
+                         "with symbolize=False" % path)
+    known = set([unique_id for unique_id, name in state.virtual_ips])
+    addrs = sorted(addrs - known)
+
+    binaries = binary_offsets(state.memory_maps, addrs)
+    symbol_cache = None
+    if cache:
+        symbol_cache = SymbolCache(None if cache is True else cache)
+    names = {}
+    tasks = []
+    for (filename, build_id), offsets in sorted(binaries.items()):
+        missing = sorted(offsets)
+        if symbol_cache is not None and build_id:
+            found = symbol_cache.get(build_id, missing)
+            # tried again, addr2line might know more than the resolver
+            # of the profiled process
+            found = dict([(offset, symbol) for offset, symbol in found.items()
+                          if symbol[0]])
+            for offset, symbol in found.items():
+                for addr in offsets[offset]:
+                    names[addr] = symbol
+            missing = [offset for offset in missing if offset not in found]
+        for i in range(0, len(missing), MAX_OFFSETS_PER_TASK):
+            tasks.append((filename, build_id,
+                          missing[i:i + MAX_OFFSETS_PER_TASK], sysroot))
+
+    for task, symbols in zip(tasks, _map(_resolve_task, tasks, workers)):
+        filename, build_id, offsets = task[:3]
+        resolved = {}
+        for offset, symbol in zip(offsets, symbols):
+            if symbol is None:
+                continue
+            resolved[offset] = symbol
+            for addr in binaries[(filename, build_id)][offset]:
+                names[addr] = symbol
+        if symbol_cache is not None and build_id:
+            symbol_cache.put(build_id, resolved)
+    if symbol_cache is not None:
+        symbol_cache.close()
+
+    records = []
+    for addr in addrs:
+        name, lineno, srcfile = names.get(addr, (None, 0, None))
+        records.append(native_symbol_record(addr, name, lineno, srcfile))
+    with open(path, 'r+b') as fileobj:
+        # the symbols must come before the trailer, the reader stops there
+        if trailer_offset is None:
+            fileobj.seek(0, os.SEEK_END)
+            trailer_offset = fileobj.tell()
+        fileobj.seek(trailer_offset)
+        trailer = fileobj.read()
+        fileobj.seek(trailer_offset)
+        fileobj.truncate()
+        fileobj.write(b''.join(records))
+        fileobj.write(trailer)
+    return len(names)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='vmprof symbolize',
+        description="Adds the names of the native functions to a profile "
+                    "written with symbolize=False.")
+    parser.add_argument("profile")
+    parser.add_argument(
+        '--workers', '-j',
+        type=int,
+        default=None,
+        help='The number of addr2line processes run at once (default: '
+             'the number of CPUs).')
+    parser.add_argument(
+        '--sysroot',
+        default=None,
+        help='A directory with copies of the binaries of the profiled '
+             'machine, searched before the root directory.')
+    parser.add_argument(
+        '--no-cache',
+        dest='cache',
+        action='store_false',
+        help='Do not use the symbol cache.')
+    parser.set_defaults(cache=True)
+
+    args = parser.parse_args(argv)
+    count = symbolize(args.profile, workers=args.workers, cache=args.cache,
+                      sysroot=args.sysroot)
+    print("named %d native functions in %s" % (count, args.profile))
+
+if __name__ == '__main__':
+    main()
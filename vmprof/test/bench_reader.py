@@ -0,0 +1,80 @@
+""" Benchmark the decoding of stack traces in vmprof.reader.LogReader.
+
+The samples of richards.cpython.prof are repeated to get a profile of
+a long running program, which is then decoded with the bulk reader and
+with a reader that decodes one address at a time, from memory and from
+a memory mapped file. The benchmark is run once with the native frames
+of the profile and once without them.
+
+    python -m vmprof.test.bench_reader [scale]
+"""
+from __future__ import print_function
+
+import sys
+import time
+import tempfile
+
+import py
+
+from vmprof.test.test_reader import (write_profile, read_state,
+        PerAddressLogReader)
+from vmprof.reader import (LogReader, MMapLogReader, LogReaderState,
+        mmap_profile)
+
+
+def scaled_richards(scale, native=True):
+    path = py.path.local(__file__).join('..', 'richards.cpython.prof')
+    state = read_state(path.read('rb'))
+    samples = [(trace[::-1], thread_id, mem_in_kb)
+               for trace, _, thread_id, mem_in_kb in state.profiles]
+    if not native:
+        samples = [([addr for addr in trace if addr & 1 == 0], thread_id,
+                    mem_in_kb) for trace, thread_id, mem_in_kb in samples]
+    virtual_ips = [(unique_id, name.encode('utf-8'))
+                   for unique_id, name in state.virtual_ips]
+    return write_profile(samples * scale, virtual_ips=virtual_ips)
+
+def read_mmap(fileobj, reader_class):
+    buf = mmap_profile(fileobj)
+    state = LogReaderState()
+    try:
+        reader_class(buf, state).read_all()
+    finally:
+        buf.close()
+    return state
+
+def read_file(fileobj, reader_class):
+    state = LogReaderState()
+    reader_class(fileobj, state).read_all()
+    return state
+
+def best_of(n, read, reader_class, data):
+    best = None
+    for i in range(n):
+        start = time.time()
+        state = read(data, reader_class)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best, len(state.profiles)
+
+def main(argv):
+    scale = int(argv[0]) if argv else 1000
+    for native in (True, False):
+        data = scaled_richards(scale, native)
+        print("profile: %.1f MB, native frames: %s" % (
+              len(data) / 1024.0 / 1024.0, native))
+        with tempfile.TemporaryFile() as fileobj:
+            fileobj.write(data)
+            fileobj.flush()
+            for name, read, source, reader_class in [
+                    ('per address', read_state, data, PerAddressLogReader),
+                    ('bulk', read_state, data, LogReader),
+                    ('bulk file', read_file, fileobj, LogReader),
+                    ('bulk mmap', read_mmap, fileobj, MMapLogReader)]:
+                duration, samples = best_of(3, read, reader_class, source)
+                print("  %-12s %8.3f s %12.0f samples/s" % (
+                      name, duration, samples / duration))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
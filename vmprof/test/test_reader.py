@@ -1,6 +1,6 @@
 
-import struct, py
-from vmprof import reader
+import io, gzip, struct, py
+from vmprof import reader, profiler
 from vmprof.reader import (FileReadError, MARKER_HEADER)
 from vmprof.test.test_run import (read_one_marker, read_header,
         BufferTooSmallError, FileObjWrapper)
@@ -48,3 +48,350 @@ def test_fileobj_wrapper():
     assert fw.read(4) == b'4567'
     assert fw.read(2) == b'89'
 
+
+def varint(value):
+    data = bytearray()
+    while value >= 0x80:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+def prefix_record(trace, thread_id, mem_in_kb, slot, previous, memory=False):
+    """ Returns a MARKER_STACKTRACE_PREFIX record of trace, previous is
+        the (trace, thread_id) of the last record of the slot or None.
+    """
+    common = 0
+    base_thread_id = 0
+    if previous is not None:
+        base, base_thread_id = previous
+        while (common < min(len(trace), len(base)) and
+               trace[len(trace) - 1 - common] == base[len(base) - 1 - common]):
+            common += 1
+        if not common:
+            base_thread_id = 0
+    fresh = trace[:len(trace) - common]
+    body = [varint(1), varint(slot), varint(common), varint(len(fresh))]
+    prev = 0
+    for addr in fresh:
+        body.append(varint(zigzag(addr - prev)))
+        prev = addr
+    body.append(varint(zigzag(thread_id - base_thread_id)))
+    if memory:
+        body.append(varint(mem_in_kb))
+    body = b''.join(body)
+    return reader.MARKER_STACKTRACE_PREFIX + varint(len(body)) + body
+
+def write_profile(samples, virtual_ips=(), lines=False, memory=False,
+                  interp_name=b'cpython', prefix=False, keyframe=None,
+                  periods=None):
+    """ Returns the bytes of a 64 bit profile containing the given samples.
+        Each sample is a (trace, thread_id, mem_in_kb) tuple, the trace
+        must be in the order the sampler writes it (top most frame first).
+        With prefix=True the samples are written as prefix records, one
+        slot per thread, every keyframe-th record of a slot on its own.
+        periods maps the index of a sample to the period factor that
+        starts with it.
+    """
+    mode = 0
+    if memory:
+        mode |= reader.PROFILE_MEMORY
+    if lines:
+        mode |= reader.PROFILE_LINES
+    data = [struct.pack('<5q', 0, 3, 0, 1000, 0)]
+    data.append(reader.MARKER_HEADER + struct.pack('!h', reader.VERSION_TIMESTAMP))
+    data.append(struct.pack('BB', mode, len(interp_name)) + interp_name)
+    for unique_id, name in virtual_ips:
+        data.append(reader.MARKER_VIRTUAL_IP)
+        data.append(struct.pack('<qq', unique_id, len(name)) + name)
+    slots = {}
+    for i, (trace, thread_id, mem_in_kb) in enumerate(samples):
+        if periods and i in periods:
+            data.append(reader.MARKER_PERIOD)
+            data.append(struct.pack('<qqqq', periods[i], 1000 * periods[i],
+                                    1500000000 + i, 0))
+        if prefix:
+            previous = slots.get(thread_id)
+            if keyframe and i % keyframe == 0:
+                previous = None
+            data.append(prefix_record(trace, thread_id, mem_in_kb,
+                                      thread_id % 64, previous, memory))
+            slots[thread_id] = (trace, thread_id)
+            continue
+        data.append(reader.MARKER_STACKTRACE)
+        data.append(struct.pack('<qq', 1, len(trace)))
+        data.append(struct.pack('<%dq' % len(trace), *trace))
+        data.append(struct.pack('<q', thread_id))
+        if memory:
+            data.append(struct.pack('<q', mem_in_kb))
+    data.append(reader.MARKER_TRAILER + b'\x00' * 24)
+    return b''.join(data)
+
+class PerAddressLogReader(reader.LogReader):
+    """ Decodes every address on its own, this is how LogReader decoded
+        stack traces before it learned to read them in bulk.
+    """
+    def read_addresses(self, count):
+        addrs = []
+        for i in range(count):
+            addr = self.read_addr()
+            if addr > 0 and addr & 1 == 1:
+                addrs.append(reader.NativeCode(addr))
+            else:
+                addrs.append(addr)
+        return addrs
+
+    def read_trace(self, depth):
+        trace = self.read_addresses(depth)
+        if self.state.profile_lines:
+            for i in range(0, len(trace), 2):
+                trace[i] = -trace[i]
+        return trace
+
+def read_state(data, reader_class=reader.LogReader):
+    state = reader.LogReaderState()
+    reader_class(io.BytesIO(data), state).read_all()
+    return state
+
+def assert_same_profiles(profiles, expected):
+    profiles = list(profiles)
+    expected = list(expected)
+    assert profiles == expected
+    for (trace, _, _, _), (expected_trace, _, _, _) in zip(profiles, expected):
+        assert [type(addr) for addr in trace] == \
+               [type(addr) for addr in expected_trace]
+
+def test_bulk_decode_matches_per_address():
+    samples = [([0x1000, 0x2001, 0x3000], 7, 0),
+               ([], 7, 0),
+               ([0x5001, 0x2001, 0x3000, 0x4000], 8, 0)]
+    data = write_profile(samples, virtual_ips=[(0x1000, b'py:a:1:a.py')])
+    state = read_state(data)
+    assert_same_profiles(state.profiles,
+                         read_state(data, PerAddressLogReader).profiles)
+    trace = state.profiles[0][0]
+    assert trace == [0x3000, 0x2001, 0x1000]
+    assert [type(addr) for addr in trace] == [int, reader.NativeCode, int]
+    assert state.profiles[2][2] == 8
+    assert state.virtual_ips == [(0x1000, 'py:a:1:a.py')]
+
+def test_bulk_decode_lines():
+    samples = [([3, 0x1000, 5, 0x2001, 0, 0x3000], 7, 12),
+               ([11, 0x1000], 7, 13)]
+    data = write_profile(samples, lines=True, memory=True)
+    state = read_state(data)
+    assert_same_profiles(state.profiles,
+                         read_state(data, PerAddressLogReader).profiles)
+    assert state.profiles[0] == ([0x3000, 0, 0x2001, -5, 0x1000, -3], 1, 7, 12)
+    assert state.profiles[1] == ([0x1000, -11], 1, 7, 13)
+
+def test_read_legacy_profile():
+    path = py.path.local(__file__).join('..', 'richards.cpython.prof')
+    data = path.read('rb')
+    state = read_state(data)
+    assert state.interp_name == 'cpython'
+    assert len(state.profiles) == 362
+    assert_same_profiles(state.profiles,
+                         read_state(data, PerAddressLogReader).profiles)
+
+def test_mmap_reader(tmpdir):
+    samples = [([3, 0x1000, 5, 0x2001], 7, 12), ([11, 0x1000], 8, 13)]
+    data = write_profile(samples, lines=True, memory=True,
+                         virtual_ips=[(0x1000, b'py:a:1:a.py')])
+    path = tmpdir.join('test.prof')
+    path.write_binary(data)
+    with open(str(path), 'rb') as fileobj:
+        buf = reader.mmap_profile(fileobj)
+        assert buf is not None
+        state = reader.LogReaderState()
+        reader.MMapLogReader(buf, state).read_all()
+        buf.close()
+    expected = read_state(data)
+    assert_same_profiles(state.profiles, expected.profiles)
+    assert state.virtual_ips == expected.virtual_ips
+    with open(str(path), 'rb') as fileobj:
+        assert list(reader._read_prof(fileobj).profiles) == \
+               list(expected.profiles)
+
+def test_mmap_profile_fallback(tmpdir):
+    data = write_profile([([0x1000], 7, 0)])
+    assert reader.mmap_profile(io.BytesIO(data)) is None
+    path = tmpdir.join('test.prof.gz')
+    with gzip.open(str(path), 'wb') as fileobj:
+        fileobj.write(data)
+    with open(str(path), 'rb') as fileobj:
+        assert reader.mmap_profile(fileobj) is None
+        state = reader._read_prof(fileobj)
+    assert list(state.profiles) == list(read_state(data).profiles)
+
+def test_iter_samples_symbols_after_samples(tmpdir):
+    samples = [([0x1000, 0x2001], 7, 0), ([0x1000, 0x2001], 7, 0),
+               ([0x3000], 8, 0)]
+    data = write_profile(samples)
+    # the symbol is written after the samples that refer to it
+    record = (reader.MARKER_VIRTUAL_IP +
+              struct.pack('<qq', 0x1000, 11) + b'py:a:1:a.py')
+    data = data[:-25] + record + data[-25:]
+    expected = read_state(data)
+    tmpdir.join('test.prof').write_binary(data)
+    with gzip.open(str(tmpdir.join('test.prof.gz')), 'wb') as fileobj:
+        fileobj.write(data)
+    for name in ['test.prof', 'test.prof.gz']:
+        path = tmpdir.join(name)
+        state = reader.LogReaderState()
+        samples = profiler.iter_samples(str(path), state)
+        assert next(samples) == ([0x2001, 0x1000], 1, 7, 0)
+        assert state.virtual_ips == [(0x1000, 'py:a:1:a.py')]
+        assert [next(samples)] + list(samples) == list(expected.profiles)[1:]
+        assert state.interp_name == 'cpython'
+
+def test_stack_table():
+    table = reader.StackTable()
+    trace = [1, reader.NativeCode(3), -7, reader.JittedCode(4)]
+    table.add(trace, 1, 7, 0)
+    table.add([1, 5, -7], 1, 7, 0)
+    table.add(list(trace), 2, 8, 5)
+    assert len(table.stack_counts) == 2
+    assert list(table.stack_counts) == [3, 1]
+    assert len(table) == 3
+    assert table[2] == (trace, 2, 8, 5)
+    assert [type(addr) for addr in table[2][0]] == \
+           [int, reader.NativeCode, int, reader.JittedCode]
+    assert [type(addr) for addr in table[1][0]] == [int] * 3
+    assert list(table.iter_stacks()) == [(trace, 3), ([1, 5, -7], 1)]
+    assert table.total_count() == 4
+
+def test_stack_table_hash_collision():
+    table = reader.StackTable()
+    assert table.intern([1, 2]) == 0
+    # pretend that [3, 4] has the same hash as [1, 2]
+    table.stack_ids[hash((3, 4))] = 0
+    assert table.intern([3, 4]) == 1
+    assert table.intern([3, 4]) == 1
+    assert table.intern([1, 2]) == 0
+    assert table.get_stack(1) == [3, 4]
+
+def test_stack_table_merge_samples():
+    table = reader.StackTable(merge_samples=True)
+    for i in range(3):
+        table.add([1, 2], 1, 7, 0)
+    table.add([1, 2], 1, 8, 0)
+    assert list(table) == [([1, 2], 3, 7, 0), ([1, 2], 1, 8, 0)]
+
+def test_stack_table_without_arrays(tmpdir, monkeypatch):
+    from vmprof import statscache
+    path = py.path.local(__file__).join('..', 'richards.cpython.prof')
+    expected = profiler.read_profile(str(path), cache=False)
+    expected_samples = list(expected.profiles)
+    # python 2 on 64 bit windows has no array type for addresses
+    monkeypatch.setattr(reader, 'ADDR_TYPECODE', None)
+    monkeypatch.setattr(statscache, 'ADDR_TYPECODE', None)
+    table = reader.StackTable()
+    trace = [1 << 40, reader.NativeCode((1 << 40) + 1)]
+    table.add(trace, 1, 1 << 40, 0)
+    table.add(list(trace), 1, 1 << 40, 0)
+    assert isinstance(table.frames, list)
+    assert list(table) == [(trace, 1, 1 << 40, 0)] * 2
+    assert type(table[0][0][1]) is reader.NativeCode
+    path.copy(tmpdir.join('richards.prof'))
+    filename = str(tmpdir.join('richards.prof'))
+    stats = profiler.read_profile(filename, cache=True)
+    assert not tmpdir.join('richards.prof.stats').check()
+    assert stats.get_tree() == expected.get_tree()
+    assert list(stats.profiles) == expected_samples
+
+def richards_samples():
+    path = py.path.local(__file__).join('..', 'richards.cpython.prof')
+    state = read_state(path.read('rb'))
+    samples = [(trace[::-1], thread_id, mem_in_kb)
+               for trace, _, thread_id, mem_in_kb in state.profiles]
+    virtual_ips = [(unique_id, name.encode('utf-8'))
+                   for unique_id, name in state.virtual_ips]
+    return state, samples, virtual_ips
+
+def test_read_prof_parallel(tmpdir, monkeypatch):
+    state, samples, virtual_ips = richards_samples()
+    data = write_profile(samples * 3, virtual_ips=virtual_ips)
+    tmpdir.join('test.prof').write_binary(data)
+    filename = str(tmpdir.join('test.prof'))
+    monkeypatch.setattr(reader, 'MIN_CHUNK_SIZE', 4096)
+    with open(filename, 'rb') as fileobj:
+        starts = reader.LogReader(fileobj, reader.LogReaderState()) \
+                       .read_symbols(4096)
+    assert len(starts) > 2
+    parallel = reader._read_prof_parallel(filename, 2)
+    expected = reader.StackTable(merge_samples=True)
+    for trace, count, thread_id, mem_in_kb in read_state(data).profiles:
+        expected.add(trace, count, thread_id, mem_in_kb)
+    assert_same_profiles(parallel.profiles, expected)
+    assert parallel.virtual_ips == state.virtual_ips
+    stats = profiler.read_profile(filename, cache=False, workers=2)
+    assert stats.get_tree() == profiler.read_profile(filename).get_tree()
+
+def test_prefix_records():
+    samples = [([3, 0x1000, 5, 0x2001, 0, 0x3000], 7, 12),
+               ([4, 0x1000, 5, 0x2001, 0, 0x3000], 7, 13),
+               ([2, 0x4000, 0, 0x3000], 8, 14),
+               ([6, 0x1000, 5, 0x2001, 0, 0x3000], 7, 15),
+               ([1, 0x5000], 7, 16),
+               ([4, 0x1000, 5, 0x2001, 0, 0x3000], 7, 17)]
+    expected = read_state(write_profile(samples, lines=True, memory=True))
+    data = write_profile(samples, lines=True, memory=True, prefix=True)
+    assert data.count(reader.MARKER_STACKTRACE_PREFIX) >= len(samples)
+    assert_same_profiles(read_state(data).profiles, expected.profiles)
+    data = write_profile([(trace[1::2], thread_id, 0)
+                          for trace, thread_id, _ in samples], prefix=True)
+    state = read_state(data)
+    assert state.profiles[1] == ([0x3000, 0x2001, 0x1000], 1, 7, 0)
+    assert [type(addr) for addr in state.profiles[1][0]] == \
+           [int, reader.NativeCode, int]
+
+def test_prefix_records_parallel(tmpdir, monkeypatch):
+    state, samples, virtual_ips = richards_samples()
+    samples = [(trace, i % 3, 0) for i, (trace, _, _) in enumerate(samples)]
+    data = write_profile(samples * 3, virtual_ips=virtual_ips, prefix=True,
+                         keyframe=50)
+    tmpdir.join('test.prof').write_binary(data)
+    filename = str(tmpdir.join('test.prof'))
+    monkeypatch.setattr(reader, 'MIN_CHUNK_SIZE', 1024)
+    with open(filename, 'rb') as fileobj:
+        skim = reader.LogReader(fileobj, reader.LogReaderState())
+        starts = skim.read_symbols(1024)
+    assert len(starts) > 2
+    assert any(warmup < start
+               for start, warmup in zip(starts, skim.chunk_warmups))
+    parallel = reader._read_prof_parallel(filename, 2)
+    expected = reader.StackTable(merge_samples=True)
+    for trace, count, thread_id, mem_in_kb in read_state(data).profiles:
+        expected.add(trace, count, thread_id, mem_in_kb)
+    assert_same_profiles(parallel.profiles, expected)
+
+def test_period_records(tmpdir, monkeypatch):
+    samples = [([1, 2], 1, 0), ([1, 2], 1, 0), ([3, 2], 1, 0),
+               ([1, 2], 1, 0), ([3, 2], 1, 0)]
+    data = write_profile(samples, periods={2: 4, 4: 1})
+    state = read_state(data)
+    counts = {}
+    for trace, count, thread_id, mem_in_kb in state.profiles:
+        counts[tuple(trace)] = counts.get(tuple(trace), 0) + count
+    # the samples after a period record stand for factor samples each
+    assert counts == {(2, 1): 6, (2, 3): 5}
+    assert state.period_changes == [[(1500000000 + 2) * 10**6, 4000, 4],
+                                    [(1500000000 + 4) * 10**6, 1000, 1]]
+
+    state, samples, virtual_ips = richards_samples()
+    periods = dict((i, 1 + i % 7) for i in range(0, len(samples), 100))
+    data = write_profile(samples, virtual_ips=virtual_ips, prefix=True,
+                         keyframe=50, periods=periods)
+    tmpdir.join('test.prof').write_binary(data)
+    filename = str(tmpdir.join('test.prof'))
+    monkeypatch.setattr(reader, 'MIN_CHUNK_SIZE', 1024)
+    parallel = reader._read_prof_parallel(filename, 2)
+    expected = reader.StackTable(merge_samples=True)
+    for trace, count, thread_id, mem_in_kb in read_state(data).profiles:
+        expected.add(trace, count, thread_id, mem_in_kb)
+    assert expected.total_count() > len(samples)
+    assert_same_profiles(parallel.profiles, expected)
@@ -2,6 +2,8 @@
 """
 import py
 import sys
+import os
+import platform
 import tempfile
 import time
 import gzip
@@ -19,7 +21,7 @@ from vmprof.profiler import read_profile
 from vmprof.reader import (gunzip, MARKER_STACKTRACE, MARKER_VIRTUAL_IP,
         MARKER_TRAILER, FileReadError, VERSION_THREAD_ID,
         MARKER_TIME_N_ZONE, assert_error,
-        MARKER_META, MARKER_NATIVE_SYMBOLS)
+        MARKER_META, MARKER_NATIVE_SYMBOLS, MARKER_STACKTRACE_PREFIX)
 from vmshare.binary import read_string, read_word, read_addr
 from vmprof.stats import Stats
 
@@ -244,6 +246,311 @@ def test_memory_measurment():
     prof.get_stats()
 
 
+@py.test.mark.skipif("sys.platform == 'win32'")
+@py.test.mark.skipif("'__pypy__' in sys.builtin_module_names")
+def test_aggregate():
+    prof = vmprof.Profiler()
+    with prof.measure(aggregate=True):
+        function_bar()
+    stats = prof.get_stats()
+    assert stats.profile_aggregate
+    # identical samples are written once with their count
+    assert any(count > 1 for _, count, _, _ in stats.profiles)
+    assert len(stats.profiles) < stats.profiles.total_count()
+    d = dict(stats.top_profile())
+    assert d[foo_full_name] > 0
+    with pytest.raises(ValueError):
+        vmprof.enable(sys.stdout.fileno(), memory=True, aggregate=True)
+
+
+@py.test.mark.skipif("sys.platform == 'win32'")
+@py.test.mark.skipif("'__pypy__' in sys.builtin_module_names")
+def test_compact_stacks():
+    tmpfile = tempfile.NamedTemporaryFile(delete=False)
+    vmprof.enable(tmpfile.fileno(), compact_stacks=True)
+    function_bar()
+    vmprof.disable()
+    tmpfile.close()
+    with open(tmpfile.name, 'rb') as fileobj:
+        assert MARKER_STACKTRACE_PREFIX in fileobj.read()
+    stats = read_profile(tmpfile.name)
+    d = dict(stats.top_profile())
+    assert d[foo_full_name] > 0
+
+
+@py.test.mark.skipif("sys.platform == 'win32'")
+@py.test.mark.skipif("'__pypy__' in sys.builtin_module_names")
+@py.test.mark.parametrize("compact_stacks", [False, True])
+def test_writer_thread(compact_stacks):
+    tmpfile = tempfile.NamedTemporaryFile(delete=False)
+    vmprof.enable(tmpfile.fileno(), writer_thread=True, writer_latency=0.005,
+                  compact_stacks=compact_stacks)
+    start_size = os.fstat(tmpfile.fileno()).st_size
+    function_bar()
+    # the samples are written while profiling, not only by disable()
+    assert os.fstat(tmpfile.fileno()).st_size > start_size
+    vmprof.disable()
+    tmpfile.close()
+    stats = read_profile(tmpfile.name)
+    d = dict(stats.top_profile())
+    assert d[foo_full_name] > 0
+    prof = vmprof.Profiler()
+    with prof.measure(writer_thread=True, writer_latency=0.005,
+                      compact_stacks=compact_stacks):
+        function_bar()
+    d = dict(prof.get_stats().top_profile())
+    assert d[foo_full_name] > 0
+    with pytest.raises(ValueError):
+        vmprof.enable(sys.stdout.fileno(), writer_thread=True,
+                      writer_latency=0)
+
+
+@py.test.mark.skipif("sys.platform == 'win32'")
+@py.test.mark.skipif("'__pypy__' in sys.builtin_module_names")
+def test_num_buffers():
+    prof = vmprof.Profiler()
+    with prof.measure(num_buffers=1):
+        function_bar()
+    stats = prof.get_stats()
+    # one thread never needs a second buffer
+    assert int(stats.meta['dropped_samples']) == 0
+    assert stats.get_drop_ratio() == 0.0
+    d = dict(stats.top_profile())
+    assert d[foo_full_name] > 0
+    with pytest.raises(ValueError):
+        vmprof.enable(sys.stdout.fileno(), num_buffers=0)
+
+
+@py.test.mark.skipif("not sys.platform.startswith('linux')")
+@py.test.mark.skipif("'__pypy__' in sys.builtin_module_names")
+def test_dropped_samples():
+    import threading
+    def sleeper():
+        end = time.time() + 0.3
+        while time.time() < end:
+            time.sleep(0.0001)
+    prof = vmprof.Profiler()
+    # the signal handler of a thread that interrupts the one of another
+    # thread finds the only buffer busy
+    with prof.measure(num_buffers=1, per_thread=True, real_time=True,
+                      period=0.0002):
+        threads = [threading.Thread(target=sleeper) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    stats = prof.get_stats()
+    dropped = int(stats.meta['dropped_samples'])
+    assert dropped > 0
+    lost = dropped + int(stats.meta['cancelled_samples'])
+    assert stats.get_lost_samples() == lost
+    assert stats.get_drop_ratio() == \
+        lost / float(stats.profiles.total_count() + lost)
+
+
+@py.test.mark.skipif("sys.platform == 'win32'")
+@py.test.mark.skipif("'__pypy__' in sys.builtin_module_names")
+def test_sampler_stats():
+    prof = vmprof.Profiler()
+    with prof.measure():
+        function_bar()
+        running = vmprof.sampler_stats()
+    assert running['samples'] > 0
+    assert 0 < running['handler_max_ns'] <= running['handler_ns']
+    assert running['walk_ns'] <= running['handler_ns']
+    assert running['handler_avg_ns'] > 0
+    assert 0.0 < running['overhead'] < 1.0
+    stats = prof.get_stats()
+    written = stats.get_sampler_stats()
+    assert written['samples'] >= running['samples']
+    assert written['bytes_written'] > 0
+    assert written['elapsed_ns'] >= running['elapsed_ns']
+    if sys.platform.startswith('linux') and sys.version_info >= (3, 7):
+        # the thread state comes from the GIL state slot of the thread
+        assert written['pystate_lockfree'] >= written['samples']
+
+
+@py.test.mark.skipif("sys.platform == 'win32'")
+@py.test.mark.skipif("'__pypy__' in sys.builtin_module_names")
+def test_max_overhead():
+    prof = vmprof.Profiler()
+    # no sampler is that cheap, the period grows after the first samples
+    with prof.measure(period=0.0005, max_overhead=0.000001):
+        function_bar()
+        function_bar()
+    stats = prof.get_stats()
+    assert stats.period_changes
+    timestamp, interval_usec, factor = stats.period_changes[0]
+    assert factor > 1
+    assert interval_usec >= 500 * factor
+    # the samples after the change are weighted with the factor
+    samples = stats.get_sampler_stats()['samples']
+    assert stats.profiles.total_count() >= samples
+    with pytest.raises(ValueError):
+        vmprof.enable(sys.stdout.fileno(), max_overhead=1.5)
+
+
+@py.test.mark.skipif("not sys.platform.startswith('linux')")
+@py.test.mark.skipif("'__pypy__' in sys.builtin_module_names")
+@py.test.mark.parametrize("real_time", [False, True])
+def test_per_thread(real_time):
+    import threading
+    # running before profiling starts, it gets its timer from enable()
+    go = threading.Event()
+    early = threading.Thread(target=lambda: go.wait() and function_bar())
+    early.start()
+    prof = vmprof.Profiler()
+    with prof.measure(per_thread=True, real_time=real_time):
+        go.set()
+        threads = [threading.Thread(target=function_bar) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        function_bar()
+        for thread in [early] + threads:
+            thread.join()
+    assert threading._profile_hook is None
+    stats = prof.get_stats()
+    # the main thread and the four others have samples
+    assert len(stats.get_thread_counts()) >= 5
+    d = dict(stats.top_profile())
+    assert d[foo_full_name] > 0
+
+
+@py.test.mark.skipif("not os.path.exists('/proc/self/timers')")
+@py.test.mark.skipif("'__pypy__' in sys.builtin_module_names")
+def test_per_thread_timers_of_exited_threads():
+    import threading
+    def timer_count():
+        with open('/proc/self/timers') as fileobj:
+            return len([line for line in fileobj if line.startswith('ID:')])
+    prof = vmprof.Profiler()
+    with prof.measure(per_thread=True, real_time=True):
+        for i in range(10):
+            thread = threading.Thread(target=function_foo)
+            thread.start()
+            thread.join()
+        # not one for every thread, a thread that returned from join()
+        # may not have exited yet
+        assert timer_count() < 5
+    assert timer_count() == 0
+
+
+@py.test.mark.skipif("not sys.platform.startswith('linux')")
+@py.test.mark.skipif("'__pypy__' in sys.builtin_module_names")
+def test_perf_events():
+    import threading
+    with py.test.raises(ValueError):
+        vmprof.enable(0, perf_events=True, real_time=True)
+    prof = vmprof.Profiler()
+    with prof.measure(perf_events=True):
+        threads = [threading.Thread(target=function_bar) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        function_bar()
+        for thread in threads:
+            thread.join()
+    stats = prof.get_stats()
+    # itimer if perf_event_paranoid forbids perf events here
+    backend = stats.meta['sampling_backend']
+    assert backend in ('perf_event', 'itimer')
+    assert vmprof.sampler_stats()['backend'] == backend
+    if backend == 'perf_event':
+        assert len(stats.get_thread_counts()) >= 4
+    d = dict(stats.top_profile())
+    assert d[foo_full_name] > 0
+
+
+@py.test.mark.skipif("sys.platform == 'win32'")
+@py.test.mark.skipif("'__pypy__' in sys.builtin_module_names")
+def test_disable_does_not_read_profile(monkeypatch):
+    def read_all(self):
+        raise AssertionError("disable() read the profile")
+    monkeypatch.setattr(vmprof.LogReaderDumpNative, 'read_all', read_all)
+    # nor does it look for the code objects through all objects
+    monkeypatch.delattr(vmprof._vmprof, 'write_all_code_objects')
+    tmpfile = tempfile.NamedTemporaryFile(delete=False)
+    vmprof.enable(tmpfile.fileno(), native=True)
+    function_bar()
+    namespace = {}
+    exec("def dying_function(function_foo):\n    return function_foo()", namespace)
+    namespace['dying_function'](function_foo)
+    del namespace  # the code object is written when it dies
+    vmprof.disable()
+    tmpfile.close()
+    stats = read_profile(tmpfile.name)
+    d = dict(stats.top_profile())
+    assert d[foo_full_name] > 0
+    assert any(name.startswith('py:dying_function:') for name in d)
+    assert any(name.startswith('n:') for name in stats.adr_dict.values())
+
+
+@py.test.mark.skipif("sys.platform == 'win32'")
+@py.test.mark.skipif("'__pypy__' in sys.builtin_module_names")
+def test_unsampled_code_objects_are_not_written():
+    tmpfile = tempfile.NamedTemporaryFile(delete=False)
+    vmprof.enable(tmpfile.fileno())
+    for i in range(1000):
+        # never runs, thus never sampled
+        compile("def f%d(): pass" % i, "<unsampled>", "exec")
+    function_foo()
+    vmprof.disable()
+    tmpfile.close()
+    stats = read_profile(tmpfile.name)
+    names = stats.adr_dict.values()
+    assert not [name for name in names if name.endswith(':<unsampled>')]
+    assert foo_full_name in names
+
+
+def _cached_leaf_a():
+    for k in range(20):
+        l = [a for a in xrange(COUNT)]
+    return l
+
+def _cached_leaf_b():
+    for k in range(20):
+        l = [a for a in xrange(COUNT)]
+    return l
+
+def _cached_deep(n, leaf):
+    if n:
+        return _cached_deep(n - 1, leaf)
+    return leaf()
+
+def _cached_caller_a():
+    return _cached_deep(50, _cached_leaf_a)
+
+def _cached_caller_b():
+    return _cached_deep(50, _cached_leaf_b)
+
+@py.test.mark.skipif("sys.platform == 'win32'")
+@py.test.mark.skipif("'__pypy__' in sys.builtin_module_names")
+@py.test.mark.parametrize("lines", [False, True])
+def test_cache_stacks(lines):
+    tmpfile = tempfile.NamedTemporaryFile(delete=False)
+    vmprof.enable(tmpfile.fileno(), lines=lines, cache_stacks=True)
+    for i in range(20):
+        # the frames of both callers reuse the same memory
+        _cached_caller_a()
+        _cached_caller_b()
+    vmprof.disable()
+    tmpfile.close()
+    sampler = vmprof.sampler_stats()
+    assert sampler['cached_frames'] > sampler['walked_frames']
+    stats = read_profile(tmpfile.name)
+    checked = 0
+    for trace, count, thread_id, mem in stats.profiles:
+        names = [stats.adr_dict[addr].split(':')[1] for addr in trace
+                 if addr in stats.adr_dict]
+        for leaf, caller, other in [('_cached_leaf_a', '_cached_caller_a', '_cached_caller_b'),
+                                    ('_cached_leaf_b', '_cached_caller_b', '_cached_caller_a')]:
+            if leaf in names:
+                assert caller in names
+                assert other not in names
+                assert names.count('_cached_deep') == 51
+                checked += 1
+    assert checked > 0
+
+
 @py.test.mark.skipif("sys.platform == 'win32'")
 def test_vmprof_real_time():
     prof = vmprof.Profiler()
@@ -436,9 +743,10 @@ class TestNative(object):
         cls.lib = clib.lib
         cls.ffi = clib.ffi
 
-    def test_gzip_call(self):
+    @py.test.mark.parametrize("native", [True, 'fp'])
+    def test_gzip_call(self, native):
         p = vmprof.Profiler()
-        with p.measure(native=True):
+        with p.measure(native=native):
             for i in range(1000):
                 self.lib.native_gzipgzipgzip();
         stats = p.get_stats()
@@ -464,6 +772,16 @@ class TestNative(object):
 
         parent = stats.get_tree()
         assert walk(parent)
+        # the same native frames are walked over and over
+        sampler = stats.get_sampler_stats()
+        assert sampler['unwind_hits'] > sampler['unwind_misses']
+        if native == 'fp' and sys.platform.startswith('linux') and \
+                platform.machine() == 'x86_64':
+            # samples whose frame pointers lead nowhere use libunwind
+            assert sampler['fp_walks'] > 0
+            assert sampler['fp_fallbacks'] <= sampler['fp_walks']
+        else:
+            assert sampler['fp_walks'] == 0
 
     def test_is_enabled(self):
         assert vmprof.is_enabled() == False
@@ -5,7 +5,8 @@ import py
 import six
 
 import vmprof
-from vmprof.stats import Node, Stats, JittedCode, AssemblerCode
+from vmprof.stats import (Node, Stats, StatsBuilder, JittedCode,
+        AssemblerCode, NativeCode, TreeNode)
 
 def test_tree_basic():
     profiles = [([1, 2], 1, 1),
@@ -23,6 +24,31 @@ def test_tree_basic():
         2: Node(2, 'bar', 1),
         3: Node(3, 'baz', 1)})
 
+def test_drop_ratio():
+    profiles = [([1, 2], 1, 1)] * 6
+    stats = Stats(profiles, adr_dict={1: 'foo', 2: 'bar'})
+    assert stats.get_lost_samples() == 0
+    assert stats.get_drop_ratio() == 0.0
+    stats = Stats(profiles, adr_dict={1: 'foo', 2: 'bar'},
+                  meta={'dropped_samples': '3', 'cancelled_samples': '1'})
+    assert stats.get_lost_samples() == 4
+    assert stats.get_drop_ratio() == 0.4
+    assert stats.get_sampler_stats() == {}
+
+def test_sampler_stats():
+    meta = {'sampler_samples': '10', 'sampler_handler_ns': '20000',
+            'sampler_walk_ns': '5000', 'sampler_elapsed_ns': '2000000',
+            'dropped_samples': '1', 'os': 'linux'}
+    stats = Stats([([1], 1, 1)], adr_dict={1: 'foo'}, meta=meta)
+    sampler = stats.get_sampler_stats()
+    assert sampler['samples'] == 10
+    assert sampler['dropped_samples'] == 1
+    assert sampler['handler_avg_ns'] == 2000
+    assert sampler['walk_avg_ns'] == 500
+    assert sampler['overhead'] == 0.01
+    assert sampler['backend'] == 'itimer'
+    assert sampler['unwind_hit_rate'] == 0.0
+
 def test_tree_jit():
     profiles = [([1], 1, 1),
                 ([1, AssemblerCode(100), JittedCode(1)], 1, 1)]
@@ -31,6 +57,102 @@ def test_tree_jit():
     assert tree == Node(1, 'foo', 2)
     assert tree.meta['jit'] == 1
 
+def test_tree_native():
+    profiles = [([1, NativeCode(3), 2], 1, 1)]
+    stats = Stats(profiles, adr_dict={1: 'foo', 2: 'bar', 3: 'baz'})
+    tree = stats.get_tree()
+    native = tree.children[3]
+    assert type(native.addr) is NativeCode
+    assert list(native.children.keys()) == [2]
+    assert type(native.children[2].addr) is int
+    assert type(tree.addr) is int
+
+def test_stats_builder():
+    profiles = [([1, 2, -3], 1, 7, 0),
+                ([1, 3], 1, 7, 0),
+                ([1, 2, -3], 1, 7, 0),
+                ([1, 2, -3], 1, 8, 0)]
+    builder = StatsBuilder()
+    for profile in profiles:
+        builder.add_sample(*profile)
+    merged = builder.get_profiles()
+    assert merged == [([1, 2, -3], 2, 7, 0), ([1, 3], 1, 7, 0),
+                      ([1, 2, -3], 1, 8, 0)]
+    adr_dict = {1: 'foo', 2: 'bar', 3: 'baz'}
+    stats = Stats(profiles, adr_dict=adr_dict)
+    merged_stats = Stats(merged, adr_dict=adr_dict)
+    assert merged_stats.get_tree() == stats.get_tree()
+    assert merged_stats.get_tree()[2].lines == {3: 3}
+    assert merged_stats.functions == stats.functions
+    assert merged_stats.function_profile(1) == stats.function_profile(1)
+
+def node_tree(stats):
+    """ Builds the call tree of stats out of Node objects """
+    top = stats.get_top(stats.profiles)
+    for trace, count, _, _ in stats.profiles:
+        cur = top
+        for addr in trace[1:]:
+            if addr <= 0:
+                cur.lines[-addr] = cur.lines.get(-addr, 0) + count
+            elif addr != cur.addr:
+                cur = cur.add_child(addr, stats._get_name(addr), count)
+        if isinstance(trace[-1], NativeCode):
+            cur.meta['native'] = cur.meta.get('native', 0) + count
+    return top
+
+def test_call_tree():
+    path = py.path.local(__file__).join('..', 'richards.cpython.prof')
+    stats = vmprof.read_profile(str(path))
+    tree = stats.get_tree()
+    assert isinstance(tree, TreeNode)
+    expected = stats.filter_top(node_tree(stats))
+    assert tree == expected
+    assert tree.as_json() == expected.as_json()
+    assert tree._rec_count() == expected._rec_count()
+    self_counts = []
+    expected_self_counts = []
+    tree.walk(lambda node: self_counts.append(node.self_count))
+    expected.walk(lambda node: expected_self_counts.append(node.self_count))
+    assert self_counts == expected_self_counts
+    tree._filter(10)
+    expected._filter(10)
+    assert tree == expected
+
+def test_function_profile_index():
+    path = py.path.local(__file__).join('..', 'richards.cpython.prof')
+    stats = vmprof.read_profile(str(path))
+    for addr in list(stats.functions)[:20]:
+        # scan all samples, as function_profile did before the index
+        result = {}
+        total = 0
+        for trace, count, _, _ in stats.profiles:
+            if addr in trace:
+                total += count
+                for other in set(trace[trace.index(addr) + 1:]):
+                    result[other] = result.get(other, 0) + count
+        profile, profile_total = stats.function_profile(addr)
+        assert profile_total == total
+        assert dict(profile) == result
+
+def test_callers_callees():
+    profiles = [([1, 2, 3], 1, 1),
+                ([1, 3], 2, 1),
+                ([1, 2, 3, 2], 1, 1),
+                ([4], 1, 1)]
+    adr_dict = {1: 'py:main:1:a.py', 2: 'py:foo:2:a.py',
+                3: 'py:bar:3:a.py', 4: 'py:foo:7:b.py'}
+    stats = Stats(profiles, adr_dict=adr_dict)
+    callers, total = stats.get_callers(3)
+    assert dict(callers) == {1: 2, 2: 2}
+    assert total == 4
+    assert stats.get_callees(2) == ([(3, 2)], 2)
+    callees, total = stats.get_callees(1)
+    assert dict(callees) == {2: 2, 3: 2}
+    assert total == 4
+    assert stats.get_callers(5) == ([], 0)
+    assert sorted(stats.find_addrs_containing_name('foo')) == [2, 4]
+    assert stats.find_addrs_by_name('bar') == [3]
+
 def test_read_simple():
     py.test.skip("think later")
     lib_cache = get_or_write_libcache('simple_nested.pypy.prof')
@@ -0,0 +1,74 @@
+import os
+
+from vmprof import statscache
+from vmprof.profiler import read_profile
+from vmprof.reader import NativeCode
+from vmprof.test.test_reader import write_profile
+from vmprof.test.test_symbolize import write_maps_profile
+
+SAMPLES = [([0x1000, 0x2001, 0x3000], 7, 0),
+           ([0x1000, 0x2001, 0x3000], 7, 0),
+           ([0x5000, 0x3000], 8, 0)]
+VIRTUAL_IPS = [(0x1000, b'py:a:1:a.py'), (0x3000, b'py:<module>:1:a.py'),
+               (0x5000, b'py:b:1:a.py')]
+
+def test_cache_roundtrip(tmpdir):
+    path = str(tmpdir.join('test.prof'))
+    with open(path, 'wb') as fileobj:
+        fileobj.write(write_profile(SAMPLES, virtual_ips=VIRTUAL_IPS))
+    stats = read_profile(path, cache=True)
+    assert os.path.exists(statscache.cache_path(path))
+    state = statscache.load_cache(path)
+    assert state is not None
+    assert list(state.profiles) == list(stats.profiles)
+    assert type(state.profiles[0][0][1]) is NativeCode
+    assert state.virtual_ips == [(0x1000, 'py:a:1:a.py'),
+                                 (0x3000, 'py:<module>:1:a.py'),
+                                 (0x5000, 'py:b:1:a.py')]
+    assert state.interp_name == 'cpython'
+    assert state.profiles.thread_counts() == {7: 2, 8: 1}
+    cached = read_profile(path)
+    assert cached.get_tree() == stats.get_tree()
+    assert cached.get_thread_counts() == {7: 2, 8: 1}
+    assert cached.start_time == stats.start_time
+    # a loaded table can still be extended
+    state.profiles.add([0x3000, 0x2001, 0x1000], 1, 7, 0)
+    assert list(state.profiles.stack_counts) == [3, 1]
+
+def test_cache_memory_maps(tmpdir):
+    path = str(tmpdir.join('test.prof'))
+    mappings = [(0x400000, 0x500000, 0x1000, '/usr/bin/python', 'abcdef'),
+                (0x7f0000000000, 0x7f0000100000, 0, '/lib/libc.so', None)]
+    write_maps_profile(path, [0x400100], mappings)
+    read_profile(path, cache=True)
+    assert statscache.load_cache(path).memory_maps == mappings
+
+def test_cache_invalidated(tmpdir):
+    path = str(tmpdir.join('test.prof'))
+    with open(path, 'wb') as fileobj:
+        fileobj.write(write_profile(SAMPLES))
+    read_profile(path, cache=True)
+    with open(path, 'wb') as fileobj:
+        fileobj.write(write_profile(SAMPLES[:1]))
+    assert statscache.load_cache(path) is None
+    assert len(read_profile(path).profiles) == 1
+    # the outdated cache was replaced
+    assert len(statscache.load_cache(path).profiles) == 1
+
+def test_no_cache_for_small_profiles(tmpdir):
+    path = str(tmpdir.join('test.prof'))
+    with open(path, 'wb') as fileobj:
+        fileobj.write(write_profile(SAMPLES))
+    read_profile(path)
+    read_profile(path, cache=False)
+    assert not os.path.exists(statscache.cache_path(path))
+
+def test_cache_of_unencodable_state(tmpdir):
+    path = str(tmpdir.join('test.prof'))
+    with open(path, 'wb') as fileobj:
+        fileobj.write(write_profile(SAMPLES))
+    state = statscache.read_profile_state(path, write=False)
+    # a byte string that is not utf-8, as in a profile read by python 2
+    state.meta = {'argv': b'\xff'}
+    assert not statscache.write_cache(path, state, statscache.profile_key(path))
+    assert os.listdir(str(tmpdir)) == ['test.prof']
@@ -0,0 +1,78 @@
+import os
+import time
+
+from vmprof import symbolcache
+from vmprof.symbolcache import SymbolCache
+
+BUILD_A = 'aa' * 20
+BUILD_B = 'bb' * 20
+
+def test_roundtrip(tmpdir):
+    path = str(tmpdir.join('symbols'))
+    cache = SymbolCache(path)
+    assert cache.get(BUILD_A, [0x10, 0x20]) == {}
+    cache.put(BUILD_A, {0x10: ('main', 12, 'main.c'), 0x30: ('', 0, '-')})
+    cache.close()
+    cache = SymbolCache(path)
+    assert cache.get(BUILD_A, [0x10, 0x20, 0x30]) == {
+        0x10: ('main', 12, 'main.c'), 0x30: ('', 0, '-')}
+    assert cache.get(BUILD_B, [0x10]) == {}
+
+def test_evicts_least_recently_used(tmpdir):
+    path = str(tmpdir.join('symbols'))
+    cache = SymbolCache(path)
+    cache.put(BUILD_A, dict([(i, ('f%d' % i, i, 'a.c')) for i in range(100)]))
+    cache.put(BUILD_B, dict([(i, ('g%d' % i, i, 'b.c')) for i in range(100)]))
+    cache.close()
+    size = os.path.getsize(os.path.join(path, BUILD_A + '.json'))
+    # A was used before B
+    old = time.time() - 2 * symbolcache.USED_INTERVAL
+    os.utime(os.path.join(path, BUILD_A + '.json'), (old, old))
+    cache = SymbolCache(path, max_bytes=size * 2)
+    cache.put('cc' * 20, {0x10: ('h', 1, 'c.c')})
+    cache.close()
+    assert sorted(os.listdir(path)) == [BUILD_B + '.json', 'cc' * 20 + '.json']
+
+def test_reading_marks_used(tmpdir):
+    path = str(tmpdir.join('symbols'))
+    cache = SymbolCache(path)
+    cache.put(BUILD_A, {0x10: ('main', 12, 'main.c')})
+    cache.close()
+    filename = os.path.join(path, BUILD_A + '.json')
+    old = time.time() - 2 * symbolcache.USED_INTERVAL
+    os.utime(filename, (old, old))
+    assert SymbolCache(path).get(BUILD_A, [0x10])
+    assert os.path.getmtime(filename) > old + symbolcache.USED_INTERVAL
+
+def test_disabled(tmpdir, monkeypatch):
+    monkeypatch.setenv('VMPROF_SYMBOL_CACHE', '')
+    assert symbolcache.default_cache_dir() is None
+    cache = SymbolCache()
+    cache.put(BUILD_A, {0x10: ('main', 12, 'main.c')})
+    cache.close()
+    monkeypatch.setenv('VMPROF_SYMBOL_CACHE', str(tmpdir))
+    assert symbolcache.default_cache_dir() == str(tmpdir)
+    assert os.listdir(str(tmpdir)) == []
+
+def test_invalid_files_are_ignored(tmpdir):
+    path = str(tmpdir.join('symbols'))
+    os.makedirs(path)
+    with open(os.path.join(path, BUILD_A + '.json'), 'w') as fileobj:
+        fileobj.write('{"version": 1, "symbols": [[1, ')
+    cache = SymbolCache(path)
+    assert cache.get(BUILD_A, [1]) == {}
+    # not a file name
+    cache.put('../x', {0x10: ('main', 12, 'main.c')})
+    cache.close()
+    assert os.listdir(str(tmpdir)) == ['symbols']
+
+def test_failed_write_is_cleaned_up(tmpdir):
+    path = str(tmpdir.join('symbols'))
+    # the file of build A cannot be replaced
+    os.makedirs(os.path.join(path, BUILD_A + '.json'))
+    cache = SymbolCache(path)
+    cache.put(BUILD_A, {0x10: ('main', 12, 'main.c')})
+    cache.put(BUILD_B, {0x20: ('f', 3, 'b.c')})
+    cache.close()
+    assert sorted(os.listdir(path)) == [BUILD_A + '.json', BUILD_B + '.json']
+    assert SymbolCache(path).get(BUILD_B, [0x20]) == {0x20: ('f', 3, 'b.c')}
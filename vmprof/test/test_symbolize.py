@@ -0,0 +1,177 @@
+import ctypes
+import os
+import sys
+
+import py
+
+import vmprof
+from vmprof import reader, symbolize
+from vmprof.profiler import read_profile
+from vmprof.test.test_reader import write_profile
+from vmprof.test.test_run import function_foo, foo_full_name
+
+pytestmark = [
+    py.test.mark.skipif("not sys.platform.startswith('linux')"),
+    py.test.mark.skipif("'__pypy__' in sys.builtin_module_names"),
+]
+
+needs_addr2line = py.test.mark.skipif("symbolize.which('addr2line') is None")
+
+def getpid_address():
+    """ The start of getpid() in libc, a native function the profile
+        written by write_maps_profile samples.
+    """
+    return ctypes.cast(ctypes.CDLL(None).getpid, ctypes.c_void_p).value
+
+def read_memory_maps(path):
+    with open(path, 'rb') as fileobj:
+        return reader._read_prof(fileobj).memory_maps
+
+def write_maps_profile(path, addrs, mappings):
+    data = write_profile([([0x1000, addr | 1], 7, 0) for addr in addrs],
+                         virtual_ips=[(0x1000, b'py:main:1:a.py')])
+    # the memory maps go before the trailer
+    trailer = len(data) - 25
+    assert data[trailer:trailer + 1] == reader.MARKER_TRAILER
+    with open(path, 'wb') as fileobj:
+        fileobj.write(data[:trailer])
+        reader.write_memory_maps(fileobj, mappings)
+        fileobj.write(data[trailer:])
+
+def test_read_elf():
+    elf = symbolize.read_elf(os.path.realpath(sys.executable))
+    assert elf is not None
+    assert elf.segments
+    offset, vaddr, size = elf.segments[0]
+    assert elf.vaddr(offset) == vaddr
+    assert elf.build_id is None or int(elf.build_id, 16) >= 0
+    assert symbolize.read_elf(__file__) is None
+    assert symbolize.read_elf('/does/not/exist') is None
+
+def test_read_memory_maps():
+    mappings = symbolize.read_memory_maps()
+    addr = getpid_address()
+    found = [m for m in mappings if m.start <= addr < m.end]
+    assert len(found) == 1
+    assert os.path.exists(found[0].path)
+    assert found[0].build_id == symbolize.read_build_id(found[0].path)
+
+def write_maps_file(path, mapping, inode_delta=0):
+    st = os.stat(mapping.path)
+    with open(path, 'w') as fileobj:
+        fileobj.write('%x-%x r-xp %08x %02x:%02x %d %s\n' % (
+            mapping.start, mapping.end, mapping.offset, os.major(st.st_dev),
+            os.minor(st.st_dev), st.st_ino + inode_delta, mapping.path))
+
+def test_read_memory_maps_replaced_file(tmpdir):
+    addr = getpid_address()
+    libc = [m for m in symbolize.read_memory_maps()
+            if m.start <= addr < m.end][0]
+    path = str(tmpdir.join('maps'))
+    write_maps_file(path, libc)
+    assert symbolize.read_memory_maps(path) == [libc]
+    # another file than the mapped one has the path now
+    write_maps_file(path, libc, inode_delta=1)
+    assert symbolize.read_memory_maps(path) == [libc._replace(build_id=None)]
+
+def test_memory_maps_roundtrip(tmpdir):
+    path = str(tmpdir.join('test.prof'))
+    mappings = [(0x400000, 0x500000, 0x1000, '/usr/bin/python', 'abcdef'),
+                (0x7f0000000000, 0x7f0000100000, 0, '/lib/libc.so', None)]
+    write_maps_profile(path, [0x400100], mappings)
+    assert read_memory_maps(path) == mappings
+    assert read_profile(path, cache=False).get_thread_counts() == {7: 1}
+
+@needs_addr2line
+def test_symbolize_profile(tmpdir):
+    path = str(tmpdir.join('test.prof'))
+    cache = str(tmpdir.join('symbols'))
+    addr = getpid_address()
+    mappings = symbolize.read_memory_maps()
+    unmapped = 0x1000000
+    assert not [m for m in mappings if m.start <= unmapped < m.end]
+    write_maps_profile(path, [addr, unmapped], mappings)
+    assert symbolize.symbolize(path, workers=2, cache=cache) == 1
+    names = read_profile(path, cache=False).adr_dict
+    assert names[addr | 1].split(':')[1] in ('getpid', '__getpid')
+    assert names[unmapped | 1] == 'n:<native symbol 0x%x>:0:-' % (unmapped | 1)
+    # the names are not added twice
+    assert symbolize.symbolize(path, cache=cache) == 0
+
+@needs_addr2line
+def test_symbolize_uses_cache(tmpdir, monkeypatch):
+    cache = str(tmpdir.join('symbols'))
+    addr = getpid_address()
+    mappings = symbolize.read_memory_maps()
+    first = str(tmpdir.join('first.prof'))
+    write_maps_profile(first, [addr], mappings)
+    symbolize.symbolize(first, workers=1, cache=cache)
+    # found without addr2line
+    monkeypatch.setattr(symbolize, 'which', lambda name: None)
+    second = str(tmpdir.join('second.prof'))
+    write_maps_profile(second, [addr], mappings)
+    assert symbolize.symbolize(second, workers=1, cache=cache) == 1
+    assert read_profile(second, cache=False).adr_dict[addr | 1] == \
+        read_profile(first, cache=False).adr_dict[addr | 1]
+    third = str(tmpdir.join('third.prof'))
+    write_maps_profile(third, [addr], mappings)
+    assert symbolize.symbolize(third, workers=1, cache=False) == 0
+
+@needs_addr2line
+def test_enable_symbolize_false(tmpdir):
+    path = str(tmpdir.join('test.prof'))
+    with open(path, 'w+b') as fileobj:
+        vmprof.enable(fileobj.fileno(), native=True, symbolize=False)
+        function_foo()
+        vmprof.disable()
+    assert read_memory_maps(path)
+    stats = read_profile(path, cache=False)
+    assert not [name for name in stats.adr_dict.values()
+                if name.startswith('n:')]
+    assert symbolize.symbolize(path, cache=str(tmpdir.join('cache'))) > 0
+    stats = read_profile(path, cache=False)
+    names = [name for name in stats.adr_dict.values()
+             if name.startswith('n:') and not name.startswith('n:<native')]
+    assert names
+    assert dict(stats.top_profile())[foo_full_name] > 0
+
+def test_resolve_addrs_uses_cache(tmpdir):
+    cache = str(tmpdir.join('symbols'))
+    addr = getpid_address() | 1
+    unknown = (getpid_address() + 4) | 1
+    resolved = []
+    def resolve_addr(addr):
+        resolved.append(addr)
+        if addr == unknown:
+            return ('', 0, '-')
+        return ('getpid', 0, 'libc')
+    symbols = symbolize.resolve_addrs([addr, unknown], resolve_addr, cache)
+    assert symbols == {addr: ('getpid', 0, 'libc'), unknown: ('', 0, '-')}
+    assert resolved == [addr, unknown]
+    # the functions that could not be named are cached as well
+    del resolved[:]
+    assert symbolize.resolve_addrs([addr, unknown], resolve_addr, cache) == symbols
+    assert resolved == []
+    assert symbolize.resolve_addrs([addr], resolve_addr, False) == {
+        addr: ('getpid', 0, 'libc')}
+    assert resolved == [addr]
+
+def test_resolve_addrs_replaced_file(tmpdir, monkeypatch):
+    cache = str(tmpdir.join('symbols'))
+    addr = getpid_address() | 1
+    maps = str(tmpdir.join('maps'))
+    libc = [m for m in symbolize.read_memory_maps()
+            if m.start <= addr < m.end][0]
+    write_maps_file(maps, libc, inode_delta=1)
+    read_maps = symbolize._read_maps
+    monkeypatch.setattr(symbolize, '_read_maps', lambda path: read_maps(maps))
+    resolved = []
+    def resolve_addr(addr):
+        resolved.append(addr)
+        return ('getpid', 0, 'libc')
+    for i in range(2):
+        assert symbolize.resolve_addrs([addr], resolve_addr, cache) == {
+            addr: ('getpid', 0, 'libc')}
+    # not cached under the build id of the file on disk
+    assert resolved == [addr, addr]
+    assert not os.path.exists(cache)